@@ -1,132 +1,222 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
-import asyncio
 import json
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from app.core.config import settings
+from app.db.versioning import BOOT_ID
 from app.models.task import Task, TaskStage, TaskStatus
 from app.db.database import SessionLocal
 from app.schemas.task import ProgressInfo
+from app.services import progress_bus
 
 router = APIRouter()
 
 
-async def event_generator(task_id: int):
-    """Generate SSE events for task progress"""
-    last_progress = -1
-    last_stage = ""
-    last_message = ""
-    last_status = ""
-    last_detail = None
-
-    def _stage_meta(task: Task) -> ProgressInfo:
-        stage_order = {
-            TaskStage.UNPACKING: 1,
-            TaskStage.PREVIEW_GENERATION: 1,
-            TaskStage.DE_DUPLICATION: 2,
-            TaskStage.FOCUS_DETECTION: 3,
-            TaskStage.CROPPING: 3,
-            TaskStage.TAGGING: 4,
-            TaskStage.PACKAGING: 4,
-            TaskStage.FINISHED: 4,
-            TaskStage.INITIAL: 1,
-        }
-        stage_names = {
-            1: "上传/解压",
-            2: "去重",
-            3: "裁切",
-            4: "打标/导出",
-        }
-        stage_total = 4
-        stage_index = stage_order.get(task.stage, 1)
-        segment = 100 / stage_total
-        overall_raw = max(0.0, min(100.0, float(task.progress)))
-        if task.status == TaskStatus.COMPLETED:
-            overall_raw = 100.0
-            stage_index = stage_total
-            stage_percent = 100.0
-        else:
-            stage_start = segment * (stage_index - 1)
-            stage_percent = (overall_raw - stage_start) / segment * 100
-            stage_percent = max(0.0, min(100.0, stage_percent))
-        return ProgressInfo(
-            overall_percent=overall_raw,
-            stage_index=stage_index,
-            stage_total=stage_total,
-            stage_name=stage_names.get(stage_index, task.stage.value if hasattr(task.stage, "value") else str(task.stage)),
-            stage_percent=stage_percent,
-            step_hint=task.message,
-        )
-    
+def _stage_meta(state: dict) -> ProgressInfo:
+    stage_order = {
+        TaskStage.UNPACKING: 1,
+        TaskStage.PREVIEW_GENERATION: 1,
+        TaskStage.DE_DUPLICATION: 2,
+        TaskStage.FOCUS_DETECTION: 3,
+        TaskStage.CROPPING: 3,
+        TaskStage.TAGGING: 4,
+        TaskStage.PACKAGING: 4,
+        TaskStage.FINISHED: 4,
+        TaskStage.INITIAL: 1,
+    }
+    stage_names = {
+        1: "上传/解压",
+        2: "去重",
+        3: "裁切",
+        4: "打标/导出",
+    }
+    stage_total = 4
+    stage_index = stage_order.get(state.get("stage"), 1)
+    segment = 100 / stage_total
+    overall_raw = max(0.0, min(100.0, float(state.get("progress") or 0)))
+    if state.get("status") == TaskStatus.COMPLETED:
+        overall_raw = 100.0
+        stage_index = stage_total
+        stage_percent = 100.0
+    else:
+        stage_start = segment * (stage_index - 1)
+        stage_percent = (overall_raw - stage_start) / segment * 100
+        stage_percent = max(0.0, min(100.0, stage_percent))
+    return ProgressInfo(
+        overall_percent=overall_raw,
+        stage_index=stage_index,
+        stage_total=stage_total,
+        stage_name=stage_names.get(stage_index, str(state.get("stage"))),
+        stage_percent=stage_percent,
+        step_hint=state.get("message") or "",
+    )
+
+
+def _load_state(task_id: int) -> Optional[dict]:
+    db = SessionLocal()
+    try:
+        task = db.query(Task).filter(Task.id == task_id).first()
+        return progress_bus.task_fields(task) if task else None
+    finally:
+        db.close()
+
+
+async def event_generator(task_id: int, initial: dict):
+    """SSE events for task progress, woken by the progress bus (no database polling)."""
+    bus = progress_bus.get_bus()
+    # The database row only fills fields this process has not seen published yet.
+    bus.seed(task_id, initial)
+    seq = bus.current_seq()
+    last_sent = None
     while True:
-        # Get current task status
-        db = SessionLocal()
-        try:
-            task = db.query(Task).filter(Task.id == task_id).first()
-        finally:
-            db.close()
-        if not task:
+        state = bus.state(task_id)
+        if state is None:
+            # Removed from the bus: the task was deleted.
             yield f"event: error\ndata: {json.dumps({'message': 'Task not found'})}\n\n"
             break
-        
-        # Check if task is completed or error
-        if task.status in ['completed', 'error']:
-            # Send final update
-            data = {
-                "id": task.id,
-                "status": task.status,
-                "stage": task.stage,
-                "progress": task.progress,
-                "message": task.message,
-                "stats": task.stats,
-                "progress_detail": _stage_meta(task).model_dump(),
-                "export_ready": bool(task.export_path)
-            }
+        data = {
+            "id": task_id,
+            "status": state.get("status"),
+            "stage": state.get("stage"),
+            "progress": state.get("progress"),
+            "message": state.get("message"),
+            "stats": state.get("stats"),
+            "progress_detail": _stage_meta(state).model_dump(),
+            "export_ready": bool(state.get("export_ready")),
+        }
+        if data != last_sent:
             yield f"data: {json.dumps(data)}\n\n"
-            # Send completion event
-            yield f"event: done\ndata: {json.dumps({'id': task.id, 'status': task.status})}\n\n"
+            last_sent = data
+        if state.get("status") in (TaskStatus.COMPLETED, TaskStatus.ERROR):
+            yield f"event: done\ndata: {json.dumps({'id': task_id, 'status': state.get('status')})}\n\n"
             break
-        
-        # Check if any field has changed
-        if (
-            task.progress != last_progress or 
-            task.stage != last_stage or 
-            task.message != last_message or 
-            task.status != last_status
-        ):
-            data = {
-                "id": task.id,
-                "status": task.status,
-                "stage": task.stage,
-                "progress": task.progress,
-                "message": task.message,
-                "stats": task.stats,
-                "progress_detail": _stage_meta(task).model_dump(),
-                "export_ready": bool(task.export_path)
-            }
-            yield f"data: {json.dumps(data)}\n\n"
-            
-            # Update last values
-            last_progress = task.progress
-            last_stage = task.stage
-            last_message = task.message
-            last_status = task.status
-        
-        # Wait before next check
-        await asyncio.sleep(1)
+        latest = await bus.wait(seq, settings.SSE_HEARTBEAT_SECONDS)
+        if latest == seq:
+            yield ": keepalive\n\n"
+        seq = latest
 
 
 @router.get("/tasks/{task_id}/events")
 async def get_task_events(task_id: int):
     """Get real-time task progress via SSE"""
-    # Check if task exists
+    initial = await run_in_threadpool(_load_state, task_id)
+    if initial is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    return StreamingResponse(
+        event_generator(task_id, initial),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Changes to these fields also resend progress_detail on the multiplexed stream.
+_DETAIL_FIELDS = {"status", "stage", "progress", "message"}
+
+
+def _parse_task_ids(tasks: Optional[str]) -> Optional[Set[int]]:
+    if not tasks:
+        return None
+    try:
+        return {int(part) for part in tasks.split(",") if part.strip()}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="tasks must be comma-separated task ids")
+
+
+def _parse_event_id(value: Optional[str]) -> Optional[int]:
+    """Bus sequence of a Last-Event-ID from this process; None for other processes/restarts."""
+    boot, _, seq = (value or "").partition("-")
+    if boot != BOOT_ID or not seq.isdigit():
+        return None
+    return int(seq)
+
+
+def _load_states(task_ids: Optional[Set[int]]) -> List[Tuple[int, dict]]:
     db = SessionLocal()
     try:
-        task = db.query(Task).filter(Task.id == task_id).first()
+        query = db.query(Task)
+        if task_ids is not None:
+            query = query.filter(Task.id.in_(task_ids))
+        return [(task.id, progress_bus.task_fields(task)) for task in query.order_by(Task.id.desc())]
     finally:
         db.close()
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
+
+
+def _with_detail(state: dict, fields: dict) -> dict:
+    entry = {"id": state["id"], **fields}
+    if _DETAIL_FIELDS & fields.keys():
+        entry["progress_detail"] = _stage_meta(state).model_dump()
+    return entry
+
+
+def _frame(event: str, seq: int, data: dict) -> str:
+    return f"id: {BOOT_ID}-{seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def multiplexed_generator(task_ids: Optional[Set[int]], last_seq: Optional[int]):
+    """One stream for many tasks: a snapshot (or a replay after Last-Event-ID), then batched deltas."""
+    bus = progress_bus.get_bus()
+    yield "retry: 3000\n\n"
+    last_write = time.monotonic()
+    events = None
+    if last_seq is not None:
+        seq, events = bus.since(last_seq)
+    while True:
+        if events is None:
+            # No usable resume point: send the full state. Read the sequence first so
+            # anything published while the rows load is delivered again as a delta.
+            seq = bus.current_seq()
+            rows = await run_in_threadpool(_load_states, task_ids)
+            tasks = []
+            for task_id, fields in rows:
+                bus.seed(task_id, fields)
+                state = bus.state(task_id)
+                if state is not None:
+                    tasks.append(_with_detail(state, {key: value for key, value in state.items() if key != "id"}))
+            yield _frame("snapshot", seq, {"tasks": tasks})
+            last_write = time.monotonic()
+        elif events:
+            # Coalesce the batch: one entry per task with the latest value of each changed field.
+            merged: Dict[int, dict] = {}
+            for _, task_id, delta in events:
+                if task_ids is not None and task_id not in task_ids:
+                    continue
+                entry = merged.get(task_id)
+                if delta.get("deleted") or entry is None or entry.get("deleted"):
+                    # A deletion replaces earlier changes; a later event starts the task afresh.
+                    entry = merged[task_id] = {}
+                entry.update(delta)
+            tasks = []
+            for task_id, fields in merged.items():
+                state = bus.state(task_id)
+                if fields.get("deleted") or state is None:
+                    tasks.append({"id": task_id, "deleted": True})
+                else:
+                    tasks.append(_with_detail(state, fields))
+            if tasks:
+                yield _frame("update", seq, {"tasks": tasks})
+                last_write = time.monotonic()
+        await bus.wait(seq, settings.SSE_HEARTBEAT_SECONDS)
+        # Events of unsubscribed tasks also wake the stream, so time the keep-alive separately.
+        if time.monotonic() - last_write >= settings.SSE_HEARTBEAT_SECONDS:
+            yield ": keepalive\n\n"
+            last_write = time.monotonic()
+        seq, events = bus.since(seq)
+
+
+@router.get("/events")
+async def get_events(
+    tasks: Optional[str] = Query(None, description="Comma-separated task ids; all tasks when omitted"),
+    last_event_id: Optional[str] = Query(None, description="Resume point when the Last-Event-ID header cannot be sent"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    """Progress of many tasks over one SSE connection (snapshot, then field deltas)."""
+    task_ids = _parse_task_ids(tasks)
+    last_seq = _parse_event_id(last_event_id_header or last_event_id)
     return StreamingResponse(
-        event_generator(task_id),
-        media_type="text/event-stream"
+        multiplexed_generator(task_ids, last_seq),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends
 from sqlalchemy.orm import Session
 from app.core.config import settings
 from app.db.database import get_db
+from app.services import job_queue, model_router, rate_limiter
 
 router = APIRouter()
 
@@ -25,3 +26,32 @@ async def get_models(db: Session = Depends(get_db)):
         "default_focus_model": settings.FOCUS_MODEL,
         "default_tag_model": settings.TAG_MODEL
     }
+
+
+def _worker_field(key: str) -> dict:
+    """Queue mode: the same state as reported by each worker process."""
+    if not job_queue.queue_mode():
+        return {}
+    return {"workers": [{"worker_id": w["worker_id"], "heartbeat_at": w["heartbeat_at"], key: w.get(key)} for w in job_queue.live_workers()]}
+
+
+@router.get("/models/health", tags=["models"])
+async def get_models_health():
+    """模型路由健康状态：成功率、错误类型、延迟EWMA与熔断状态（按进程统计，队列模式下附各工作进程）"""
+    return {
+        "enabled": settings.MODEL_ROUTER_ENABLED,
+        "scope": "api_process",
+        "models": model_router.snapshot(),
+        **_worker_field("models"),
+    }
+
+
+@router.get("/models/limits", tags=["models"])
+async def get_models_limits():
+    """限流状态：每个 (base_url, 模型) 的额度、排队深度与等待时间（按进程统计，队列模式下附各工作进程）"""
+    return {
+        "enabled": settings.MODEL_RATE_LIMIT_ENABLED,
+        "scope": "api_process",
+        "buckets": rate_limiter.snapshot(),
+        **_worker_field("limits"),
+    }
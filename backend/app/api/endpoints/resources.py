@@ -0,0 +1,60 @@
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+
+from app.core.config import settings
+from app.services import job_queue, memory_budget, resource_pools, scheduler
+
+router = APIRouter()
+
+
+class ResourceLimitsPayload(BaseModel):
+    stage_slots: Optional[int] = None
+    workers: Optional[int] = None
+
+
+def _status() -> dict:
+    status = {
+        "worker_mode": settings.WORKER_MODE,
+        # Everything below describes this API process only.
+        "scope": "api_process",
+        "stages": scheduler.resources(),
+        "pools": resource_pools.snapshot(),
+        "memory": memory_budget.snapshot(),
+    }
+    if job_queue.queue_mode():
+        status["pool_limits"] = job_queue.pool_limits()
+        status["workers"] = [
+            {key: worker.get(key) for key in ("worker_id", "pid", "heartbeat_at", "pools", "memory")}
+            for worker in job_queue.live_workers()
+        ]
+    return status
+
+
+@router.get("/resources", tags=["resources"])
+async def get_resources():
+    """各资源类别（cpu/net/disk）的阶段槽位与子任务线程池：上限、占用、排队与利用率，以及解码内存预算（本 API 进程；队列模式下另附各工作进程上报的状态）"""
+    return _status()
+
+
+@router.put("/resources/{name}", tags=["resources"])
+async def update_resource_limits(name: str, payload: ResourceLimitsPayload):
+    """运行时调整资源类别的阶段槽位数或线程池上限，无需重启（队列模式下线程池上限同时转发给工作进程）"""
+    if name not in scheduler.RESOURCES:
+        raise HTTPException(status_code=404, detail=f"Unknown resource class: {name}")
+    if payload.stage_slots is None and payload.workers is None:
+        raise HTTPException(status_code=400, detail="stage_slots or workers is required")
+    for value in (payload.stage_slots, payload.workers):
+        if value is not None and value < 1:
+            raise HTTPException(status_code=400, detail="Limits must be at least 1")
+    if payload.workers is not None and name not in resource_pools.POOL_NAMES:
+        raise HTTPException(status_code=400, detail=f"Resource class {name} has no worker pool")
+    if payload.stage_slots is not None:
+        scheduler.resize(name, payload.stage_slots)
+    if payload.workers is not None:
+        resource_pools.resize(name, payload.workers)
+        if job_queue.queue_mode():
+            # Workers split the total between them on their next status report.
+            job_queue.set_pool_limit(name, payload.workers)
+    return _status()
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Dict, Optional
 import json
 from pathlib import Path
 
@@ -35,12 +35,97 @@ class Settings(BaseSettings):
 
     # Processing configuration
     MAX_UPLOAD_MB: int = 2048
-    MAX_PARALLEL_TASKS: int = 5
+    MAX_PARALLEL_TASKS: int = 5  # superseded by *_STAGE_SLOTS
+    # Scheduler configuration
+    CPU_STAGE_SLOTS: int = 2
+    NET_STAGE_SLOTS: int = 5
+    DISK_STAGE_SLOTS: int = 1
+    CPU_POOL_WORKERS: int = 4
+    DISK_POOL_WORKERS: int = 4
+    SCHEDULER_FAST_LANE_SLOTS: int = 1
+    SCHEDULER_QUANTUM: float = 30.0
+    SCHEDULER_DEFAULT_JOB_SECONDS: float = 120.0
     PHASH_THRESHOLD: int = 6
     KEEP_PER_CLUSTER: int = 2
     PREVIEW_MAX_SIDE: int = 1280
     PREVIEW_JPEG_QUALITY: int = 86
+    PREVIEW_WORKERS: int = 0  # 0 = one per CPU core
+    PYRAMID_ENABLED: bool = True
     MAX_IMAGE_PIXELS: int = 1000000000
+    LAZY_ZIP_SOURCE: bool = True
+    ZIP_READ_WORKERS: int = 4
+    MEMORY_BUDGET_MB: int = 2048  # 0 = unlimited
+    MEMORY_MAX_IMAGE_MB: int = 256
+
+    # Model response cache configuration
+    MODEL_CACHE_ENABLED: bool = True
+    MODEL_CACHE_PATH: str = "./data/model_cache.sqlite3"
+    MODEL_CACHE_MAX_MB: int = 256
+
+    # Model image payload configuration
+    MODEL_IMAGE_MAX_SIDE: int = 1024
+    MODEL_IMAGE_MAX_KB: int = 400
+    MODEL_IMAGE_BUDGETS: Dict[str, Dict[str, int]] = {}  # per model name
+
+    # Progress push configuration
+    PROGRESS_CHECKPOINT_SECONDS: float = 5.0
+    SSE_HEARTBEAT_SECONDS: float = 15.0
+
+    # Dedup feature extraction configuration
+    FEATURE_CHUNK_SIZE: int = 16
+
+    # Focus batch configuration
+    FOCUS_BATCH_SIZE: int = 1  # 1 = one image per call
+    FOCUS_BATCH_SIZES: Dict[str, int] = {}  # per model name
+
+    # Crop planner configuration
+    CROP_PLANNER_MODE: str = "model"  # model / local / auto
+    LOCAL_CROP_MIN_CONFIDENCE: float = 0.6
+
+    # Model router configuration
+    MODEL_ROUTER_ENABLED: bool = True
+    MODEL_ROUTER_MIN_SUCCESS_RATE: float = 0.5
+    MODEL_ROUTER_EWMA_ALPHA: float = 0.2
+    MODEL_BREAKER_FAILURES: int = 3
+    MODEL_BREAKER_COOLDOWN: float = 60.0
+
+    # Model rate limit configuration
+    MODEL_RATE_LIMIT_ENABLED: bool = True
+    MODEL_RATE_LIMIT_RPM: int = 0  # 0 = unlimited
+    MODEL_RATE_LIMIT_TPM: int = 0  # 0 = unlimited
+    MODEL_RATE_LIMITS: Dict[str, Dict[str, int]] = {}  # per model name
+    MODEL_429_MAX_RETRIES: int = 5
+    MODEL_429_BACKOFF_BASE: float = 1.0
+    MODEL_429_BACKOFF_MAX: float = 60.0
+
+    # Model hedge configuration
+    MODEL_HEDGE_ENABLED: bool = True
+    MODEL_HEDGE_PERCENTILE: float = 95.0
+    MODEL_HEDGE_MIN_SAMPLES: int = 20
+    MODEL_HEDGE_DEFAULT_DELAY: float = 20.0
+    MODEL_HEDGE_MIN_DELAY: float = 2.0
+    MODEL_HEDGE_MAX_OUTSTANDING: int = 4
+
+    # Shared HTTP connection pool for model calls (per base_url + api_key).
+    MODEL_HTTP_POOL_SIZE: int = 32
+    MODEL_HTTP_KEEPALIVE: int = 16
+    MODEL_HTTP_KEEPALIVE_EXPIRY: float = 60.0
+    MODEL_HTTP_TIMEOUT: float = 30.0
+    MODEL_HTTP2: bool = True
+
+    # Export configuration
+    EXPORT_WRITE_PACKAGE: bool = False  # also keep train_package.zip on disk
+
+    # Recrop configuration
+    RECROP_PROXY_CACHE_MB: int = 256
+    RECROP_RENDER_WORKERS: int = 2
+
+    # Worker configuration
+    WORKER_MODE: str = "inline"  # inline / queue (python -m app.worker)
+    WORKER_PROCESSES: int = 2
+    JOB_POLL_INTERVAL: float = 1.0
+    JOB_HEARTBEAT_INTERVAL: float = 5.0
+    JOB_HEARTBEAT_TIMEOUT: float = 60.0
 
     # Celery configuration
     CELERY_BROKER_URL: str
@@ -3,6 +3,10 @@ from sqlalchemy.orm import sessionmaker, Session
 from app.core.config import settings
 from app.models.task import Base
 from app.models.app_setting import AppSetting  # noqa: F401
+from app.models.job import Job, WorkerStatus  # noqa: F401
+from app.db import versioning  # noqa: F401  (registers task version tracking)
+from app.services import image_summary  # noqa: F401  (keeps image summary columns in sync)
+from app.db.migrations import run_migrations
 
 # Create database engine
 connect_args = {}
@@ -12,6 +16,7 @@ engine = create_engine(settings.DATABASE_URL, connect_args=connect_args)
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
+run_migrations(engine)
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
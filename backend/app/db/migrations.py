@@ -0,0 +1,75 @@
+"""Additive schema changes for existing SQLite databases.
+
+``create_all`` only creates missing tables; columns and indexes added to
+existing tables later are listed here and added when absent.
+"""
+import logging
+import os
+from typing import Callable, List, Optional, Tuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from app.services import image_summary
+
+logger = logging.getLogger(__name__)
+
+Backfill = Union[str, Callable[[Connection], None]]
+
+
+def _backfill_export_ready(conn: Connection) -> None:
+    """Mark tasks whose export file still exists; listings stop checking the filesystem after this."""
+    rows = conn.execute(text("SELECT id, export_path FROM tasks WHERE export_path IS NOT NULL")).fetchall()
+    ready = [{"id": task_id} for task_id, path in rows if path and os.path.exists(path)]
+    if ready:
+        conn.execute(text("UPDATE tasks SET export_ready = 1 WHERE id = :id"), ready)
+
+# (table, column, column definition, backfill run once after its columns are added),
+# in the order they were introduced. A backfill shared by several columns runs once.
+_COLUMNS: List[Tuple[str, str, str, Optional[Backfill]]] = [
+    ("tasks", "version", "INTEGER NOT NULL DEFAULT 0", None),
+    ("images", "caption", "TEXT", "UPDATE images SET caption = json_extract(meta_json, '$.caption')"),
+    ("images", "cluster_id", "INTEGER", image_summary.backfill),
+    ("images", "shot_type", "VARCHAR", image_summary.backfill),
+    ("images", "has_face", "BOOLEAN", image_summary.backfill),
+    ("images", "face_conf", "FLOAT", image_summary.backfill),
+    ("images", "has_pose", "BOOLEAN", image_summary.backfill),
+    ("images", "pose_conf", "FLOAT", image_summary.backfill),
+    ("images", "subject_area_ratio", "FLOAT", image_summary.backfill),
+    ("images", "focus_confidence", "FLOAT", image_summary.backfill),
+    ("images", "crop_square_model", "JSON", image_summary.backfill),
+    ("images", "crop_square_user", "JSON", image_summary.backfill),
+    ("tasks", "export_ready", "BOOLEAN NOT NULL DEFAULT 0", _backfill_export_ready),
+]
+
+# (index name, table, columns), matching the model's __table_args__.
+_INDEXES: List[Tuple[str, str, Tuple[str, ...]]] = [
+    ("ix_images_task_selected", "images", ("task_id", "selected")),
+    ("ix_images_task_cluster", "images", ("task_id", "cluster_id")),
+    ("ix_images_task_shot_type", "images", ("task_id", "shot_type")),
+]
+
+
+def run_migrations(engine: Engine) -> None:
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        existing = {}
+        backfills: List[Backfill] = []
+        for table, column, ddl, backfill in _COLUMNS:
+            if table not in existing:
+                existing[table] = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+            if column in existing[table]:
+                continue
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            if backfill and backfill not in backfills:
+                backfills.append(backfill)
+            existing[table].add(column)
+            logger.info(f"数据库迁移: {table} 新增列 {column}")
+        for backfill in backfills:
+            if callable(backfill):
+                backfill(conn)
+            else:
+                conn.execute(text(backfill))
+        for name, table, columns in _INDEXES:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
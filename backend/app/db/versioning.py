@@ -0,0 +1,91 @@
+"""Change tracking behind the conditional GETs of task listings.
+
+Every flush that changes a task, or adds, changes or removes one of its
+images, bumps that task's ``version`` in the same transaction. Each process
+also counts commits of such changes in ``generation()``, so the API can
+answer an unchanged poll without a query while it is the only writer.
+"""
+import itertools
+import threading
+import uuid
+
+from sqlalchemy import event, func, update
+from sqlalchemy.orm import Session
+
+from app.models.image import Image
+from app.models.task import Task
+
+# Distinguishes generations of different processes (and restarts).
+BOOT_ID = uuid.uuid4().hex[:8]
+
+_CHANGED = "tasks_changed"
+_LOCK = threading.Lock()
+_GENERATION = 0
+
+
+def generation() -> int:
+    with _LOCK:
+        return _GENERATION
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_versions(session, flush_context, instances) -> None:
+    touched = set()
+    bumped = set()
+    changed = False
+    dirty = list(session.dirty)
+    for obj in dirty:
+        # session.dirty also lists objects whose attributes were set to equal values.
+        if not session.is_modified(obj, include_collections=False):
+            continue
+        if isinstance(obj, Task):
+            # Evaluated by the UPDATE itself, so concurrent writers never reuse a version.
+            obj.version = Task.version + 1
+            bumped.add(obj.id)
+            changed = True
+        elif isinstance(obj, Image):
+            touched.add(obj.task_id)
+            changed = True
+    for obj in itertools.chain(session.new, session.deleted):
+        if isinstance(obj, (Task, Image)):
+            changed = True
+            if isinstance(obj, Image):
+                touched.add(obj.task_id)
+    touched -= bumped
+    touched.discard(None)
+    if touched:
+        session.execute(
+            update(Task)
+            .where(Task.id.in_(touched))
+            .values(version=Task.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+    if changed:
+        session.info[_CHANGED] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_bulk(state) -> None:
+    # Bulk query.update()/delete() bypass the flush.
+    if (state.is_update or state.is_delete) and state.bind_mapper is not None:
+        if state.bind_mapper.class_ in (Task, Image):
+            state.session.info[_CHANGED] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session) -> None:
+    global _GENERATION
+    if session.info.pop(_CHANGED, False):
+        with _LOCK:
+            _GENERATION += 1
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session) -> None:
+    session.info.pop(_CHANGED, None)
+
+
+def db_signature(db: Session) -> str:
+    """Aggregate that changes with any task insert, delete or version bump (for other writers)."""
+    count, max_id, total = db.query(func.count(Task.id), func.max(Task.id), func.sum(Task.version)).one()
+    return f"{count}.{max_id or 0}.{total or 0}"
@@ -1,12 +1,14 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Request, Query
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, defer
 import os
 import shutil
 import threading
 import json
 from pathlib import Path
+from urllib.parse import quote
 import sys
 from typing import List, Optional, Dict, Union, Set
 from pydantic import BaseModel
@@ -18,13 +20,20 @@ from app.models.log import Log, LogLevel
 from app.schemas.task import TaskResponse, TaskBatchResponse, ProgressInfo
 from app.tasks import processing
 from app.api.endpoints import events
+from app.db import versioning
 from app.db.database import get_db, SessionLocal
 from app.core.defaults import DEFAULT_DEDUP_PARAMS
 from app.services.app_settings import get_app_settings as load_app_settings, update_app_settings
+from app.services.export_package import IncrementalExportBuilder, build_export_plan, parse_range_header
+from app.services.image_source import close_sources, ensure_local_path, open_image_file
+from app.services.preview_pool import shutdown_preview_pool
+from app.services.pyramid import PYRAMID_LEVELS, smallest_level
+from app.services import crop_planner, hedging, http_pool, job_queue, progress_bus, recrop, scheduler
 from sqlalchemy.exc import OperationalError
 import time
 import hashlib
 import re
+import uuid
 
 # FastAPI app
 app = FastAPI(title=settings.APP_NAME, version=settings.APP_VERSION)
@@ -36,6 +45,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 # Create data directories
@@ -52,6 +62,10 @@ app.include_router(events.router, prefix="/api", tags=["events"])
 from app.api.endpoints.models import router as models_router
 app.include_router(models_router, prefix="/api", tags=["models"])
 
+# Include resource class routes
+from app.api.endpoints.resources import router as resources_router
+app.include_router(resources_router, prefix="/api", tags=["resources"])
+
 
 def _load_ports_config() -> Dict[str, int | str]:
     ports_path = Path(__file__).resolve().parents[2] / "config" / "ports.json"
@@ -155,6 +169,22 @@ def _validate_backend_port() -> None:
     if actual is not None and actual != expected:
         raise RuntimeError(f"Backend port must be {expected} (config/ports.json), got {actual}")
 
+@app.on_event("startup")
+def _resume_interrupted_tasks() -> None:
+    processing.resume_interrupted_tasks()
+
+
+@app.on_event("shutdown")
+def _shutdown_preview_pool() -> None:
+    shutdown_preview_pool()
+
+
+@app.on_event("shutdown")
+def _close_http_pool() -> None:
+    hedging.shutdown()
+    http_pool.close_all()
+
+
 class SelectionPayload(BaseModel):
     image_ids: List[int]
     selected: bool
@@ -169,6 +199,11 @@ class CropUpdatePayload(BaseModel):
     source: str = "user"
 
 
+class PriorityPayload(BaseModel):
+    priority: Optional[int] = None
+    weight: Optional[float] = None
+
+
 class DedupParamsPayload(BaseModel):
     face_sim_th1: Optional[float] = DEFAULT_DEDUP_PARAMS["face_sim_th1"]
     face_sim_th2: Optional[float] = DEFAULT_DEDUP_PARAMS["face_sim_th2"]
@@ -205,9 +240,31 @@ def _get_task_or_404(db: Session, task_id: int) -> Task:
     return task
 
 
+def _update_task_config(task: Task, **values) -> None:
+    # Reassign so SQLAlchemy notices the change on the plain JSON column.
+    config = dict(task.config or {})
+    config.update(values)
+    task.config = config
+
+
+def _validate_planner(planner: Optional[str]) -> Optional[str]:
+    if planner is not None and planner not in crop_planner.PLANNER_MODES:
+        raise HTTPException(status_code=400, detail=f"planner must be one of {', '.join(crop_planner.PLANNER_MODES)}")
+    return planner
+
+
+def _queue_info(task: Task) -> Optional[Dict]:
+    """Scheduler state of the task's stage job: running, queued/preempted with position and ETA."""
+    if job_queue.queue_mode():
+        return job_queue.queue_info(task.id)
+    return scheduler.queue_info(task.id)
+
+
 def _assert_idle(task: Task):
     if task.status == TaskStatus.PROCESSING:
         raise HTTPException(status_code=400, detail="Task is already processing")
+    if job_queue.queue_mode() and job_queue.active_job(task.id):
+        raise HTTPException(status_code=400, detail="Task is already queued")
 
 
 def _add_log(db: Session, message: str, level: LogLevel = LogLevel.INFO, task_id: Optional[int] = None):
@@ -218,6 +275,9 @@ def _add_log(db: Session, message: str, level: LogLevel = LogLevel.INFO, task_id
 
 def _delete_task_dirs(task_dirs: List[str], attempts: int = 6, delay: float = 0.5) -> None:
     remaining = [path for path in task_dirs if path]
+    for path in remaining:
+        # Zip-backed image sources keep the upload open; release it before deleting.
+        close_sources(path)
     for _ in range(attempts):
         if not remaining:
             return
@@ -257,6 +317,7 @@ def _force_clear_db() -> None:
                 db.query(Log).delete(synchronize_session=False)
                 db.query(Task).delete(synchronize_session=False)
                 db.commit()
+                progress_bus.removed()
                 return
             except OperationalError as exc:
                 db.rollback()
@@ -290,6 +351,7 @@ def _force_delete_task(task_id: int) -> None:
                 db.query(Log).filter(Log.task_id == task_id).delete(synchronize_session=False)
                 db.query(Task).filter(Task.id == task_id).delete(synchronize_session=False)
                 db.commit()
+                progress_bus.removed([task_id])
                 break
             except OperationalError as exc:
                 db.rollback()
@@ -315,77 +377,65 @@ def _reset_task_data(task: Task, db: Session):
     db.commit()
     # remove generated dirs (keep upload/unpack)
     base = f"./data/tasks/{task.id}"
-    for sub in ["previews", "crops", "export", "crops/images", "crops/txt"]:
+    for sub in ["previews", "crops", "export", "crops/images", "crops/txt", "proxies", "pyramid"]:
         path = os.path.join(base, sub)
         shutil.rmtree(path, ignore_errors=True)
+    task.export_path = None
+    task.export_ready = False
     # recreate base dirs needed
     os.makedirs(os.path.join(base, "previews"), exist_ok=True)
     os.makedirs(os.path.join(base, "crops", "images"), exist_ok=True)
     os.makedirs(os.path.join(base, "crops", "txt"), exist_ok=True)
     os.makedirs(os.path.join(base, "export"), exist_ok=True)
 
-def _image_summary(img: Image, task_id: int) -> Dict:
-    meta = img.meta_json or {}
-    crop_meta = meta.get("focus", {}) if isinstance(meta, dict) else {}
-    crop_square_user = meta.get("crop_square_user") if isinstance(meta, dict) else None
-    crop_square_model = meta.get("crop_square_model") if isinstance(meta, dict) else None
-    dedup_meta = meta.get("dedup", {}) if isinstance(meta, dict) else {}
+def _thumb_url(task_id: int, img: Image) -> Optional[str]:
+    # Levels are recorded once written and only removed with the image rows, so skip the stat.
+    path, level = smallest_level(img, min_long=PYRAMID_LEVELS[0], verify=False)
+    if level is not None:
+        return f"/static/{task_id}/pyramid/{os.path.basename(path)}"
+    return f"/static/{task_id}/previews/{os.path.basename(img.preview_path)}" if img.preview_path else None
 
-    # Get subject ratio with enhanced fallback logic
-    subject_ratio = meta.get("subject_area_ratio")
-    
-    # Fallback 1: Use focus bbox if available
-    if subject_ratio is None and crop_meta.get("bbox"):
-        bbox = crop_meta["bbox"]
-        subject_ratio = max(0.0, min(1.0, (bbox.get("x2", 0) - bbox.get("x1", 0)) * (bbox.get("y2", 0) - bbox.get("y1", 0))))
-    
-    # Fallback 2: Use crop square if available
-    if subject_ratio is None and crop_square_model:
-        side = crop_square_model.get("side")
-        if side:
-            subject_ratio = max(0.0, min(1.0, float(side) * float(side)))
-    
-    # Ensure image dimensions are valid
-    width = img.width if img.width is not None and img.width > 0 else 1024
-    height = img.height if img.height is not None and img.height > 0 else 1024
-
-    # Get face and pose info with proper defaults
-    has_face = meta.get("has_face")
-    if has_face is None:
-        has_face = bool(dedup_meta.get("face_emb") or crop_meta.get("bbox"))
-    
-    face_conf = meta.get("face_conf") or crop_meta.get("confidence") or 0.0
-    
-    has_pose = meta.get("has_pose")
-    if has_pose is None:
-        has_pose = False
 
-    pose_conf = meta.get("pose_conf") or 0.0
+def _crop_url(task_id: int, img: Image) -> Optional[str]:
+    if not img.crop_path:
+        return None
+    url = f"/static/{task_id}/crops/images/{os.path.basename(img.crop_path)}"
+    version = recrop.crop_url_version(img)
+    return f"{url}?v={version}" if version is not None else url
+
 
+def _image_summary(img: Image, task_id: int, with_meta: bool = True) -> Dict:
+    """Listing entry from the image columns; ``with_meta=False`` skips the fields that need meta_json."""
     summary = {
         "id": img.id,
         "orig_name": img.orig_name,
-        "width": width,
-        "height": height,
+        "width": img.width if img.width is not None and img.width > 0 else 1024,
+        "height": img.height if img.height is not None and img.height > 0 else 1024,
         "md5": img.md5,
         "preview_url": f"/static/{task_id}/previews/{os.path.basename(img.preview_path)}" if img.preview_path else None,
-        "crop_url": f"/static/{task_id}/crops/images/{os.path.basename(img.crop_path)}" if img.crop_path else None,
         "keep": img.selected,
         "sharpness": img.sharpness if img.sharpness is not None and img.sharpness > 0 else 0.0,
-        "subject_area_ratio": subject_ratio,
-        "has_face": has_face,
-        "face_conf": face_conf,
-        "has_pose": has_pose,
-        "pose_conf": pose_conf,
-        "cluster_id": dedup_meta.get("cluster_id"),
-        "shot_type": meta.get("focus", {}).get("shot_type") if meta.get("focus") else None,
-        "confidence": meta.get("focus", {}).get("confidence") if meta.get("focus") else None,
-        "reason": meta.get("focus", {}).get("reason") if meta.get("focus") else None,
-        "quality": meta.get("quality"),
-        "decision": meta.get("decision") if isinstance(meta, dict) else None,
-        "crop_square_model": crop_square_model,
-        "crop_square_user": crop_square_user,
+        "subject_area_ratio": img.subject_area_ratio,
+        "has_face": bool(img.has_face),
+        "face_conf": img.face_conf or 0.0,
+        "has_pose": bool(img.has_pose),
+        "pose_conf": img.pose_conf or 0.0,
+        "cluster_id": img.cluster_id,
+        "shot_type": img.shot_type,
+        "confidence": img.focus_confidence,
+        "crop_square_model": img.crop_square_model,
+        "crop_square_user": img.crop_square_user,
     }
+    if with_meta:
+        meta = img.meta_json or {}
+        focus = meta.get("focus") or {}
+        summary.update(
+            crop_url=_crop_url(task_id, img),
+            thumb_url=_thumb_url(task_id, img),
+            reason=focus.get("reason"),
+            quality=meta.get("quality"),
+            decision=meta.get("decision"),
+        )
     return summary
 
 
@@ -436,6 +486,10 @@ async def create_task(
     tag_model: Optional[str] = Form(settings.TAG_MODEL),
     api_key: Optional[str] = Form(None),
     base_url: Optional[str] = Form(None),
+    bypass_model_cache: bool = Form(False),
+    crop_planner: Optional[str] = Form(None),
+    priority: int = Form(0),
+    owner: Optional[str] = Form(None),
     request: Request = None,
     db: Session = Depends(get_db)
 ):
@@ -461,6 +515,10 @@ async def create_task(
         config={
             "base_url_source": "custom" if use_custom else "default",
             "model_priority": header_models,
+            "bypass_model_cache": bypass_model_cache,
+            "crop_planner": _validate_planner(crop_planner),
+            "priority": priority,
+            "owner": owner,
         },
     )
     db.add(task)
@@ -503,10 +561,9 @@ async def create_task(
     db.commit()
 
     # Start initial prepare step only
-    processing.submit_task(processing.prepare_task, task.id)
+    processing.submit_job("prepare", task.id)
 
     task.progress_detail = _stage_meta(task)
-    task.export_ready = False
     return task
 
 
@@ -518,6 +575,10 @@ async def create_folder_task(
     tag_model: Optional[str] = Form(settings.TAG_MODEL),
     api_key: Optional[str] = Form(None),
     base_url: Optional[str] = Form(None),
+    bypass_model_cache: bool = Form(False),
+    crop_planner: Optional[str] = Form(None),
+    priority: int = Form(0),
+    owner: Optional[str] = Form(None),
     request: Request = None,
     db: Session = Depends(get_db)
 ):
@@ -547,6 +608,10 @@ async def create_folder_task(
             "base_url_source": "custom" if use_custom else "default",
             "model_priority": header_models,
             "input_type": "folder",
+            "bypass_model_cache": bypass_model_cache,
+            "crop_planner": _validate_planner(crop_planner),
+            "priority": priority,
+            "owner": owner,
         },
     )
     db.add(task)
@@ -607,10 +672,9 @@ async def create_folder_task(
     task.message = "Upload completed, preparing files..."
     db.commit()
 
-    processing.submit_task(processing.prepare_task, task.id)
+    processing.submit_job("prepare", task.id)
 
     task.progress_detail = _stage_meta(task)
-    task.export_ready = False
     return task
 
 
@@ -621,6 +685,10 @@ async def create_batch_tasks(
     tag_model: Optional[str] = Form(settings.TAG_MODEL),
     api_key: Optional[str] = Form(None),
     base_url: Optional[str] = Form(None),
+    bypass_model_cache: bool = Form(False),
+    crop_planner: Optional[str] = Form(None),
+    priority: int = Form(0),
+    owner: Optional[str] = Form(None),
     request: Request = None,
     db: Session = Depends(get_db)
 ):
@@ -634,6 +702,8 @@ async def create_batch_tasks(
     if header_key:
         api_key = header_key
 
+    # All zips of one upload share a fair-share owner, so a large batch competes as one party.
+    batch_owner = owner or f"batch-{uuid.uuid4().hex[:12]}"
     results = []
     for file in files:
         # Create task
@@ -647,6 +717,10 @@ async def create_batch_tasks(
             config={
                 "base_url_source": "custom" if use_custom else "default",
                 "model_priority": header_models,
+                "bypass_model_cache": bypass_model_cache,
+                "crop_planner": _validate_planner(crop_planner),
+                "priority": priority,
+                "owner": batch_owner,
             },
         )
         db.add(task)
@@ -690,42 +764,99 @@ async def create_batch_tasks(
         db.commit()
 
         # Kick off prepare step
-        processing.submit_task(processing.prepare_task, task.id)
+        processing.submit_job("prepare", task.id)
 
         results.append({"id": task.id, "zip_name": file.filename})
 
     return results
 
 
+def _tasks_etag(request: Request, db: Session) -> str:
+    """Weak ETag for task reads: changes with any task/image version, queue state or query string."""
+    if job_queue.queue_mode():
+        # Workers commit from other processes, so read cheap aggregates instead of in-process counters.
+        state = f"{versioning.db_signature(db)}-{job_queue.change_signature(db)}"
+    else:
+        state = f"{versioning.BOOT_ID}-{versioning.generation()}-{scheduler.generation()}"
+    digest = hashlib.sha1(f"{state}|{request.url.path}?{request.url.query}".encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def _not_modified(request: Request, etag: str) -> Optional[Response]:
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+
+def _decorate_task(task: Task) -> None:
+    task.progress_detail = _stage_meta(task)
+    task.queue = _queue_info(task)
+    if task.config is None:
+        task.config = {}
+
+
 @app.get("/api/tasks", response_model=List[TaskResponse])
-def get_tasks(include_items: bool = Query(False), db: Session = Depends(get_db)):
-    tasks = db.query(Task).all()
+def get_tasks(
+    request: Request,
+    response: Response,
+    include_items: bool = Query(False),
+    status: Optional[List[TaskStatus]] = Query(None),
+    stage: Optional[List[TaskStage]] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[int] = Query(None, description="X-Next-Cursor of the previous page"),
+    db: Session = Depends(get_db),
+):
+    """Tasks newest first; with ``limit`` pages by id and returns the next cursor in X-Next-Cursor."""
+    etag = _tasks_etag(request, db)
+    cached = _not_modified(request, etag)
+    if cached is not None:
+        return cached
+
+    query = db.query(Task)
+    if status:
+        query = query.filter(Task.status.in_(status))
+    if stage:
+        query = query.filter(Task.stage.in_(stage))
+    if cursor is not None:
+        query = query.filter(Task.id < cursor)
+    query = query.order_by(Task.id.desc())
+    tasks = query.limit(limit + 1).all() if limit else query.all()
+    if limit and len(tasks) > limit:
+        tasks = tasks[:limit]
+        response.headers["X-Next-Cursor"] = str(tasks[-1].id)
+
+    items_by_task: Dict[int, List[Image]] = {}
+    if include_items and tasks:
+        # One query for the whole page instead of one per task.
+        for img in db.query(Image).filter(Image.task_id.in_([t.id for t in tasks])).order_by(Image.id):
+            items_by_task.setdefault(img.task_id, []).append(img)
     for task in tasks:
-        task.progress_detail = _stage_meta(task)
-        task.export_ready = bool(task.export_path and os.path.exists(task.export_path))
-        if task.config is None:
-            task.config = {}
+        _decorate_task(task)
         if include_items:
-            imgs = db.query(Image).filter(Image.task_id == task.id).all()
-            task.items = [_image_summary(img, task.id) for img in imgs]
+            task.items = [_image_summary(img, task.id) for img in items_by_task.get(task.id, [])]
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
     return tasks
 
 
 @app.get("/api/tasks/{task_id}", response_model=TaskResponse)
-def get_task(task_id: int, db: Session = Depends(get_db)):
+def get_task(task_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
+    etag = _tasks_etag(request, db)
+    cached = _not_modified(request, etag)
+    if cached is not None:
+        return cached
     task = _get_task_or_404(db, task_id)
-    task.progress_detail = _stage_meta(task)
-    task.export_ready = bool(task.export_path and os.path.exists(task.export_path))
-    if task.config is None:
-        task.config = {}
+    _decorate_task(task)
     imgs = db.query(Image).filter(Image.task_id == task_id).all()
     task.items = [_image_summary(img, task_id) for img in imgs]
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
     return task
 
 
 @app.post("/api/tasks/{task_id}/images/select")
 def update_image_selection(task_id: int, payload: SelectionPayload, db: Session = Depends(get_db)):
-    _get_task_or_404(db, task_id)
+    task = _get_task_or_404(db, task_id)
     images = db.query(Image).filter(Image.task_id == task_id, Image.id.in_(payload.image_ids)).all()
     for img in images:
         img.selected = payload.selected
@@ -733,12 +864,13 @@ def update_image_selection(task_id: int, payload: SelectionPayload, db: Session
         meta["decision"] = {"keep": payload.selected}
         img.meta_json = meta
     db.commit()
+    processing.refresh_export(task, images)
     return {"updated": len(images)}
 
 
 @app.post("/api/tasks/{task_id}/items/{item_id}/decision")
 def update_decision(task_id: int, item_id: int, payload: DecisionPayload, db: Session = Depends(get_db)):
-    _get_task_or_404(db, task_id)
+    task = _get_task_or_404(db, task_id)
     image = db.query(Image).filter(Image.task_id == task_id, Image.id == item_id).first()
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
@@ -747,43 +879,30 @@ def update_decision(task_id: int, item_id: int, payload: DecisionPayload, db: Se
     meta["decision"] = {"keep": payload.keep}
     image.meta_json = meta
     db.commit()
+    processing.refresh_export(task, [image])
     return {"id": item_id, "keep": payload.keep}
 
 
 @app.post("/api/tasks/{task_id}/items/{item_id}/crop")
 def update_crop(task_id: int, item_id: int, payload: CropUpdatePayload, db: Session = Depends(get_db)):
-    _get_task_or_404(db, task_id)
+    task = _get_task_or_404(db, task_id)
     image = db.query(Image).filter(Image.task_id == task_id, Image.id == item_id).first()
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
     if not image.orig_path:
         raise HTTPException(status_code=400, detail="Missing original image")
-    dirs = {
-        "images": os.path.join(f"./data/tasks/{task_id}", "crops", "images"),
-    }
-    os.makedirs(dirs["images"], exist_ok=True)
-    crop_square = payload.crop_square or {}
-    cx = crop_square.get("cx", 0.5)
-    cy = crop_square.get("cy", 0.5)
-    side = crop_square.get("side", 1.0)
-    # Convert side to half-size scaling
+    crop_square = dict(payload.crop_square or {})
+    crop_square["source"] = payload.source
     app_settings = load_app_settings(db)
     crop_output_size = int(app_settings.get("crop_output_size", 1024) or 1024)
-    crop_path = processing.crop_1024_from_original(
-        image.orig_path,
-        cx,
-        cy,
-        dirs["images"],
-        quality=95,
-        side=side,
-        output_size=crop_output_size,
-    )
-    meta = image.meta_json or {}
-    meta["crop_square_user"] = {"cx": cx, "cy": cy, "side": side, "source": payload.source}
-    image.meta_json = meta
-    image.crop_path = crop_path
-    db.commit()
-    return {"id": item_id, "crop_path": f"/static/{task_id}/crops/images/{os.path.basename(crop_path)}", "crop_square": meta["crop_square_user"]}
+    # Instant render from the working proxy; the full-res crop follows in the background.
+    render = recrop.apply_user_crop(db, task, image, crop_square, crop_output_size)
+    return {
+        "id": item_id,
+        "crop_path": _crop_url(task_id, image),
+        "crop_square": image.meta_json["crop_square_user"],
+        "crop_render": render,
+    }
 
 
 @app.delete("/api/tasks/{task_id}")
@@ -793,6 +912,8 @@ def delete_task(
     db: Session = Depends(get_db)
 ):
     processing.cancel_task(task_id)
+    if job_queue.queue_mode():
+        job_queue.request_cancel(task_id)
     if force:
         threading.Thread(target=_force_delete_task, args=(task_id,), daemon=True).start()
         return {"deleted": task_id, "force": True, "async": True}
@@ -831,6 +952,8 @@ def delete_all_tasks(
 ):
     if force:
         processing.cancel_all_tasks()
+        if job_queue.queue_mode():
+            job_queue.request_cancel()
         threading.Thread(target=_force_delete_all, daemon=True).start()
         return {"deleted": "all", "force": True, "async": True}
 
@@ -844,6 +967,7 @@ def delete_all_tasks(
                 db.query(Log).filter(Log.task_id.in_(ids)).delete(synchronize_session=False)
                 db.query(Task).delete()
                 db.commit()
+                progress_bus.removed(ids)
                 break
             except OperationalError as exc:
                 db.rollback()
@@ -870,38 +994,48 @@ def start_dedup(task_id: int, payload: Optional[DedupParamsPayload] = None, db:
     else:
         dedup_params = global_dedup
 
-    if task.config is None:
-        task.config = {}
     if dedup_params == global_dedup:
-        task.config.pop("dedup_params", None)
+        _update_task_config(task, dedup_params=None, pipeline="manual")
     else:
-        task.config["dedup_params"] = dedup_params
+        _update_task_config(task, dedup_params=dedup_params, pipeline="manual")
     
     # reset previous outputs for this task
     _reset_task_data(task, db)
     db.commit()
     
     # Start dedup with params
-    def _run():
-        processing.prepare_task(task_id)
-        processing.dedup_task(task_id, dedup_params=dedup_params)
-    processing.submit_task(_run, task_id=task_id)
+    processing.submit_job("prepare_dedup", task_id, dedup_params=dedup_params)
     return {"status": "started", "stage": "de_duplication", "params": dedup_params, "reset": True}
 
 
 @app.post("/api/tasks/{task_id}/crop")
-def start_crop(task_id: int, db: Session = Depends(get_db)):
+def start_crop(
+    task_id: int,
+    bypass_cache: Optional[bool] = Query(None),
+    planner: Optional[str] = Query(None),
+    db: Session = Depends(get_db),
+):
     task = _get_task_or_404(db, task_id)
     _assert_idle(task)
-    processing.submit_task(processing.crop_task, task_id)
+    _update_task_config(task, pipeline="manual")
+    if bypass_cache is not None:
+        _update_task_config(task, bypass_model_cache=bypass_cache)
+    if planner is not None:
+        _update_task_config(task, crop_planner=_validate_planner(planner))
+    db.commit()
+    processing.submit_job("crop", task_id)
     return {"status": "started", "stage": "cropping"}
 
 
 @app.post("/api/tasks/{task_id}/caption")
-def start_caption(task_id: int, db: Session = Depends(get_db)):
+def start_caption(task_id: int, bypass_cache: Optional[bool] = Query(None), db: Session = Depends(get_db)):
     task = _get_task_or_404(db, task_id)
     _assert_idle(task)
-    processing.submit_task(processing.caption_task, task_id)
+    _update_task_config(task, pipeline="manual")
+    if bypass_cache is not None:
+        _update_task_config(task, bypass_model_cache=bypass_cache)
+    db.commit()
+    processing.submit_job("caption", task_id)
     return {"status": "started", "stage": "caption"}
 
 
@@ -922,23 +1056,125 @@ def run_all(task_id: int, payload: Optional[DedupParamsPayload] = None, db: Sess
             task.config["dedup_params"] = dedup_params
         db.commit()
 
-    processing.submit_task(processing.run_full_pipeline, task_id)
+    processing.submit_job("run_all", task_id)
     return {"status": "started", "stage": "full"}
 
 
+@app.post("/api/tasks/{task_id}/resume")
+def resume_task(task_id: int, db: Session = Depends(get_db)):
+    task = _get_task_or_404(db, task_id)
+    _assert_idle(task)
+    processing.clear_cancelled(task_id)
+    processing.submit_job("resume", task_id)
+    return {"status": "started", "stage": task.stage}
+
+
+@app.post("/api/tasks/{task_id}/priority")
+def update_task_priority(task_id: int, payload: PriorityPayload, db: Session = Depends(get_db)):
+    task = _get_task_or_404(db, task_id)
+    if payload.weight is not None and payload.weight <= 0:
+        raise HTTPException(status_code=400, detail="weight must be positive")
+    values = {k: v for k, v in (("priority", payload.priority), ("weight", payload.weight)) if v is not None}
+    _update_task_config(task, **values)
+    db.commit()
+    # Takes effect for a job already queued or running, not only the next one.
+    if job_queue.queue_mode():
+        if payload.priority is not None:
+            job_queue.reprioritize(task_id, payload.priority)
+    else:
+        scheduler.reprioritize(task_id, payload.priority, payload.weight)
+    return {"id": task_id, "priority": task.config.get("priority", 0), "weight": task.config.get("weight", 1.0), "queue": _queue_info(task)}
+
+
+@app.post("/api/tasks/{task_id}/items/{item_id}/caption", status_code=202)
+def recaption_item(task_id: int, item_id: int, db: Session = Depends(get_db)):
+    task = _get_task_or_404(db, task_id)
+    _assert_idle(task)
+    image = db.query(Image).filter(Image.id == item_id, Image.task_id == task_id).first()
+    if not image:
+        raise HTTPException(status_code=404, detail="Image not found")
+    if not image.crop_path:
+        raise HTTPException(status_code=400, detail="Image has no crop yet")
+    # Fast lane (a queued job in queue mode); the outcome arrives as stats.recaption on the progress stream.
+    processing.submit_recaption(task_id, item_id)
+    return {"id": item_id, "status": "queued"}
+
+
+@app.get("/api/scheduler")
+def scheduler_status():
+    if job_queue.queue_mode():
+        return job_queue.queue_stats()
+    return scheduler.snapshot()
+
+
+@app.get("/api/tasks/{task_id}/jobs")
+def list_task_jobs(task_id: int, limit: int = Query(50, ge=1, le=500), db: Session = Depends(get_db)):
+    _get_task_or_404(db, task_id)
+    return {"mode": settings.WORKER_MODE, "jobs": job_queue.list_jobs(task_id, limit=limit)}
+
+
+@app.get("/api/jobs")
+def job_queue_status():
+    return job_queue.queue_stats()
+
+
 @app.get("/api/tasks/{task_id}/download")
-def download_task(task_id: int, db: Session = Depends(get_db)):
-    from fastapi.responses import FileResponse
-    
+def download_task(task_id: int, request: Request, db: Session = Depends(get_db)):
     task = db.query(Task).filter(Task.id == task_id).first()
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
-    
-    export_path = task.export_path or os.path.join(f"./data/tasks/{task_id}/export", "train_package.zip")
-    if not os.path.exists(export_path):
+    if not task.export_path or not os.path.exists(task.export_path):
         raise HTTPException(status_code=404, detail="Export file not found")
-    
-    return FileResponse(export_path, filename=f"{task.name}.train_package.zip")
+
+    # Never hand out a proxy-rendered recrop: full-res renders finish in the background first.
+    pending = recrop.pending_renders(task_id)
+    if pending:
+        processing.schedule_recrop_flush(task_id)
+        raise HTTPException(
+            status_code=409,
+            detail="Full-resolution recrops are still rendering",
+            # Roughly one second per full-res render.
+            headers={"Retry-After": str(min(30, max(1, len(pending))))},
+        )
+    export_dir = os.path.join(f"./data/tasks/{task_id}", "export")
+    manifest_path = os.path.join(export_dir, "manifest.json")
+    kept_images = db.query(Image).filter(
+        Image.task_id == task_id, Image.selected == True, Image.crop_path.isnot(None)  # noqa: E712
+    ).all()
+    if not os.path.exists(manifest_path):
+        IncrementalExportBuilder(export_dir).sync(task, kept_images)
+    plan = build_export_plan(kept_images, manifest_path)
+    total = plan.total_size()
+    etag = plan.etag()
+
+    filename = f"{task.name}.train_package.zip"
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}",
+    }
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    if if_range is None or if_range == etag:
+        try:
+            byte_range = parse_range_header(request.headers.get("Range"), total)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{total}"
+            raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers=headers)
+
+    if byte_range is None:
+        headers["Content-Length"] = str(total)
+        return StreamingResponse(plan.iter_range(0), media_type="application/zip", headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        plan.iter_range(start, end),
+        status_code=206,
+        media_type="application/zip",
+        headers=headers,
+    )
 
 
 @app.post("/api/settings/test", response_model=SettingsTestResponse)
@@ -971,57 +1207,84 @@ def save_app_settings(payload: AppSettingsUpdate, db: Session = Depends(get_db))
     )
 
 
+@app.get("/api/tasks/{task_id}/images/{image_id}/pyramid")
+def get_image_level(
+    task_id: int,
+    image_id: int,
+    size: int = Query(256, ge=1, description="Required long-side size in pixels"),
+    db: Session = Depends(get_db),
+):
+    """Serve the smallest stored pyramid level whose long side is at least ``size``."""
+    image = db.query(Image).filter(Image.task_id == task_id, Image.id == image_id).first()
+    if not image:
+        raise HTTPException(status_code=404, detail="Image not found")
+    path, level = smallest_level(image, min_long=size)
+    if level is None:
+        # Larger than every stored level: the original is the only source that satisfies it.
+        try:
+            path = ensure_local_path(image.orig_path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Image file not found")
+    return FileResponse(path, headers={"X-Pyramid-Level": str(level) if level is not None else "original"})
+
+
+# Listing fields still read from meta_json; when none is requested the blob is not loaded.
+_IMAGE_META_FIELDS = {"crop_url", "thumb_url", "reason", "quality", "decision", "meta_json"}
+
+
 @app.get("/api/tasks/{task_id}/images")
 def get_task_images(
     task_id: int,
+    response: Response,
     selected: Optional[bool] = None,
+    cluster_id: Optional[int] = None,
+    shot_type: Optional[str] = None,
+    has_face: Optional[bool] = None,
     include_prompt: bool = False,
+    fields: Optional[str] = Query(None, description="Comma-separated keys to return, e.g. id,thumb_url,keep"),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[int] = Query(None, description="X-Next-Cursor of the previous page"),
     db: Session = Depends(get_db)
 ):
+    """Images of a task in id order, served from the database only (no image or txt reads)."""
     _get_task_or_404(db, task_id)
+    wanted = {name.strip() for name in fields.split(",") if name.strip()} if fields else None
     query = db.query(Image).filter(Image.task_id == task_id)
     if selected is not None:
         query = query.filter(Image.selected == selected)
-    
-    images = query.all()
+    if cluster_id is not None:
+        query = query.filter(Image.cluster_id == cluster_id)
+    if shot_type:
+        query = query.filter(Image.shot_type == shot_type)
+    if has_face is not None:
+        query = query.filter(Image.has_face == has_face)
+    if cursor is not None:
+        query = query.filter(Image.id > cursor)
+    with_meta = wanted is None or bool(wanted & _IMAGE_META_FIELDS)
+    if not with_meta:
+        query = query.options(defer(Image.meta_json))
+    if not include_prompt and (wanted is None or "prompt_text" not in wanted):
+        query = query.options(defer(Image.caption))
+    query = query.order_by(Image.id)
+    images = query.limit(limit + 1).all() if limit else query.all()
+    if limit and len(images) > limit:
+        images = images[:limit]
+        response.headers["X-Next-Cursor"] = str(images[-1].id)
 
-    # Add URLs to images
     result = []
     for img in images:
-        # Ensure width/height可用
-        if not img.width or not img.height:
-            try:
-                from PIL import Image as PILImage, ImageOps
-                with PILImage.open(img.orig_path) as pil_img:
-                    pil_img = ImageOps.exif_transpose(pil_img)
-                    img.width, img.height = pil_img.size
-                db.commit()
-            except Exception:
-                img.width = img.width or 1024
-                img.height = img.height or 1024
-
-        summary = _image_summary(img, task_id)
-        meta = img.meta_json or {}
-
-        # 附加原始/裁切路径与提示词信息
+        summary = _image_summary(img, task_id, with_meta=with_meta)
+        if with_meta:
+            summary["meta_json"] = img.meta_json or {}
         summary["orig_path"] = img.orig_path
         summary["crop_path"] = img.crop_path
         summary["selected"] = img.selected
-        summary["keep"] = summary.get("keep", img.selected)
         summary["has_prompt"] = bool(img.prompt_txt_path)
-        if include_prompt:
-            if img.prompt_txt_path and os.path.exists(img.prompt_txt_path):
-                try:
-                    with open(img.prompt_txt_path, "r", encoding="utf-8") as f:
-                        summary["prompt_text"] = f.read()
-                except Exception:
-                    summary["prompt_text"] = None
-            else:
-                summary["prompt_text"] = None
-        summary["meta_json"] = meta
-
+        if include_prompt or (wanted is not None and "prompt_text" in wanted):
+            summary["prompt_text"] = img.caption
+        if wanted is not None:
+            summary = {key: value for key, value in summary.items() if key in wanted}
         result.append(summary)
-    
     return result
 
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, JSON, Boolean, Float
+from sqlalchemy import Column, Integer, String, ForeignKey, JSON, Boolean, Float, Text, Index
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.orm import relationship
 from .task import Base
@@ -14,6 +14,8 @@ class Image(Base):
     preview_path = Column(String)
     crop_path = Column(String)
     prompt_txt_path = Column(String)
+    # Caption text as written to prompt_txt_path, so listings need no file reads.
+    caption = Column(Text)
     md5 = Column(String)
     phash = Column(String)
     sharpness = Column(Float)
@@ -21,5 +23,23 @@ class Image(Base):
     height = Column(Integer)
     selected = Column(Boolean, default=True)
     meta_json = Column(MutableDict.as_mutable(JSON), default=dict)
+    # Listing fields derived from meta_json on every flush (app.services.image_summary),
+    # so they can be filtered and sorted in SQL.
+    cluster_id = Column(Integer)
+    shot_type = Column(String)
+    has_face = Column(Boolean)
+    face_conf = Column(Float)
+    has_pose = Column(Boolean)
+    pose_conf = Column(Float)
+    subject_area_ratio = Column(Float)
+    focus_confidence = Column(Float)
+    crop_square_model = Column(JSON)
+    crop_square_user = Column(JSON)
 
     task = relationship("Task", back_populates="images")
+
+    __table_args__ = (
+        Index("ix_images_task_selected", "task_id", "selected"),
+        Index("ix_images_task_cluster", "task_id", "cluster_id"),
+        Index("ix_images_task_shot_type", "task_id", "shot_type"),
+    )
@@ -0,0 +1,45 @@
+from sqlalchemy import Column, Integer, String, DateTime, JSON, Boolean, Enum
+from datetime import datetime
+import enum
+from .task import Base
+
+
+class JobStatus(str, enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class Job(Base):
+    """A stage run waiting for, or executing in, a worker process."""
+
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    task_id = Column(Integer, index=True)
+    kind = Column(String)
+    args = Column(JSON, default=dict)
+    priority = Column(Integer, default=0, index=True)
+    status = Column(Enum(JobStatus), default=JobStatus.QUEUED, index=True)
+    cancel_requested = Column(Boolean, default=False)
+    worker_id = Column(String, nullable=True)
+    attempts = Column(Integer, default=0)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class WorkerStatus(Base):
+    """Latest state a worker process reported about itself (queue mode)."""
+
+    __tablename__ = "workers"
+
+    id = Column(String, primary_key=True)
+    pid = Column(Integer)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    heartbeat_at = Column(DateTime, default=datetime.utcnow, index=True)
+    status = Column(JSON, default=dict)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, JSON, ForeignKey, Enum
+from sqlalchemy import Boolean, Column, Integer, String, DateTime, JSON, ForeignKey, Enum
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -46,6 +46,10 @@ class Task(Base):
     stats = Column(JSON, default=dict)
     upload_path = Column(String)
     export_path = Column(String)
+    # Set when the export is written, cleared when it is reset; listings read it instead of stat-ing files.
+    export_ready = Column(Boolean, nullable=False, default=False, server_default="0")
+    # Bumped on every change to the task or its images (app.db.versioning); drives listing ETags.
+    version = Column(Integer, nullable=False, default=0, server_default="0")
 
     images = relationship("Image", back_populates="task")
     logs = relationship("Log", back_populates="task")
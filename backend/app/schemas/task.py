@@ -36,6 +36,8 @@ class TaskResponse(BaseModel):
     config: Dict = {}
     progress_detail: ProgressInfo
     items: Optional[list] = None
+    queue: Optional[Dict] = None
+    version: int = 0
 
     class Config:
         from_attributes = True
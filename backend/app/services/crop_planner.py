@@ -0,0 +1,210 @@
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image as PILImage
+
+from app.core.config import settings
+from app.services.image_source import open_image_file
+from app.services.pyramid import smallest_level
+
+PLANNER_MODES = ("model", "local", "auto")
+
+# Saliency only says where "something" is; keep it below the default auto threshold.
+SALIENCY_CONFIDENCE = 0.4
+_SALIENCY_SIDE = 128
+# Share of the crop window kept above the head when the subject is taller than the window.
+_HEAD_MARGIN = 0.05
+# Smallest crop side (share of the short edge); the crop stage clamps model output to the same floor.
+MIN_CROP_SIDE = 0.9
+# Padding around a body box, and how much of the subject a face box stands for.
+_BODY_PADDING = 1.1
+_FACE_CONTEXT = 3.0
+
+Box = Tuple[float, float, float, float]
+
+
+def planner_mode(task) -> str:
+    mode = (task.config or {}).get("crop_planner") or settings.CROP_PLANNER_MODE
+    return mode if mode in PLANNER_MODES else "model"
+
+
+def _swaps_axes(orientation: int) -> bool:
+    return orientation in (5, 6, 7, 8)
+
+
+def to_stored(x: float, y: float, orientation: int) -> Tuple[float, float]:
+    """Map a normalized point on the EXIF-transposed image back to the stored pixel frame.
+
+    Dedup features are computed on the upright image, while crops (and the
+    previews the model sees) use the stored pixels.
+    """
+    if orientation == 2:
+        return 1.0 - x, y
+    if orientation == 3:
+        return 1.0 - x, 1.0 - y
+    if orientation == 4:
+        return x, 1.0 - y
+    if orientation == 5:
+        return y, x
+    if orientation == 6:
+        return y, 1.0 - x
+    if orientation == 7:
+        return 1.0 - y, 1.0 - x
+    if orientation == 8:
+        return 1.0 - y, x
+    return x, y
+
+
+def _clamp(value: float) -> float:
+    return max(0.0, min(1.0, value))
+
+
+def _stored_bbox(box: Box, orientation: int) -> dict:
+    cx, cy, w, h = box
+    corners = [to_stored(_clamp(cx + dx * w / 2), _clamp(cy + dy * h / 2), orientation) for dx in (-1, 1) for dy in (-1, 1)]
+    xs = [c[0] for c in corners]
+    ys = [c[1] for c in corners]
+    return {"x1": min(xs), "y1": min(ys), "x2": max(xs), "y2": max(ys)}
+
+
+def _box(value) -> Optional[Box]:
+    if not isinstance(value, (list, tuple)) or len(value) != 4:
+        return None
+    try:
+        cx, cy, w, h = (float(v) for v in value)
+    except (TypeError, ValueError):
+        return None
+    if w <= 0 or h <= 0:
+        return None
+    return cx, cy, w, h
+
+
+def _crop_side(box: Box, scale: float, upright_w: int, upright_h: int) -> float:
+    """Square side (share of the short edge) covering ``box`` grown by ``scale``."""
+    _, _, w, h = box
+    extent = max(w * upright_w, h * upright_h) * scale / min(upright_w, upright_h)
+    return max(MIN_CROP_SIDE, min(1.0, extent))
+
+
+def _center_on_subject(
+    box: Box, face: Optional[Box], side: float, upright_w: int, upright_h: int
+) -> Tuple[float, float]:
+    """Center a ``side`` square on the subject; tall subjects keep the head in frame."""
+    cx, cy, _, h = box
+    short = min(upright_w, upright_h)
+    window_h = side * short / upright_h
+    if h > window_h:
+        top = cy - h / 2
+        if face is not None:
+            top = min(top, face[1] - face[3] / 2)
+        cy = top + window_h / 2 - _HEAD_MARGIN * window_h
+    return _clamp(cx), _clamp(cy)
+
+
+def _box_blur(arr: np.ndarray, k: int) -> np.ndarray:
+    pad = k // 2
+    padded = np.pad(arr, pad, mode="edge")
+    acc = np.pad(padded.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    return (acc[k:, k:] - acc[:-k, k:] - acc[k:, :-k] + acc[:-k, :-k]) / float(k * k)
+
+
+def saliency_center(path: str) -> Optional[Tuple[float, float]]:
+    """Spectral-residual saliency centroid (normalized, stored pixel frame)."""
+    with open_image_file(path) as fp, PILImage.open(fp) as img:
+        img.draft("L", (_SALIENCY_SIDE, _SALIENCY_SIDE))
+        gray = img.convert("L")
+        gray.thumbnail((_SALIENCY_SIDE, _SALIENCY_SIDE))
+        arr = np.asarray(gray, dtype=np.float32) / 255.0
+    if arr.shape[0] < 8 or arr.shape[1] < 8:
+        return None
+    spectrum = np.fft.fft2(arr)
+    log_amp = np.log(np.abs(spectrum) + 1e-8)
+    residual = log_amp - _box_blur(log_amp, 3)
+    sal = np.abs(np.fft.ifft2(np.exp(residual + 1j * np.angle(spectrum)))) ** 2
+    sal = _box_blur(sal, max(3, (min(arr.shape) // 16) | 1))
+    sal = np.where(sal >= np.percentile(sal, 90), sal, 0.0)
+    total = float(sal.sum())
+    if total <= 0:
+        return None
+    ys, xs = np.indices(sal.shape)
+    return (
+        float((xs * sal).sum() / total + 0.5) / sal.shape[1],
+        float((ys * sal).sum() / total + 0.5) / sal.shape[0],
+    )
+
+
+def _result(
+    x: float, y: float, side: float, confidence: float, source: str, shot_type: str, bbox: Optional[dict] = None
+) -> dict:
+    result = {
+        "focus_point": {"x": _clamp(x), "y": _clamp(y), "side": round(side, 4)},
+        "confidence": round(float(confidence), 3),
+        "usable": True,
+        "reject_reason": None,
+        "reason": f"local {source}",
+        "planner": "local",
+        "source": source,
+    }
+    if shot_type and shot_type != "unknown":
+        result["shot_type"] = shot_type
+    if bbox is not None:
+        result["bbox"] = bbox
+    return result
+
+
+def plan_crop(image, use_saliency: bool = True) -> Optional[dict]:
+    """Focus result in the model's format, planned from the dedup face/pose boxes.
+
+    Falls back to a saliency centroid on the smallest pyramid level. The local
+    planner cannot judge image quality, so it never marks an image unusable.
+    Returns None when nothing can be planned.
+    """
+    meta = image.meta_json or {}
+    width, height = image.width or 0, image.height or 0
+    orientation = int(meta.get("orientation") or 1)
+    if _swaps_axes(orientation):
+        width, height = height, width
+    shot_type = meta.get("shot_type") or "unknown"
+    face = _box(meta.get("face_bbox_norm"))
+    body = _box(meta.get("body_bbox_norm"))
+    pose_conf = float(meta.get("pose_conf") or 0.0)
+    face_conf = float(meta.get("face_conf") or 0.0)
+
+    if width > 0 and height > 0:
+        if body is not None and meta.get("has_pose"):
+            side = _crop_side(body, _BODY_PADDING, width, height)
+            x, y = _center_on_subject(body, face, side, width, height)
+            return _result(
+                *to_stored(x, y, orientation), side, pose_conf, "pose", shot_type, _stored_bbox(body, orientation)
+            )
+        if face is not None and meta.get("has_face"):
+            # Faces sit in the upper part of the subject: keep them on the upper third of the window.
+            side = _crop_side(face, _FACE_CONTEXT, width, height)
+            window_h = side * min(width, height) / height
+            x, y = _clamp(face[0]), _clamp(face[1] + window_h / 6)
+            return _result(
+                *to_stored(x, y, orientation), side, face_conf, "face", shot_type, _stored_bbox(face, orientation)
+            )
+
+    if not use_saliency:
+        return None
+    path, level = smallest_level(image)
+    if level is None:
+        path = image.preview_path or image.orig_path
+    try:
+        center = saliency_center(path)
+    except Exception:
+        return None
+    if center is None:
+        return None
+    # Saliency has no extent to size the window from.
+    return _result(center[0], center[1], 1.0, SALIENCY_CONFIDENCE, "saliency", shot_type)
+
+
+def accept_local(plan: Optional[dict], mode: str, min_confidence: Optional[float] = None) -> bool:
+    if plan is None or mode == "model":
+        return False
+    if mode == "local":
+        return True
+    threshold = settings.LOCAL_CROP_MIN_CONFIDENCE if min_confidence is None else min_confidence
+    return float(plan.get("confidence") or 0.0) >= threshold
@@ -1,11 +1,12 @@
 from __future__ import annotations
 
 import argparse
+import json
 import math
 import os
 import threading
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import Any, BinaryIO, Callable, List, Optional, Tuple
 
 import cv2
 import numpy as np
@@ -29,6 +30,10 @@ class ImageMeta:
     body_height_ratio: Optional[float] = None  # 人物高度占画面高度的比例
     is_full_body: bool = False  # 是否为全身照
     shot_type: str = "unknown"  # 拍摄类型：closeup, medium, long
+    # Visible pose landmarks as (cx, cy, w, h), same convention as face_bbox_norm.
+    body_bbox_norm: Optional[Tuple[float, float, float, float]] = None
+    # EXIF orientation of the source; features are computed on the transposed image.
+    orientation: int = 1
 
 
 def _get_face_app():
@@ -107,26 +112,48 @@ def _face_bbox_norm(face, width: int, height: int) -> Optional[Tuple[float, floa
     return (cx / width, cy / height, w / width, h / height)
 
 
-def _extract_pose_vec(img_rgb: np.ndarray, min_pose_conf: float) -> Tuple[Optional[np.ndarray], float, Optional[float]]:
+def _landmark_bbox_norm(landmarks) -> Optional[Tuple[float, float, float, float]]:
+    xs = [min(1.0, max(0.0, lm.x)) for lm in landmarks if lm.visibility > 0.5]
+    ys = [min(1.0, max(0.0, lm.y)) for lm in landmarks if lm.visibility > 0.5]
+    if len(xs) < 2:
+        return None
+    w = max(xs) - min(xs)
+    h = max(ys) - min(ys)
+    if w <= 0 or h <= 0:
+        return None
+    return (min(xs) + w / 2.0, min(ys) + h / 2.0, w, h)
+
+
+def _exif_orientation(img: Image.Image) -> int:
+    try:
+        return int(img.getexif().get(0x0112, 1) or 1)
+    except Exception:
+        return 1
+
+
+def _extract_pose_vec(
+    img_rgb: np.ndarray, min_pose_conf: float
+) -> Tuple[Optional[np.ndarray], float, Optional[float], Optional[Tuple[float, float, float, float]]]:
     pose = _get_pose_model()
     results = pose.process(img_rgb)
     if not results.pose_landmarks:
-        return None, 0.0, None
+        return None, 0.0, None, None
 
     landmarks = results.pose_landmarks.landmark
     if len(landmarks) < 33:
-        return None, 0.0, None
+        return None, 0.0, None, None
 
+    body_bbox_norm = _landmark_bbox_norm(landmarks)
     left = landmarks[11]
     right = landmarks[12]
     if left.visibility <= 0.5 or right.visibility <= 0.5:
-        return None, 0.0, None
+        return None, 0.0, None, body_bbox_norm
 
     cx = (left.x + right.x) / 2.0
     cy = (left.y + right.y) / 2.0
     shoulder_w = math.hypot(left.x - right.x, left.y - right.y)
     if shoulder_w <= 1e-6:
-        return None, 0.0, None
+        return None, 0.0, None, body_bbox_norm
 
     coords = []
     valid = 0
@@ -187,10 +214,10 @@ def _extract_pose_vec(img_rgb: np.ndarray, min_pose_conf: float) -> Tuple[Option
 
     pose_conf = valid / float(len(landmarks))
     if valid == 0 or pose_conf < min_pose_conf:
-        return None, 0.0, body_height_ratio
+        return None, 0.0, body_height_ratio, body_bbox_norm
 
     vec = np.array(coords, dtype=np.float32)
-    return _normalize_vec(vec), pose_conf, body_height_ratio
+    return _normalize_vec(vec), pose_conf, body_height_ratio, body_bbox_norm
 
 
 def extract_features(
@@ -199,8 +226,43 @@ def extract_features(
     max_side_small: int = 512,
     min_pose_conf: float = 0.35,
     max_workers: int = 4,
+    opener: Optional[Callable[[str], BinaryIO]] = None,
+    chunk_size: int = 0,
+    should_stop: Optional[Callable[[], bool]] = None,
+    on_chunk: Optional[Callable[[List[ImageMeta], int, int], None]] = None,
+    executor=None,
+    admit: Optional[Callable[[Image.Image, int], Any]] = None,
 ) -> List[ImageMeta]:
+    """Extract face/pose features; ``opener`` reads originals that are not plain files (e.g. zip members).
+
+    Work is handed out in chunks of ``chunk_size`` images (0 = all at once).
+    After each chunk ``on_chunk(chunk_metas, done, total)`` is called and
+    ``should_stop()`` is checked; once it returns True, queued images are
+    dropped, in-flight ones stop at their next step, and the metas finished
+    so far are returned. ``executor`` (a shared pool) replaces the private
+    pool of ``max_workers`` threads. ``admit(img, max_side_analysis)`` is
+    called on each opened image before it is decoded and returns a memory
+    reservation released once the image is done (None stops extraction).
+    """
+
+    # BaseException so the per-step ``except Exception`` handlers below let it through.
+    class _Stopped(BaseException):
+        pass
+
+    def _checkpoint() -> None:
+        if should_stop is not None and should_stop():
+            raise _Stopped()
+
+    def _admit(img: Image.Image):
+        if admit is None:
+            return None
+        reservation = admit(img, max_side_analysis)
+        if reservation is None:
+            raise _Stopped()
+        return reservation
+
     def _process_one(path: str) -> ImageMeta:
+        _checkpoint()
         errors: List[str] = []
         face_bbox_norm = None
         face_conf = 0.0
@@ -210,11 +272,25 @@ def extract_features(
         sharpness = 0.0
         small_gray = None
         body_height_ratio = None
+        body_bbox_norm = None
+        orientation = 1
+        reservation = None
 
         try:
             # 尝试打开图片，使用更可靠的错误处理
-            img = ImageOps.exif_transpose(Image.open(path))
+            if opener is not None:
+                with opener(path) as fp:
+                    img = Image.open(fp)
+                    reservation = _admit(img)
+                    img.load()
+            else:
+                img = Image.open(path)
+                reservation = _admit(img)
+            orientation = _exif_orientation(img)
+            img = ImageOps.exif_transpose(img)
         except Exception as exc:
+            if reservation is not None:
+                reservation.release()
             return ImageMeta(
                 path=path,
                 face_bbox_norm=None,
@@ -252,6 +328,7 @@ def extract_features(
                 analysis_bgr = cv2.cvtColor(analysis_rgb, cv2.COLOR_RGB2BGR)
 
                 # 人脸特征提取
+                _checkpoint()
                 try:
                     face_app = _get_face_app()
                     faces = face_app.get(analysis_bgr)
@@ -271,8 +348,11 @@ def extract_features(
                     errors.append(f"face_extract_failed:{exc}")
 
                 # 姿势特征提取
+                _checkpoint()
                 try:
-                    pose_vec, pose_conf, body_height_ratio = _extract_pose_vec(analysis_rgb, min_pose_conf=min_pose_conf)
+                    pose_vec, pose_conf, body_height_ratio, body_bbox_norm = _extract_pose_vec(
+                        analysis_rgb, min_pose_conf=min_pose_conf
+                    )
                     if pose_vec is None:
                         errors.append("no_pose")
                 except Exception as exc:
@@ -302,6 +382,8 @@ def extract_features(
                 img.close()
             except Exception:
                 pass
+            if reservation is not None:
+                reservation.release()
 
         return ImageMeta(
             path=path,
@@ -316,20 +398,145 @@ def extract_features(
             body_height_ratio=body_height_ratio,
             is_full_body=is_full_body,
             shot_type=shot_type,
+            body_bbox_norm=body_bbox_norm,
+            orientation=orientation,
         )
 
-    if max_workers <= 1:
-        return [_process_one(p) for p in paths]
+    total = len(paths)
+    chunk_size = chunk_size if chunk_size and chunk_size > 0 else max(1, total)
+    metas: List[ImageMeta] = []
+    chunk: List[ImageMeta] = []
+
+    def _finish_chunk() -> bool:
+        """Report the chunk; True when extraction should stop."""
+        if on_chunk is not None and chunk:
+            on_chunk(list(chunk), len(metas), total)
+        chunk.clear()
+        return should_stop is not None and should_stop()
+
+    if max_workers <= 1 and executor is None:
+        for path in paths:
+            try:
+                meta = _process_one(path)
+            except _Stopped:
+                break
+            metas.append(meta)
+            chunk.append(meta)
+            if len(chunk) >= chunk_size and _finish_chunk():
+                break
+        _finish_chunk()
+        return metas
 
+    from collections import deque
     from concurrent.futures import ThreadPoolExecutor
 
-    metas: List[ImageMeta] = []
-    with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        for meta in ex.map(_process_one, paths):
+    ex = executor or ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque()
+    next_idx = 0
+    try:
+        while next_idx < total or pending:
+            # Keep at most one chunk queued so a stop drops little work.
+            while next_idx < total and len(pending) < chunk_size:
+                pending.append(ex.submit(_process_one, paths[next_idx]))
+                next_idx += 1
+            try:
+                meta = pending.popleft().result()
+            except _Stopped:
+                break
             metas.append(meta)
+            chunk.append(meta)
+            if len(chunk) >= chunk_size and _finish_chunk():
+                break
+    finally:
+        for future in pending:
+            future.cancel()
+        if executor is None:
+            ex.shutdown(wait=True, cancel_futures=True)
+        else:
+            # Shared pool: wait only for this call's items that already started.
+            for future in pending:
+                if not future.cancelled():
+                    try:
+                        future.result()
+                    except BaseException:  # noqa: BLE001
+                        pass
+    # Report the last (possibly partial) chunk so finished work is kept.
+    _finish_chunk()
     return metas
 
 
+def _stat_signature(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def save_image_meta(meta: ImageMeta, out_path: str, source: Optional[List[int]] = None) -> None:
+    """Persist extracted features so an interrupted dedup can reuse them.
+
+    ``source`` identifies the original image version; defaults to its (size, mtime).
+    """
+    arrays = {}
+    for name in ("face_emb", "pose_vec", "small_gray"):
+        value = getattr(meta, name)
+        if value is not None:
+            arrays[name] = value
+    if source is None:
+        source = _stat_signature(meta.path)
+    info = {
+        "source": source,
+        "face_bbox_norm": list(meta.face_bbox_norm) if meta.face_bbox_norm is not None else None,
+        "face_conf": meta.face_conf,
+        "pose_conf": meta.pose_conf,
+        "sharpness": meta.sharpness,
+        "errors": meta.errors,
+        "body_height_ratio": meta.body_height_ratio,
+        "is_full_body": meta.is_full_body,
+        "shot_type": meta.shot_type,
+        "body_bbox_norm": list(meta.body_bbox_norm) if meta.body_bbox_norm is not None else None,
+        "orientation": meta.orientation,
+    }
+    tmp_path = f"{out_path}.tmp.npz"
+    np.savez_compressed(tmp_path, info=np.array(json.dumps(info)), **arrays)
+    os.replace(tmp_path, out_path)
+
+
+def load_image_meta(in_path: str, image_path: str, source: Optional[List[int]] = None) -> Optional[ImageMeta]:
+    """Load features saved by save_image_meta; None if missing or the source image changed."""
+    if not os.path.exists(in_path):
+        return None
+    try:
+        with np.load(in_path, allow_pickle=False) as data:
+            info = json.loads(str(data["info"]))
+            arrays = {name: data[name] for name in ("face_emb", "pose_vec", "small_gray") if name in data.files}
+        if source is None:
+            source = _stat_signature(image_path)
+        if source is None or info.get("source") != list(source):
+            return None
+    except Exception:
+        return None
+    bbox = info.get("face_bbox_norm")
+    body_bbox = info.get("body_bbox_norm")
+    return ImageMeta(
+        path=image_path,
+        face_bbox_norm=tuple(bbox) if bbox is not None else None,
+        face_conf=info.get("face_conf", 0.0),
+        face_emb=arrays.get("face_emb"),
+        pose_vec=arrays.get("pose_vec"),
+        pose_conf=info.get("pose_conf", 0.0),
+        sharpness=info.get("sharpness", 0.0),
+        small_gray=arrays.get("small_gray"),
+        errors=info.get("errors") or [],
+        body_height_ratio=info.get("body_height_ratio"),
+        is_full_body=bool(info.get("is_full_body")),
+        shot_type=info.get("shot_type", "unknown"),
+        body_bbox_norm=tuple(body_bbox) if body_bbox is not None else None,
+        orientation=int(info.get("orientation") or 1),
+    )
+
+
 def _cosine_sim(a: Optional[np.ndarray], b: Optional[np.ndarray]) -> float:
     if a is None or b is None:
         return 0.0
@@ -0,0 +1,627 @@
+import bisect
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Zip format constants (PKWARE APPNOTE).
+_LOCAL_HEADER_SIG = 0x04034B50
+_CENTRAL_HEADER_SIG = 0x02014B50
+_EOCD_SIG = 0x06054B50
+_ZIP64_EOCD_SIG = 0x06064B50
+_ZIP64_LOCATOR_SIG = 0x07064B50
+_ZIP_STORED = 0
+_ZIP_DEFLATED = 8
+_UTF8_FLAG = 0x800
+_ZIP32_LIMIT = 0xFFFFFFFF
+_ZIP16_LIMIT = 0xFFFF
+
+# Already-compressed formats are stored as-is, everything else is deflated.
+_STORED_EXTS = {".jpg", ".jpeg", ".png", ".webp"}
+
+_CRC_LOCK = threading.Lock()
+_CRC_CACHE: Dict[Tuple[str, int, int], int] = {}
+_CRC_CACHE_MAX = 100000
+
+
+def _dos_datetime(ts: float) -> Tuple[int, int]:
+    t = time.localtime(ts)
+    year = max(1980, t.tm_year)
+    dos_date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return dos_time, dos_date
+
+
+def _file_crc32(path: str, size: int, mtime_ns: int) -> int:
+    key = (os.path.abspath(path), size, mtime_ns)
+    with _CRC_LOCK:
+        cached = _CRC_CACHE.get(key)
+    if cached is not None:
+        return cached
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    with _CRC_LOCK:
+        if len(_CRC_CACHE) >= _CRC_CACHE_MAX:
+            _CRC_CACHE.clear()
+        _CRC_CACHE[key] = crc
+    return crc
+
+
+def _deflate(data: bytes) -> bytes:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _Member:
+    def __init__(self, arcname: str, method: int, crc: int, size: int, payload_size: int, mtime: float):
+        self.arcname = arcname
+        self.name_bytes = arcname.encode("utf-8")
+        self.method = method
+        self.crc = crc
+        self.size = size
+        self.payload_size = payload_size
+        self.mtime = mtime
+        self.dos_time, self.dos_date = _dos_datetime(mtime)
+        self.path: Optional[str] = None
+        self.data: Optional[bytes] = None
+        self.offset = 0
+
+
+def _local_header(m: _Member) -> bytes:
+    return struct.pack(
+        "<IHHHHHIIIHH",
+        _LOCAL_HEADER_SIG,
+        20,
+        _UTF8_FLAG,
+        m.method,
+        m.dos_time,
+        m.dos_date,
+        m.crc,
+        m.payload_size,
+        m.size,
+        len(m.name_bytes),
+        0,
+    ) + m.name_bytes
+
+
+def _central_header(m: _Member) -> bytes:
+    extra = b""
+    offset = m.offset
+    version = 20
+    if offset >= _ZIP32_LIMIT:
+        extra = struct.pack("<HHQ", 0x0001, 8, offset)
+        offset = _ZIP32_LIMIT
+        version = 45
+    return struct.pack(
+        "<IHHHHHHIIIHHHHHII",
+        _CENTRAL_HEADER_SIG,
+        version,
+        version,
+        _UTF8_FLAG,
+        m.method,
+        m.dos_time,
+        m.dos_date,
+        m.crc,
+        m.payload_size,
+        m.size,
+        len(m.name_bytes),
+        len(extra),
+        0,
+        0,
+        0,
+        0o100644 << 16,
+        offset,
+    ) + m.name_bytes + extra
+
+
+def _end_records(count: int, cd_offset: int, cd_size: int) -> bytes:
+    out = b""
+    zip64 = count > _ZIP16_LIMIT or cd_offset >= _ZIP32_LIMIT or cd_size >= _ZIP32_LIMIT
+    if zip64:
+        eocd64_offset = cd_offset + cd_size
+        out += struct.pack(
+            "<IQHHIIQQQQ",
+            _ZIP64_EOCD_SIG,
+            44,
+            45,
+            45,
+            0,
+            0,
+            count,
+            count,
+            cd_size,
+            cd_offset,
+        )
+        out += struct.pack("<IIQI", _ZIP64_LOCATOR_SIG, 0, eocd64_offset, 1)
+    out += struct.pack(
+        "<IHHHHIIH",
+        _EOCD_SIG,
+        0,
+        0,
+        min(count, _ZIP16_LIMIT),
+        min(count, _ZIP16_LIMIT),
+        min(cd_size, _ZIP32_LIMIT),
+        min(cd_offset, _ZIP32_LIMIT),
+        0,
+    )
+    return out
+
+
+class ZipStreamPlan:
+    """Deterministic zip layout that can be streamed (or range-read) without a temp file.
+
+    Image members are STORED (JPEGs do not compress further), text members are
+    deflated in memory up front. All offsets are known before streaming, so the
+    total size can be sent as Content-Length and any byte range served directly
+    from the source files.
+    """
+
+    def __init__(self) -> None:
+        self._members: List[_Member] = []
+        self._names: set = set()
+        self._segments: Optional[List[Tuple[int, int, Optional[str], Optional[bytes]]]] = None
+        self._starts: List[int] = []
+        self.size = 0
+
+    def add_file(self, path: str, arcname: str, compress: Optional[bool] = None) -> bool:
+        if arcname in self._names or not os.path.isfile(path):
+            return False
+        st = os.stat(path)
+        if compress is None:
+            compress = os.path.splitext(path)[1].lower() not in _STORED_EXTS
+        if compress:
+            with open(path, "rb") as f:
+                return self.add_bytes(f.read(), arcname, mtime=st.st_mtime)
+        crc = _file_crc32(path, st.st_size, st.st_mtime_ns)
+        member = _Member(arcname, _ZIP_STORED, crc, st.st_size, st.st_size, st.st_mtime)
+        member.path = path
+        self._append(member)
+        return True
+
+    def add_bytes(self, data: bytes, arcname: str, mtime: Optional[float] = None) -> bool:
+        if arcname in self._names:
+            return False
+        packed = _deflate(data)
+        member = _Member(
+            arcname,
+            _ZIP_DEFLATED,
+            zlib.crc32(data),
+            len(data),
+            len(packed),
+            mtime if mtime is not None else time.time(),
+        )
+        member.data = packed
+        self._append(member)
+        return True
+
+    def _append(self, member: _Member) -> None:
+        self._members.append(member)
+        self._names.add(member.arcname)
+        self._segments = None
+
+    @property
+    def member_count(self) -> int:
+        return len(self._members)
+
+    def _layout(self) -> List[Tuple[int, int, Optional[str], Optional[bytes]]]:
+        if self._segments is not None:
+            return self._segments
+        segments: List[Tuple[int, int, Optional[str], Optional[bytes]]] = []
+        pos = 0
+
+        def _push(length: int, path: Optional[str], data: Optional[bytes]) -> None:
+            nonlocal pos
+            if length:
+                segments.append((pos, length, path, data))
+                pos += length
+
+        for m in self._members:
+            m.offset = pos
+            header = _local_header(m)
+            _push(len(header), None, header)
+            _push(m.payload_size, m.path, m.data)
+        cd_offset = pos
+        central = b"".join(_central_header(m) for m in self._members)
+        _push(len(central), None, central)
+        tail = _end_records(len(self._members), cd_offset, len(central))
+        _push(len(tail), None, tail)
+
+        self._segments = segments
+        self._starts = [seg[0] for seg in segments]
+        self.size = pos
+        return segments
+
+    def total_size(self) -> int:
+        self._layout()
+        return self.size
+
+    def etag(self) -> str:
+        """Stable validator for If-Range: changes whenever any member changes."""
+        h = hashlib.sha1()
+        for m in self._members:
+            h.update(m.name_bytes)
+            h.update(struct.pack("<IQ", m.crc, m.size))
+        return f'"{h.hexdigest()}"'
+
+    def iter_range(self, start: int = 0, end: Optional[int] = None, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+        """Yield bytes [start, end] (inclusive) of the archive."""
+        segments = self._layout()
+        if end is None or end >= self.size:
+            end = self.size - 1
+        if start > end:
+            return
+        idx = max(0, bisect.bisect_right(self._starts, start) - 1)
+        pos = start
+        while pos <= end and idx < len(segments):
+            seg_start, seg_len, path, data = segments[idx]
+            seg_from = pos - seg_start
+            seg_to = min(seg_len, end - seg_start + 1)
+            if data is not None:
+                yield data[seg_from:seg_to]
+            else:
+                with open(path, "rb") as f:
+                    f.seek(seg_from)
+                    remaining = seg_to - seg_from
+                    while remaining > 0:
+                        chunk = f.read(min(chunk_size, remaining))
+                        if not chunk:
+                            raise IOError(f"export source changed while streaming: {path}")
+                        remaining -= len(chunk)
+                        yield chunk
+            pos = seg_start + seg_to
+            idx += 1
+
+    def write_to(self, path: str) -> str:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for chunk in self.iter_range(0):
+                f.write(chunk)
+        os.replace(tmp_path, path)
+        return path
+
+
+def parse_range_header(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single ``bytes=`` range. Returns None for a full response.
+
+    Raises ValueError when the range cannot be satisfied.
+    """
+    if not header or not header.strip().startswith("bytes="):
+        return None
+    spec = header.strip()[len("bytes="):]
+    if "," in spec:
+        # Multi-range responses are optional; serve the full body instead.
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first == "":
+            length = int(last)
+            if length <= 0:
+                raise ValueError("empty suffix range")
+            start = max(0, size - length)
+            end = size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError as exc:
+        raise ValueError(f"invalid range: {header}") from exc
+    end = min(end, size - 1)
+    if start >= size or start > end:
+        raise ValueError(f"unsatisfiable range: {header}")
+    return start, end
+
+
+def _manifest_entry(img) -> Dict:
+    return {
+        "image_id": img.id,
+        "orig_name": img.orig_name,
+        "md5": img.md5,
+        "focus_point": (img.meta_json or {}).get("focus", {}).get("focus_point"),
+        "crop_path": os.path.basename(img.crop_path) if img.crop_path else None,
+        "prompt": (img.meta_json or {}).get("caption", ""),
+    }
+
+
+def build_manifest(task, images) -> Dict:
+    return {
+        "version": "1.2",
+        "task_id": task.id,
+        "task_name": task.name,
+        "created_at": datetime.utcnow().isoformat(),
+        "focus_model": task.focus_model,
+        "tag_model": task.tag_model,
+        "images": [_manifest_entry(img) for img in images],
+    }
+
+
+def build_export_plan(images, manifest_path: Optional[str]) -> ZipStreamPlan:
+    """Lay out the training package from crop/txt files on disk."""
+    plan = ZipStreamPlan()
+    for img in images:
+        if img.crop_path:
+            plan.add_file(img.crop_path, f"images/{os.path.basename(img.crop_path)}", compress=False)
+        if img.prompt_txt_path:
+            plan.add_file(img.prompt_txt_path, f"txt/{os.path.basename(img.prompt_txt_path)}", compress=True)
+    if manifest_path:
+        plan.add_file(manifest_path, "manifest.json", compress=True)
+    return plan
+
+
+_BUILDER_LOCKS_GUARD = threading.Lock()
+_BUILDER_LOCKS: Dict[str, threading.Lock] = {}
+
+# Compact the on-disk package once superseded members take up this much space.
+_COMPACT_MIN_DEAD_BYTES = 8 * 1024 * 1024
+_COMPACT_DEAD_RATIO = 0.5
+
+_INDEX_VERSION = 2
+
+
+def _builder_lock(export_dir: str) -> threading.Lock:
+    key = os.path.abspath(export_dir)
+    with _BUILDER_LOCKS_GUARD:
+        lock = _BUILDER_LOCKS.get(key)
+        if lock is None:
+            lock = _BUILDER_LOCKS[key] = threading.Lock()
+        return lock
+
+
+def _file_signature(path: Optional[str]) -> Optional[List]:
+    if not path or not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    return [os.path.basename(path), st.st_mtime_ns, st.st_size]
+
+
+def _image_members(img) -> List[List]:
+    members = []
+    if img.crop_path and os.path.isfile(img.crop_path):
+        members.append([f"images/{os.path.basename(img.crop_path)}", img.crop_path, False])
+    if img.prompt_txt_path and os.path.isfile(img.prompt_txt_path):
+        members.append([f"txt/{os.path.basename(img.prompt_txt_path)}", img.prompt_txt_path, True])
+    return members
+
+
+def _member_record(m: _Member) -> List:
+    return [m.offset, m.method, m.crc, m.size, m.payload_size, m.mtime]
+
+
+def _member_from_record(arcname: str, record: List) -> _Member:
+    offset, method, crc, size, payload_size, mtime = record
+    m = _Member(arcname, method, crc, size, payload_size, mtime)
+    m.offset = offset
+    return m
+
+
+def _copy_exact(path: str, f, length: int, chunk_size: int = 1024 * 1024) -> None:
+    with open(path, "rb") as src:
+        remaining = length
+        while remaining > 0:
+            chunk = src.read(min(chunk_size, remaining))
+            if not chunk:
+                raise IOError(f"export source changed while packaging: {path}")
+            f.write(chunk)
+            remaining -= len(chunk)
+
+
+class IncrementalExportBuilder:
+    """Keep manifest.json (and optionally train_package.zip) up to date per image.
+
+    ``package_index.json`` records which file versions are already exported so
+    a sync only touches images that actually changed. Changed members are
+    appended to the package followed by a new central directory; the index
+    records the end offset of the last complete append, so a torn append is
+    truncated away on the next update. Superseded members stay as dead space
+    until they outgrow the live data, then the package is rebuilt into a temp
+    file and swapped in. ``upsert(..., flush=False)`` only queues the change on
+    this builder until ``flush()`` or ``sync()``.
+    """
+
+    def __init__(self, export_dir: str, write_package: bool = False):
+        self.export_dir = export_dir
+        self.write_package = write_package
+        self.manifest_path = os.path.join(export_dir, "manifest.json")
+        self.package_path = os.path.join(export_dir, "train_package.zip")
+        self.index_path = os.path.join(export_dir, "package_index.json")
+        # image id -> (index entry, manifest entry), or None for a removal.
+        self._pending: Dict[int, Optional[Tuple[Dict, Dict]]] = {}
+
+    def _load_json(self, path: str, default: Dict) -> Dict:
+        if not os.path.exists(path):
+            return default
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return default
+
+    def _save_json(self, data: Dict, path: str, indent: Optional[int] = None) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=indent, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _load_state(self, task) -> Tuple[Dict, Dict]:
+        manifest = self._load_json(self.manifest_path, build_manifest(task, []))
+        manifest.update({"version": "1.2", "task_name": task.name, "focus_model": task.focus_model, "tag_model": task.tag_model})
+        index = self._load_json(self.index_path, {})
+        if index.get("version") != _INDEX_VERSION:
+            # Older indexes map image ids straight to entries; keep those that list their source files.
+            images = {
+                key: entry
+                for key, entry in index.items()
+                if isinstance(entry, dict) and all(isinstance(member, list) for member in entry.get("members", []))
+            }
+            index = {"version": _INDEX_VERSION, "images": images, "package": None}
+        return manifest, index
+
+    def _save_manifest(self, manifest: Dict) -> None:
+        manifest["updated_at"] = datetime.utcnow().isoformat()
+        manifest["images"].sort(key=lambda entry: entry.get("image_id") or 0)
+        self._save_json(manifest, self.manifest_path, indent=2)
+
+    def _package_matches(self, layout: Optional[Dict]) -> bool:
+        """Whether train_package.zip still ends in the central directory ``layout`` recorded."""
+        if not layout or not os.path.exists(self.package_path):
+            return False
+        size = layout["size"]
+        if os.path.getsize(self.package_path) < size or size < 22:
+            return False
+        with open(self.package_path, "rb") as f:
+            f.seek(size - 22)
+            tail = f.read(22)
+        sig, _, _, _, count, _, cd_offset, _ = struct.unpack("<IHHHHIIH", tail)
+        return (
+            sig == _EOCD_SIG
+            and count == min(len(layout["members"]), _ZIP16_LIMIT)
+            and cd_offset == min(layout["cd_offset"], _ZIP32_LIMIT)
+        )
+
+    def _rebuild_package(self, images: Dict) -> Dict:
+        plan = ZipStreamPlan()
+        for key in sorted(images, key=int):
+            for arcname, path, compress in images[key].get("members", []):
+                plan.add_file(path, arcname, compress=compress)
+        plan.add_file(self.manifest_path, "manifest.json", compress=True)
+        plan.write_to(self.package_path)
+        members = plan._members
+        cd_offset = members[-1].offset + 30 + len(members[-1].name_bytes) + members[-1].payload_size if members else 0
+        return {
+            "size": plan.total_size(),
+            "cd_offset": cd_offset,
+            "dead": 0,
+            "members": {m.arcname: _member_record(m) for m in members},
+        }
+
+    def _append_package(self, layout: Optional[Dict], images: Dict, adds: List[List], drops: List[str]) -> Dict:
+        if not self._package_matches(layout):
+            return self._rebuild_package(images)
+        size = layout["size"]
+        plan = ZipStreamPlan()
+        for arcname, path, compress in adds:
+            plan.add_file(path, arcname, compress=compress)
+        members = dict(layout["members"])
+        # The previous central directory and end records become dead space too.
+        dead = layout["dead"] + size - layout["cd_offset"]
+        for arcname in set(drops) | {m.arcname for m in plan._members}:
+            old = members.pop(arcname, None)
+            if old is not None:
+                dead += 30 + len(arcname.encode("utf-8")) + old[4]
+        live = [_member_from_record(arcname, record) for arcname, record in members.items()]
+        with open(self.package_path, "r+b") as f:
+            # Bytes past the recorded end are left over from an append that never completed.
+            f.truncate(size)
+            f.seek(size)
+            pos = size
+            for m in plan._members:
+                m.offset = pos
+                header = _local_header(m)
+                f.write(header)
+                if m.data is not None:
+                    f.write(m.data)
+                else:
+                    _copy_exact(m.path, f, m.payload_size)
+                pos += len(header) + m.payload_size
+                live.append(m)
+            live.sort(key=lambda m: m.offset)
+            central = b"".join(_central_header(m) for m in live)
+            f.write(central)
+            f.write(_end_records(len(live), pos, len(central)))
+            f.flush()
+            os.fsync(f.fileno())
+            end = f.tell()
+        if dead >= _COMPACT_MIN_DEAD_BYTES and dead >= (pos - dead) * _COMPACT_DEAD_RATIO:
+            return self._rebuild_package(images)
+        return {
+            "size": end,
+            "cd_offset": pos,
+            "dead": dead,
+            "members": {m.arcname: _member_record(m) for m in live},
+        }
+
+    def _apply(self, task, changes: Dict[int, Optional[Tuple[Dict, Dict]]]) -> int:
+        manifest, index = self._load_state(task)
+        images = index["images"]
+        entries = {entry.get("image_id"): entry for entry in manifest.get("images", [])}
+        adds: List[List] = []
+        drops: List[str] = []
+        for image_id, change in changes.items():
+            key = str(image_id)
+            old = images.pop(key, None)
+            entries.pop(image_id, None)
+            if old:
+                drops.extend(member[0] for member in old.get("members", []))
+            if change is not None:
+                images[key], entries[image_id] = change
+                adds.extend(change[0]["members"])
+        manifest["images"] = list(entries.values())
+        self._save_manifest(manifest)
+        if self.write_package:
+            adds.append(["manifest.json", self.manifest_path, True])
+            index["package"] = self._append_package(index.get("package"), images, adds, drops)
+        else:
+            index["package"] = None
+        self._save_json(index, self.index_path)
+        return len(changes)
+
+    def _take_pending(self) -> Dict[int, Optional[Tuple[Dict, Dict]]]:
+        changes, self._pending = self._pending, {}
+        return changes
+
+    def upsert(self, task, images, flush: bool = True) -> int:
+        """Add or replace the export members of ``images``; with ``flush=False`` only queue them."""
+        for img in images:
+            entry = {
+                "crop": _file_signature(img.crop_path),
+                "txt": _file_signature(img.prompt_txt_path),
+                "members": _image_members(img),
+            }
+            self._pending[img.id] = (entry, _manifest_entry(img))
+        return self.flush(task) if flush else 0
+
+    def remove(self, task, image_ids, flush: bool = True) -> int:
+        for image_id in image_ids:
+            self._pending[image_id] = None
+        return self.flush(task) if flush else 0
+
+    def flush(self, task) -> int:
+        """Write queued changes to the manifest, the index and (optionally) the package."""
+        if not self._pending:
+            return 0
+        with _builder_lock(self.export_dir):
+            return self._apply(task, self._take_pending())
+
+    def sync(self, task, kept_images) -> int:
+        """Reconcile the export with ``kept_images``, touching only changed images."""
+        with _builder_lock(self.export_dir):
+            changes = self._take_pending()
+            _, index = self._load_state(task)
+            images = dict(index["images"])
+            for image_id, change in changes.items():
+                images.pop(str(image_id), None)
+                if change is not None:
+                    images[str(image_id)] = change[0]
+            kept_ids = {str(img.id) for img in kept_images}
+            for key in images:
+                if key not in kept_ids:
+                    changes[int(key)] = None
+            for img in kept_images:
+                entry = images.get(str(img.id))
+                crop, txt = _file_signature(img.crop_path), _file_signature(img.prompt_txt_path)
+                if entry is None or entry.get("crop") != crop or entry.get("txt") != txt:
+                    changes[img.id] = ({"crop": crop, "txt": txt, "members": _image_members(img)}, _manifest_entry(img))
+            stale = not os.path.exists(self.manifest_path) or (
+                self.write_package and not self._package_matches(index.get("package"))
+            )
+            if not changes and not stale:
+                return 0
+            return self._apply(task, changes)
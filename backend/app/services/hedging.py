@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from openai import RateLimitError
+
+from app.core.config import settings
+from app.services import model_router
+from app.services.http_pool import close_loop_clients, get_async_openai_client
+
+logger = logging.getLogger(__name__)
+
+# Recent successful call latencies per model, used for the hedge deadline.
+_LATENCY_WINDOW = 200
+_LAT_LOCK = threading.Lock()
+_LATENCIES: Dict[str, Deque[float]] = {}
+
+# Hedged calls run on one background event loop so the losing request can be cancelled.
+_LOOP_LOCK = threading.Lock()
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOOP_THREAD: Optional[threading.Thread] = None
+
+_HEDGE_LOCK = threading.Lock()
+_OUTSTANDING_HEDGES = 0
+
+
+@dataclass
+class HedgeResult:
+    model: str
+    response: Any
+    hedged: bool = False
+    capped: bool = False
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = int(round(q / 100.0 * (len(ordered) - 1)))
+    return ordered[max(0, min(len(ordered) - 1, idx))]
+
+
+def record_latency(model: str, seconds: float) -> None:
+    with _LAT_LOCK:
+        samples = _LATENCIES.get(model)
+        if samples is None:
+            samples = _LATENCIES[model] = deque(maxlen=_LATENCY_WINDOW)
+        samples.append(seconds)
+
+
+def hedge_delay(model: str) -> float:
+    """Seconds to wait for ``model`` before hedging: MODEL_HEDGE_PERCENTILE of its recent latency."""
+    with _LAT_LOCK:
+        samples = list(_LATENCIES.get(model) or ())
+    if len(samples) < settings.MODEL_HEDGE_MIN_SAMPLES:
+        return settings.MODEL_HEDGE_DEFAULT_DELAY
+    return max(settings.MODEL_HEDGE_MIN_DELAY, percentile(samples, settings.MODEL_HEDGE_PERCENTILE))
+
+
+def _acquire_hedge() -> bool:
+    global _OUTSTANDING_HEDGES
+    with _HEDGE_LOCK:
+        if _OUTSTANDING_HEDGES >= settings.MODEL_HEDGE_MAX_OUTSTANDING:
+            return False
+        _OUTSTANDING_HEDGES += 1
+        return True
+
+
+def _release_hedge() -> None:
+    global _OUTSTANDING_HEDGES
+    with _HEDGE_LOCK:
+        _OUTSTANDING_HEDGES = max(0, _OUTSTANDING_HEDGES - 1)
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP, _LOOP_THREAD
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="model-hedge", daemon=True)
+            thread.start()
+            _LOOP, _LOOP_THREAD = loop, thread
+        return _LOOP
+
+
+def shutdown() -> None:
+    global _LOOP, _LOOP_THREAD
+    with _LOOP_LOCK:
+        loop, thread = _LOOP, _LOOP_THREAD
+        _LOOP = _LOOP_THREAD = None
+    if loop is not None:
+        close_loop_clients(loop)
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not None:
+            thread.join(timeout=5)
+
+
+def _is_valid(validate: Optional[Callable[[str], Any]], response: Any) -> bool:
+    if validate is None:
+        return True
+    try:
+        validate(response.choices[0].message.content)
+        return True
+    except Exception:
+        return False
+
+
+async def _race(
+    client,
+    base_url: str,
+    primary: str,
+    backup: str,
+    request: Dict[str, Any],
+    validate: Optional[Callable[[str], Any]],
+    on_send: Optional[Callable[[str], None]],
+    admit: Optional[Callable[[str], bool]],
+) -> HedgeResult:
+    async def _leg(model: str):
+        if on_send is not None:
+            on_send(model)
+        started = time.monotonic()
+        try:
+            response = await client.chat.completions.create(model=model, **request)
+        except (asyncio.CancelledError, RateLimitError):
+            # Losing a race or being throttled says nothing about the model's health.
+            raise
+        except Exception as exc:
+            model_router.record_failure(base_url, model, exc)
+            raise
+        record_latency(model, time.monotonic() - started)
+        model_router.record_success(base_url, model, time.monotonic() - started)
+        return model, response
+
+    primary_task = asyncio.ensure_future(_leg(primary))
+    done, _ = await asyncio.wait({primary_task}, timeout=hedge_delay(primary))
+    if done:
+        # Answered (or failed) in time: errors go to the caller's model fallback as before.
+        model, response = primary_task.result()
+        return HedgeResult(model, response)
+    if not _acquire_hedge():
+        model, response = await primary_task
+        return HedgeResult(model, response, capped=True)
+    if admit is not None and not admit(backup):
+        # No rate-limit capacity for the backup right now: hedges never queue.
+        _release_hedge()
+        model, response = await primary_task
+        return HedgeResult(model, response, capped=True)
+
+    logger.info(f"模型 {primary} 超过对冲阈值未响应，向 {backup} 发送对冲请求")
+    hedge_task = asyncio.ensure_future(_leg(backup))
+    pending = {primary_task, hedge_task}
+    fallback = None
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # Prefer the primary when both finished in the same tick.
+            for task in sorted(done, key=lambda t: t is not primary_task):
+                try:
+                    model, response = task.result()
+                except Exception as exc:  # noqa: BLE001
+                    error = error or exc
+                    continue
+                if _is_valid(validate, response):
+                    return HedgeResult(model, response, hedged=True)
+                fallback = fallback or HedgeResult(model, response, hedged=True)
+        if fallback is not None:
+            return fallback
+        raise error
+    finally:
+        # Cancelling the loser closes its connection instead of waiting for the answer.
+        for task in pending:
+            task.cancel()
+        _release_hedge()
+
+
+def call_hedged(
+    base_url: str,
+    api_key: str,
+    primary: str,
+    backup: str,
+    request: Dict[str, Any],
+    validate: Optional[Callable[[str], Any]] = None,
+    on_send: Optional[Callable[[str], None]] = None,
+    admit: Optional[Callable[[str], bool]] = None,
+) -> HedgeResult:
+    """Call ``primary`` and, once it exceeds its latency deadline, race a duplicate on ``backup``.
+
+    The first valid response wins and the other request is cancelled. Hedges
+    in flight across all tasks are capped by MODEL_HEDGE_MAX_OUTSTANDING;
+    beyond the cap, or when ``admit(backup)`` refuses, the call simply waits
+    for the primary.
+    """
+    loop = _get_loop()
+    client = get_async_openai_client(base_url, api_key, loop=loop)
+    future = asyncio.run_coroutine_threadsafe(_race(client, base_url, primary, backup, request, validate, on_send, admit), loop)
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
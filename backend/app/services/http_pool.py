@@ -0,0 +1,139 @@
+import asyncio
+import importlib.util
+import logging
+import threading
+import weakref
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+_LOCK = threading.Lock()
+_SYNC_CLIENTS: Dict[Tuple[str, str], OpenAI] = {}
+# Keyed weakly by event loop: a client is only usable on the loop that opened its connections.
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str], AsyncOpenAI]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def http2_available() -> bool:
+    """HTTP/2 needs the optional ``h2`` package (``pip install httpx[http2]``)."""
+    return settings.MODEL_HTTP2 and importlib.util.find_spec("h2") is not None
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.MODEL_HTTP_POOL_SIZE,
+        max_keepalive_connections=settings.MODEL_HTTP_KEEPALIVE,
+        keepalive_expiry=settings.MODEL_HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def _key(base_url: str, api_key: str) -> Tuple[str, str]:
+    return base_url.rstrip("/"), api_key or ""
+
+
+def get_openai_client(base_url: str, api_key: str) -> OpenAI:
+    """Process-wide OpenAI client per (base_url, api_key) sharing one keep-alive pool."""
+    key = _key(base_url, api_key)
+    with _LOCK:
+        client = _SYNC_CLIENTS.get(key)
+        if client is None:
+            http_client = httpx.Client(
+                limits=_limits(),
+                http2=http2_available(),
+                timeout=settings.MODEL_HTTP_TIMEOUT,
+            )
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=settings.MODEL_HTTP_TIMEOUT,
+                http_client=http_client,
+            )
+            _SYNC_CLIENTS[key] = client
+            logger.info(f"创建共享HTTP连接池 {key[0]}（http2={http2_available()}）")
+        return client
+
+
+def get_async_openai_client(base_url: str, api_key: str, loop: Optional[asyncio.AbstractEventLoop] = None) -> AsyncOpenAI:
+    """Async counterpart of get_openai_client.
+
+    httpx async connections belong to the event loop that opened them, so
+    clients are shared per (base_url, api_key, loop) and dropped with the loop.
+    """
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    key = _key(base_url, api_key)
+    with _LOCK:
+        clients = _ASYNC_CLIENTS.get(loop)
+        if clients is None:
+            clients = _ASYNC_CLIENTS[loop] = {}
+        client = clients.get(key)
+        if client is None:
+            http_client = httpx.AsyncClient(
+                limits=_limits(),
+                http2=http2_available(),
+                timeout=settings.MODEL_HTTP_TIMEOUT,
+            )
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=settings.MODEL_HTTP_TIMEOUT,
+                http_client=http_client,
+            )
+            clients[key] = client
+        return client
+
+
+async def _aclose(clients: List[AsyncOpenAI]) -> None:
+    for client in clients:
+        try:
+            await client.close()
+        except Exception:
+            pass
+
+
+def _close_async(loop: asyncio.AbstractEventLoop, clients: List[AsyncOpenAI], timeout: float = 5.0) -> None:
+    if not clients or loop.is_closed():
+        # A closed loop already dropped its transports.
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if loop is running:
+        loop.create_task(_aclose(clients))
+    elif loop.is_running():
+        try:
+            asyncio.run_coroutine_threadsafe(_aclose(clients), loop).result(timeout)
+        except Exception:
+            pass
+    else:
+        loop.run_until_complete(_aclose(clients))
+
+
+def close_loop_clients(loop: asyncio.AbstractEventLoop) -> None:
+    """Close the async clients of ``loop``; call before stopping a long-lived loop."""
+    with _LOCK:
+        clients = list((_ASYNC_CLIENTS.pop(loop, None) or {}).values())
+    _close_async(loop, clients)
+
+
+def close_all() -> None:
+    """Close every pooled client, sync and async."""
+    with _LOCK:
+        clients = list(_SYNC_CLIENTS.values())
+        _SYNC_CLIENTS.clear()
+        loops = [(loop, list(per_loop.values())) for loop, per_loop in _ASYNC_CLIENTS.items()]
+        _ASYNC_CLIENTS.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            pass
+    for loop, async_clients in loops:
+        _close_async(loop, async_clients)
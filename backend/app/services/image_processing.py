@@ -1,9 +1,16 @@
+import io
+import math
 import os
+from contextlib import ExitStack
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
 import numpy as np
 from PIL import Image as PILImage, ImageOps
 import imagehash
 
 from app.core.defaults import DEFAULT_CROP_OUTPUT_SIZE, MIN_CROP_OUTPUT_SIZE, MAX_CROP_OUTPUT_SIZE
+from app.services.image_source import open_image_file
+from app.services.pyramid import levels_below, write_levels
 
 
 def calculate_sharpness(image: PILImage.Image) -> float:
@@ -18,34 +25,143 @@ def calculate_sharpness(image: PILImage.Image) -> float:
     return float(sharpness)
 
 
-def generate_preview(image_path: str, output_dir: str, max_side: int = 1200, quality: int = 86) -> str:
-    """Generate preview image with max side"""
-    with PILImage.open(image_path) as img:
+def render_preview(
+    image_path: str,
+    output_dir: str,
+    max_side: int = 1200,
+    quality: int = 86,
+    data: Optional[bytes] = None,
+    pyramid_dir: Optional[str] = None,
+    pyramid_levels: Iterable[int] = (),
+) -> Tuple[str, int, int, List[int]]:
+    """Write the preview JPEG (and pyramid levels) and return (preview_path, orig_width, orig_height, levels).
+
+    Images are only ever downscaled; JPEGs are decoded at a reduced DCT scale
+    when that still covers the largest size needed.
+    """
+    with (io.BytesIO(data) if data is not None else open_image_file(image_path)) as fp, PILImage.open(fp) as img:
+        width, height = img.size
+        long_side = max(1, width, height)
+        levels = levels_below(long_side, pyramid_levels) if pyramid_dir else []
+        orientation = img.getexif().get(0x0112) if levels else None
+        decode_side = max([max_side] + levels)
+        if decode_side < long_side:
+            scale = decode_side / long_side
+            img.draft("RGB", (max(1, round(width * scale)), max(1, round(height * scale))))
+
         # Convert to RGB if needed
         if img.mode != 'RGB':
             img = img.convert('RGB')
-        
-        # Calculate new size while maintaining aspect ratio
-        width, height = img.size
-        if width > height:
-            new_width = max_side
-            new_height = int((height / width) * max_side)
-        else:
-            new_height = max_side
-            new_width = int((width / height) * max_side)
-        
-        # Resize with high quality
-        img = img.resize((new_width, new_height), PILImage.LANCZOS)
-        
+
+        written: List[int] = []
+        if levels:
+            written = write_levels(img, image_path, pyramid_dir, levels, orientation=orientation)
+
+        scale = max_side / long_side
+        if scale < 1:
+            target = (max(1, round(width * scale)), max(1, round(height * scale)))
+            if img.size != target:
+                img = img.resize(target, PILImage.LANCZOS, reducing_gap=3.0)
+
         # Generate output path
         filename = os.path.basename(image_path)
         name, ext = os.path.splitext(filename)
         output_path = os.path.join(output_dir, f"{name}_preview.jpg")
+
+        # Baseline JPEG: optimize/progressive cost several times the encode time for ~5% size.
+        img.save(output_path, "JPEG", quality=quality)
+
+        return output_path, width, height, written
+
+
+def generate_preview(
+    image_path: str,
+    output_dir: str,
+    max_side: int = 1200,
+    quality: int = 86,
+    data: Optional[bytes] = None,
+) -> str:
+    """Generate preview image with max side; ``data`` may hold the already-read original bytes."""
+    return render_preview(image_path, output_dir, max_side=max_side, quality=quality, data=data)[0]
+
+
+def compute_crop_box(width: int, height: int, x: float, y: float, side: float = 1.0) -> Tuple[int, int, int, int]:
+    """Square crop box in pixels, centered at normalized (x,y) with side ratio (0-1) of the short edge."""
+    base_size = min(width, height)
+    side_ratio = max(0.05, min(1.0, side if side is not None else 1.0))
+    crop_size = max(1, int(base_size * side_ratio))
+    
+    # Calculate crop coordinates
+    center_x = int(x * width)
+    center_y = int(y * height)
+    
+    # Calculate crop box with boundary checks
+    half_size = crop_size // 2
+    left = max(0, center_x - half_size)
+    top = max(0, center_y - half_size)
+    right = min(width, center_x + half_size)
+    bottom = min(height, center_y + half_size)
+    
+    # If crop box is not square, adjust
+    if right - left != bottom - top:
+        current_size = min(right - left, bottom - top)
+        half_size = current_size // 2
+        left = center_x - half_size
+        top = center_y - half_size
+        right = center_x + half_size
+        bottom = center_y + half_size
         
-        # Save with specified quality
-        img.save(output_path, quality=quality, optimize=True, progressive=True)
-        
-        return output_path
+        # Ensure within bounds
+        if left < 0:
+            left = 0
+            right = current_size
+        if right > width:
+            right = width
+            left = width - current_size
+        if top < 0:
+            top = 0
+            bottom = current_size
+        if bottom > height:
+            bottom = height
+            top = height - current_size
+    return left, top, right, bottom
+
+
+def clamp_output_size(output_size: Optional[int]) -> int:
+    size = int(output_size) if output_size else DEFAULT_CROP_OUTPUT_SIZE
+    return max(MIN_CROP_OUTPUT_SIZE, min(MAX_CROP_OUTPUT_SIZE, size))
+
+
+def crop_output_path(image_path: str, output_dir: str) -> str:
+    name, ext = os.path.splitext(os.path.basename(image_path))
+    return os.path.join(output_dir, f"{name}_crop.jpg")
+
+
+def crop_decode_side(image_size: Tuple[int, int], side: float, output_size: int, proxy: bool = False) -> int:
+    """Long side a crop (and optional working proxy) needs from the decoded original."""
+    width, height = image_size
+    short = max(1, min(width, height))
+    side_ratio = max(0.05, min(1.0, side if side is not None else 1.0))
+    scale = output_size / (short * side_ratio)
+    if proxy:
+        scale = max(scale, output_size * 2 / short)
+    return math.ceil(max(width, height) * min(1.0, scale))
+
+
+def save_working_proxy(img: PILImage.Image, proxy_path: str, output_size: int) -> None:
+    """Save a reduced copy (short edge ~2x the crop output) used for interactive recrops."""
+    target_short = clamp_output_size(output_size) * 2
+    scale = min(1.0, target_short / max(1, min(img.size)))
+    proxy = img
+    if scale < 1.0:
+        proxy = img.resize(
+            (max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+            PILImage.LANCZOS,
+            reducing_gap=3.0,
+        )
+    tmp_path = f"{proxy_path}.tmp"
+    proxy.save(tmp_path, "JPEG", quality=92)
+    os.replace(tmp_path, proxy_path)
 
 
 def crop_1024_from_original(
@@ -56,67 +172,46 @@ def crop_1024_from_original(
     quality: int = 95,
     side: float = 1.0,
     output_size: int = DEFAULT_CROP_OUTPUT_SIZE,
+    output_path: Optional[str] = None,
+    proxy_path: Optional[str] = None,
+    admit: Optional[Callable[[PILImage.Image, int], Any]] = None,
 ) -> str:
-    """Crop square from original image, centered at (x,y) with optional side ratio (0-1)."""
-    with PILImage.open(image_path) as img:
+    """Crop square from original image, centered at (x,y) with optional side ratio (0-1).
+
+    ``output_path`` overrides the default ``{name}_crop.jpg``; ``proxy_path``
+    also stores a working proxy from the same decode. ``admit(img, needed_side)``
+    reserves decode memory and may reduce the decode resolution; the
+    reservation is held until the crop is written.
+    """
+    size = clamp_output_size(output_size)
+    with ExitStack() as stack:
+        fp = stack.enter_context(open_image_file(image_path))
+        img = stack.enter_context(PILImage.open(fp))
+        if admit is not None:
+            stack.enter_context(admit(img, crop_decode_side(img.size, side, size, proxy=bool(proxy_path))))
+
         # Convert to RGB if needed
         if img.mode != 'RGB':
             img = img.convert('RGB')
         
         width, height = img.size
-        base_size = min(width, height)
-        side_ratio = max(0.05, min(1.0, side if side is not None else 1.0))
-        crop_size = max(1, int(base_size * side_ratio))
-        
-        # Calculate crop coordinates
-        center_x = int(x * width)
-        center_y = int(y * height)
-        
-        # Calculate crop box with boundary checks
-        half_size = crop_size // 2
-        left = max(0, center_x - half_size)
-        top = max(0, center_y - half_size)
-        right = min(width, center_x + half_size)
-        bottom = min(height, center_y + half_size)
-        
-        # If crop box is not square, adjust
-        if right - left != bottom - top:
-            current_size = min(right - left, bottom - top)
-            half_size = current_size // 2
-            left = center_x - half_size
-            top = center_y - half_size
-            right = center_x + half_size
-            bottom = center_y + half_size
-            
-            # Ensure within bounds
-            if left < 0:
-                left = 0
-                right = current_size
-            if right > width:
-                right = width
-                left = width - current_size
-            if top < 0:
-                top = 0
-                bottom = current_size
-            if bottom > height:
-                bottom = height
-                top = height - current_size
+        box = compute_crop_box(width, height, x, y, side)
         
         # Crop image
-        cropped = img.crop((left, top, right, bottom))
+        cropped = img.crop(box)
         
         # Resize to output square size
-        size = int(output_size) if output_size else DEFAULT_CROP_OUTPUT_SIZE
-        size = max(MIN_CROP_OUTPUT_SIZE, min(MAX_CROP_OUTPUT_SIZE, size))
         cropped = cropped.resize((size, size), PILImage.LANCZOS)
         
         # Generate output path
-        filename = os.path.basename(image_path)
-        name, ext = os.path.splitext(filename)
-        output_path = os.path.join(output_dir, f"{name}_crop.jpg")
+        if output_path is None:
+            output_path = crop_output_path(image_path, output_dir)
         
         # Save with specified quality
-        cropped.save(output_path, quality=quality, optimize=True, progressive=True)
+        cropped.save(output_path, "JPEG", quality=quality, optimize=True, progressive=True)
+
+        if proxy_path:
+            save_working_proxy(img, proxy_path, size)
         
         return output_path
 
@@ -162,7 +257,7 @@ def get_crop_coords_from_prompt(image_path: str, prompt_result: dict) -> dict:
     Calculate crop coordinates based on prompt result.
     Returns normalized coordinates for 1024x1024 square crop.
     """
-    with PILImage.open(image_path) as img:
+    with open_image_file(image_path) as fp, PILImage.open(fp) as img:
         width, height = img.size
     
     # Extract subject bbox from prompt result
@@ -0,0 +1,237 @@
+import io
+import os
+import shutil
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+_IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def _is_safe_member(name: str) -> bool:
+    normalized = name.replace("\\", "/")
+    if normalized.startswith("/") or (len(normalized) >= 2 and normalized[1] == ":"):
+        return False
+    return ".." not in normalized.split("/")
+
+
+class ZipImageSource:
+    """Read image members straight out of an uploaded zip.
+
+    Image records keep the path the member *would* have after extraction
+    (``<unpack>/<member>``); reads of such paths are served from the archive
+    until something materializes the file. Every thread gets its own ZipFile
+    handle, so members can be decompressed in parallel.
+    """
+
+    def __init__(self, zip_path: str, root: str):
+        self.zip_path = zip_path
+        self.root = root
+        self._root_abs = os.path.abspath(root)
+        self._local = threading.local()
+        self._handles: List[zipfile.ZipFile] = []
+        self._lock = threading.Lock()
+        self._infos: Optional[Dict[str, zipfile.ZipInfo]] = None
+
+    def _zip(self) -> zipfile.ZipFile:
+        zf = getattr(self._local, "zf", None)
+        if zf is None or zf.fp is None:
+            zf = zipfile.ZipFile(self.zip_path, "r")
+            self._local.zf = zf
+            with self._lock:
+                self._handles.append(zf)
+        return zf
+
+    def _member_infos(self) -> Dict[str, zipfile.ZipInfo]:
+        if self._infos is None:
+            infos = {}
+            for info in self._zip().infolist():
+                if info.is_dir() or not _is_safe_member(info.filename):
+                    continue
+                infos[info.filename] = info
+            self._infos = infos
+        return self._infos
+
+    def member_paths(self) -> List[str]:
+        """Virtual extraction paths of all safe file members, in archive order."""
+        return [os.path.join(self.root, name) for name in self._member_infos()]
+
+    def member_for(self, path: str) -> Optional[str]:
+        abs_path = os.path.abspath(path)
+        if not abs_path.startswith(self._root_abs + os.sep):
+            return None
+        name = os.path.relpath(abs_path, self._root_abs).replace(os.sep, "/")
+        return name if name in self._member_infos() else None
+
+    def read(self, path: str) -> bytes:
+        member = self.member_for(path)
+        if member is None:
+            raise FileNotFoundError(path)
+        return self._zip().read(member)
+
+    def open(self, path: str) -> BinaryIO:
+        """Stream one member; cheap when only its header is read."""
+        member = self.member_for(path)
+        if member is None:
+            raise FileNotFoundError(path)
+        return self._zip().open(member)
+
+    def signature(self, path: str) -> Optional[List[int]]:
+        member = self.member_for(path)
+        if member is None:
+            return None
+        info = self._member_infos()[member]
+        return [info.file_size, info.CRC]
+
+    def materialize(self, path: str) -> str:
+        """Extract one member to its virtual path so it exists on disk."""
+        if os.path.exists(path):
+            return path
+        member = self.member_for(path)
+        if member is None:
+            raise FileNotFoundError(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.part"
+        with self._zip().open(member) as src, open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_path, path)
+        return path
+
+    def iter_prefetched(
+        self, paths: List[str], max_workers: int = 4, lookahead: int = 8, executor=None
+    ) -> Iterator[Tuple[str, bytes]]:
+        """Yield (path, bytes) in order while later members decompress in parallel.
+
+        Reads run on ``executor`` (e.g. the shared disk pool) when given,
+        otherwise on a private pool of ``max_workers`` threads.
+        """
+        if not paths:
+            return
+        if executor is not None:
+            yield from self._iter_window(executor, paths, lookahead)
+            return
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as ex:
+            yield from self._iter_window(ex, paths, lookahead)
+
+    def _iter_window(self, ex, paths: List[str], lookahead: int) -> Iterator[Tuple[str, bytes]]:
+        window = max(1, lookahead)
+        futures = [ex.submit(self.read, p) for p in paths[:window]]
+        next_idx = len(futures)
+        try:
+            for idx, path in enumerate(paths):
+                data = futures[idx].result()
+                futures[idx] = None
+                if next_idx < len(paths):
+                    futures.append(ex.submit(self.read, paths[next_idx]))
+                    next_idx += 1
+                yield path, data
+        finally:
+            # An abandoned iteration must not leave reads queued on a shared pool.
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+
+    def close(self) -> None:
+        with self._lock:
+            handles, self._handles = self._handles, []
+        for zf in handles:
+            try:
+                zf.close()
+            except Exception:
+                pass
+
+
+_SOURCES_LOCK = threading.Lock()
+_SOURCES: Dict[str, ZipImageSource] = {}
+
+
+def get_zip_source(zip_path: str, root: str) -> ZipImageSource:
+    key = os.path.abspath(root)
+    with _SOURCES_LOCK:
+        source = _SOURCES.get(key)
+        if source is None or os.path.abspath(source.zip_path) != os.path.abspath(zip_path):
+            source = _SOURCES[key] = ZipImageSource(zip_path, root)
+        return source
+
+
+def _source_for_path(path: str) -> Optional[ZipImageSource]:
+    """Find the zip source for a task path like ``.../tasks/{id}/unpack/<member>``."""
+    abs_path = os.path.abspath(path)
+    with _SOURCES_LOCK:
+        for key, source in _SOURCES.items():
+            if abs_path.startswith(key + os.sep):
+                return source
+    # Not registered in this process (restart / worker process): derive from the task layout.
+    parts = abs_path.split(os.sep)
+    if "unpack" not in parts:
+        return None
+    idx = len(parts) - 1 - parts[::-1].index("unpack")
+    root = os.sep.join(parts[: idx + 1])
+    zip_path = os.path.join(os.path.dirname(root), "upload.zip")
+    if not os.path.exists(zip_path):
+        return None
+    return get_zip_source(zip_path, root)
+
+
+def open_image_file(path: str) -> BinaryIO:
+    """Open an original image for reading, from disk or from its upload zip."""
+    if os.path.exists(path):
+        return open(path, "rb")
+    source = _source_for_path(path)
+    if source is None:
+        raise FileNotFoundError(path)
+    return io.BytesIO(source.read(path))
+
+
+def open_image_stream(path: str) -> BinaryIO:
+    """Like open_image_file, but zip members are streamed instead of read whole (for header probes)."""
+    if os.path.exists(path):
+        return open(path, "rb")
+    source = _source_for_path(path)
+    if source is None:
+        raise FileNotFoundError(path)
+    return source.open(path)
+
+
+def read_image_bytes(path: str) -> bytes:
+    with open_image_file(path) as f:
+        return f.read()
+
+
+def ensure_local_path(path: str) -> str:
+    """Return a real filesystem path, extracting the member from the zip if needed."""
+    if os.path.exists(path):
+        return path
+    source = _source_for_path(path)
+    if source is None:
+        raise FileNotFoundError(path)
+    return source.materialize(path)
+
+
+def source_signature(path: str) -> Optional[List[int]]:
+    """Signature used to validate cached per-image artifacts.
+
+    Zip members use (size, crc) so the value survives materialization; plain
+    files use (size, mtime).
+    """
+    source = _source_for_path(path)
+    signature = source.signature(path) if source is not None else None
+    if signature is None and os.path.exists(path):
+        st = os.stat(path)
+        signature = [st.st_size, st.st_mtime_ns]
+    return signature
+
+
+def close_sources(prefix: str) -> None:
+    """Release zip handles under ``prefix`` (e.g. before deleting a task dir)."""
+    abs_prefix = os.path.abspath(prefix)
+    with _SOURCES_LOCK:
+        keys = [key for key in _SOURCES if key == abs_prefix or key.startswith(abs_prefix + os.sep)]
+        sources = [_SOURCES.pop(key) for key in keys]
+    for source in sources:
+        source.close()
+
+
+def is_image_path(path: str) -> bool:
+    return os.path.splitext(path.lower())[1] in _IMAGE_EXTS
@@ -0,0 +1,94 @@
+"""Listing fields derived from ``Image.meta_json`` and stored in their own columns.
+
+The pipeline only writes ``meta_json``; every flush that changes it recomputes
+the summary columns, so listings can filter, sort and read them without
+loading or parsing the blob.
+"""
+import itertools
+import json
+from typing import Any, Dict, Optional
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+
+from app.models.image import Image
+
+# Columns on Image maintained from meta_json, in derive() order.
+COLUMNS = (
+    "cluster_id", "shot_type", "has_face", "face_conf", "has_pose", "pose_conf",
+    "subject_area_ratio", "focus_confidence", "crop_square_model", "crop_square_user",
+)
+
+
+def derive(meta: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Summary column values for a meta_json dict."""
+    meta = meta if isinstance(meta, dict) else {}
+    focus = meta.get("focus") if isinstance(meta.get("focus"), dict) else {}
+    dedup = meta.get("dedup") if isinstance(meta.get("dedup"), dict) else {}
+    crop_square_model = meta.get("crop_square_model")
+
+    subject_ratio = meta.get("subject_area_ratio")
+    if subject_ratio is None and focus.get("bbox"):
+        bbox = focus["bbox"]
+        subject_ratio = max(0.0, min(1.0, (bbox.get("x2", 0) - bbox.get("x1", 0)) * (bbox.get("y2", 0) - bbox.get("y1", 0))))
+    if subject_ratio is None and crop_square_model:
+        side = crop_square_model.get("side")
+        if side:
+            subject_ratio = max(0.0, min(1.0, float(side) * float(side)))
+
+    has_face = meta.get("has_face")
+    if has_face is None:
+        has_face = bool(dedup.get("face_emb") or focus.get("bbox"))
+
+    return {
+        "cluster_id": dedup.get("cluster_id"),
+        "shot_type": focus.get("shot_type"),
+        "has_face": bool(has_face),
+        "face_conf": meta.get("face_conf") or focus.get("confidence") or 0.0,
+        "has_pose": bool(meta.get("has_pose")),
+        "pose_conf": meta.get("pose_conf") or 0.0,
+        "subject_area_ratio": subject_ratio,
+        "focus_confidence": focus.get("confidence"),
+        "crop_square_model": crop_square_model,
+        "crop_square_user": meta.get("crop_square_user"),
+    }
+
+
+def apply(image: Image) -> None:
+    for column, value in derive(image.meta_json).items():
+        setattr(image, column, value)
+
+
+@event.listens_for(Session, "before_flush")
+def _sync_summaries(session, flush_context, instances) -> None:
+    for obj in itertools.chain(session.new, list(session.dirty)):
+        if not isinstance(obj, Image):
+            continue
+        # Untouched (possibly deferred) meta_json is neither loaded nor recomputed.
+        if obj in session.new or inspect(obj).attrs.meta_json.history.has_changes():
+            apply(obj)
+
+
+def backfill(conn) -> None:
+    """Fill the summary columns of existing rows from their stored meta_json (migration)."""
+    rows = conn.execute(text("SELECT id, meta_json FROM images")).fetchall()
+    statement = text(
+        "UPDATE images SET " + ", ".join(f"{column} = :{column}" for column in COLUMNS) + " WHERE id = :id"
+    )
+    batch = []
+    for image_id, raw in rows:
+        try:
+            meta = json.loads(raw) if isinstance(raw, str) else raw
+        except ValueError:
+            meta = None
+        values = derive(meta)
+        for column in ("crop_square_model", "crop_square_user"):
+            if values[column] is not None:
+                values[column] = json.dumps(values[column])
+        values["id"] = image_id
+        batch.append(values)
+        if len(batch) >= 500:
+            conn.execute(statement, batch)
+            batch = []
+    if batch:
+        conn.execute(statement, batch)
@@ -0,0 +1,379 @@
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import aliased
+
+from app.core.config import settings
+from app.db.database import SessionLocal
+from app.models.app_setting import AppSetting
+from app.models.job import Job, JobStatus, WorkerStatus
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = (JobStatus.QUEUED, JobStatus.RUNNING)
+
+# Short user-facing jobs beside a task's stages: claimed ahead of stage jobs,
+# rerun as they are after a lost worker, and not counted as the task being busy.
+SIDE_KINDS = ("recaption", "flush_recrops")
+FAST_LANE_PRIORITY = 2 ** 31 - 1
+
+# app_settings key holding pool sizes set through the API, forwarded to workers.
+POOL_LIMITS_KEY = "worker_pool_limits"
+
+
+def queue_mode() -> bool:
+    return settings.WORKER_MODE == "queue"
+
+
+def _to_dict(job: Job) -> Dict[str, Any]:
+    return {
+        "id": job.id,
+        "task_id": job.task_id,
+        "kind": job.kind,
+        "args": job.args or {},
+        "priority": job.priority or 0,
+        "status": getattr(job.status, "value", job.status),
+        "cancel_requested": bool(job.cancel_requested),
+        "worker_id": job.worker_id,
+        "attempts": job.attempts or 0,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "heartbeat_at": job.heartbeat_at.isoformat() if job.heartbeat_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def enqueue(task_id: int, kind: str, args: Optional[dict] = None, priority: int = 0) -> int:
+    """Persist a stage job; workers take higher priority first, then FIFO."""
+    if kind in SIDE_KINDS:
+        priority = FAST_LANE_PRIORITY
+    db = SessionLocal()
+    try:
+        job = Job(task_id=task_id, kind=kind, args=args or {}, priority=priority, status=JobStatus.QUEUED)
+        db.add(job)
+        db.commit()
+        return job.id
+    finally:
+        db.close()
+
+
+def claim(worker_id: str) -> Optional[Dict[str, Any]]:
+    """Atomically take the next queued job (priority, then age) whose task has nothing running.
+
+    The UPDATE is guarded by the queued status, so when several workers race
+    for the same row only one of them changes it.
+    """
+    running = aliased(Job)
+    busy_tasks = select(running.task_id).where(running.status == JobStatus.RUNNING)
+    candidate = (
+        select(Job.id)
+        .where(Job.status == JobStatus.QUEUED, Job.task_id.not_in(busy_tasks))
+        .order_by(Job.priority.desc(), Job.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        result = db.execute(
+            update(Job)
+            .where(Job.id == candidate, Job.status == JobStatus.QUEUED)
+            .values(
+                status=JobStatus.RUNNING,
+                worker_id=worker_id,
+                started_at=now,
+                heartbeat_at=now,
+                attempts=Job.attempts + 1,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        if result.rowcount != 1:
+            return None
+        # A worker process runs one job at a time, so its id names the claimed row.
+        job = (
+            db.query(Job)
+            .filter(Job.worker_id == worker_id, Job.status == JobStatus.RUNNING)
+            .order_by(Job.id.desc())
+            .first()
+        )
+        return _to_dict(job) if job else None
+    finally:
+        db.close()
+
+
+def heartbeat(job_id: int, worker_id: str) -> bool:
+    """Refresh the job's heartbeat; returns True when a cancel was requested."""
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.worker_id == worker_id, Job.status == JobStatus.RUNNING)
+            .values(heartbeat_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        job = db.query(Job).filter(Job.id == job_id).first()
+        return bool(job and job.cancel_requested)
+    finally:
+        db.close()
+
+
+def finish(job_id: int, worker_id: str, status: JobStatus, error: Optional[str] = None) -> None:
+    """Record the outcome, unless the job was requeued after this worker lost its heartbeat."""
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.worker_id == worker_id, Job.status == JobStatus.RUNNING)
+            .values(status=status, error=error[:1000] if error else None, finished_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def request_cancel(task_id: Optional[int] = None) -> int:
+    """Cancel queued jobs outright and flag running ones for their worker.
+
+    ``task_id=None`` applies to every task. Returns the number of jobs touched.
+    """
+    db = SessionLocal()
+    try:
+        queued = update(Job).where(Job.status == JobStatus.QUEUED)
+        running = update(Job).where(Job.status == JobStatus.RUNNING)
+        if task_id is not None:
+            queued = queued.where(Job.task_id == task_id)
+            running = running.where(Job.task_id == task_id)
+        touched = db.execute(
+            queued.values(status=JobStatus.CANCELLED, finished_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        touched += db.execute(
+            running.values(cancel_requested=True).execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        return touched
+    finally:
+        db.close()
+
+
+def requeue_stale(timeout: Optional[float] = None) -> List[int]:
+    """Requeue running jobs whose worker stopped heartbeating.
+
+    The stage may have been partway through, so the job comes back as a
+    ``resume`` that continues from the task's recorded stage.
+    """
+    timeout = settings.JOB_HEARTBEAT_TIMEOUT if timeout is None else timeout
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    db = SessionLocal()
+    try:
+        stale = (
+            db.query(Job)
+            .filter(Job.status == JobStatus.RUNNING, Job.heartbeat_at < cutoff)
+            .all()
+        )
+        requeued = []
+        for job in stale:
+            if job.cancel_requested:
+                job.status = JobStatus.CANCELLED
+                job.finished_at = datetime.utcnow()
+                continue
+            logger.warning(f"任务 {job.task_id} 的作业 {job.id}（{job.kind}）心跳超时，重新入队恢复")
+            job.status = JobStatus.QUEUED
+            if job.kind not in SIDE_KINDS:
+                job.kind = "resume"
+                job.args = {}
+            job.worker_id = None
+            job.error = "worker heartbeat lost"
+            requeued.append(job.id)
+        db.commit()
+        return requeued
+    finally:
+        db.close()
+
+
+def reprioritize(task_id: int, priority: int) -> int:
+    db = SessionLocal()
+    try:
+        count = db.execute(
+            update(Job)
+            .where(Job.task_id == task_id, Job.status == JobStatus.QUEUED, Job.kind.not_in(SIDE_KINDS))
+            .values(priority=priority)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        return count
+    finally:
+        db.close()
+
+
+def _avg_job_seconds(db) -> float:
+    recent = (
+        db.query(Job.started_at, Job.finished_at)
+        .filter(
+            Job.status == JobStatus.DONE,
+            Job.kind.not_in(SIDE_KINDS),
+            Job.started_at.isnot(None),
+            Job.finished_at.isnot(None),
+        )
+        .order_by(Job.id.desc())
+        .limit(50)
+        .all()
+    )
+    if not recent:
+        return settings.SCHEDULER_DEFAULT_JOB_SECONDS
+    return sum((finished - started).total_seconds() for started, finished in recent) / len(recent)
+
+
+def queue_info(task_id: int) -> Optional[Dict[str, Any]]:
+    """Position among queued jobs and a start estimate from recent job durations."""
+    db = SessionLocal()
+    try:
+        job = (
+            db.query(Job)
+            .filter(Job.task_id == task_id, Job.status.in_(ACTIVE_STATUSES))
+            .order_by(Job.id)
+            .first()
+        )
+        if job is None:
+            return None
+        lane = "interactive" if job.kind in SIDE_KINDS else "batch"
+        info = {"state": getattr(job.status, "value", job.status), "lane": lane, "priority": job.priority or 0, "job_id": job.id}
+        if job.status == JobStatus.RUNNING:
+            return {**info, "position": 0, "estimated_start_seconds": 0.0, "estimated_start_at": None}
+        ahead = (
+            db.query(Job)
+            .filter(
+                Job.status == JobStatus.QUEUED,
+                (Job.priority > (job.priority or 0)) | ((Job.priority == (job.priority or 0)) & (Job.id < job.id)),
+            )
+            .count()
+        )
+        workers = max(1, settings.WORKER_PROCESSES)
+        idle = max(0, workers - db.query(Job).filter(Job.status == JobStatus.RUNNING).count())
+        seconds = 0.0 if ahead < idle else ((ahead - idle) // workers + 1) * _avg_job_seconds(db)
+        return {
+            **info,
+            "position": ahead + 1,
+            "estimated_start_seconds": round(seconds, 1),
+            "estimated_start_at": (datetime.utcnow() + timedelta(seconds=seconds)).isoformat(),
+        }
+    finally:
+        db.close()
+
+
+def active_job(task_id: int, kind: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """The task's queued or running job of ``kind``; by default any stage job (side jobs ignored)."""
+    db = SessionLocal()
+    try:
+        query = db.query(Job).filter(Job.task_id == task_id, Job.status.in_(ACTIVE_STATUSES))
+        if kind is not None:
+            query = query.filter(Job.kind == kind)
+        else:
+            query = query.filter(Job.kind.not_in(SIDE_KINDS))
+        job = query.order_by(Job.id).first()
+        return _to_dict(job) if job else None
+    finally:
+        db.close()
+
+
+def list_jobs(task_id: int, limit: int = 50) -> List[Dict[str, Any]]:
+    db = SessionLocal()
+    try:
+        jobs = db.query(Job).filter(Job.task_id == task_id).order_by(Job.id.desc()).limit(limit).all()
+        return [_to_dict(job) for job in jobs]
+    finally:
+        db.close()
+
+
+def change_signature(db) -> str:
+    """Changes whenever a job is enqueued, claimed or finished; folded into listing ETags."""
+    max_id = db.query(func.max(Job.id)).scalar() or 0
+    queued = db.query(Job).filter(Job.status == JobStatus.QUEUED).count()
+    running = db.query(Job).filter(Job.status == JobStatus.RUNNING).count()
+    return f"{max_id}.{queued}.{running}"
+
+
+def queue_stats() -> Dict[str, Any]:
+    db = SessionLocal()
+    try:
+        counts = {status.value: 0 for status in JobStatus}
+        for status, in db.query(Job.status).filter(Job.status.in_(ACTIVE_STATUSES)).all():
+            counts[getattr(status, "value", status)] += 1
+        workers = db.query(Job.worker_id).filter(Job.status == JobStatus.RUNNING).distinct().count()
+        return {"mode": settings.WORKER_MODE, "queued": counts["queued"], "running": counts["running"], "busy_workers": workers}
+    finally:
+        db.close()
+
+
+def report_worker(worker_id: str, status: Dict[str, Any]) -> None:
+    """Store a worker process's own health, limit and pool snapshot."""
+    db = SessionLocal()
+    try:
+        row = db.query(WorkerStatus).filter(WorkerStatus.id == worker_id).first()
+        if row is None:
+            row = WorkerStatus(id=worker_id, pid=os.getpid())
+            db.add(row)
+        row.heartbeat_at = datetime.utcnow()
+        row.status = status
+        db.commit()
+    finally:
+        db.close()
+
+
+def remove_worker(worker_id: str) -> None:
+    db = SessionLocal()
+    try:
+        db.query(WorkerStatus).filter(WorkerStatus.id == worker_id).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def live_workers() -> List[Dict[str, Any]]:
+    """Snapshots of worker processes that reported within JOB_HEARTBEAT_TIMEOUT."""
+    cutoff = datetime.utcnow() - timedelta(seconds=settings.JOB_HEARTBEAT_TIMEOUT)
+    db = SessionLocal()
+    try:
+        rows = db.query(WorkerStatus).filter(WorkerStatus.heartbeat_at >= cutoff).order_by(WorkerStatus.id).all()
+        return [
+            {
+                "worker_id": row.id,
+                "pid": row.pid,
+                "started_at": row.started_at.isoformat() if row.started_at else None,
+                "heartbeat_at": row.heartbeat_at.isoformat() if row.heartbeat_at else None,
+                **(row.status or {}),
+            }
+            for row in rows
+        ]
+    finally:
+        db.close()
+
+
+def pool_limits() -> Dict[str, int]:
+    """Total cpu/disk pool sizes across worker processes set through the API ({} when never set)."""
+    db = SessionLocal()
+    try:
+        row = db.query(AppSetting).filter(AppSetting.key == POOL_LIMITS_KEY).first()
+        return dict(row.value or {}) if row else {}
+    finally:
+        db.close()
+
+
+def set_pool_limit(name: str, limit: int) -> None:
+    db = SessionLocal()
+    try:
+        row = db.query(AppSetting).filter(AppSetting.key == POOL_LIMITS_KEY).first()
+        if row is None:
+            row = AppSetting(key=POOL_LIMITS_KEY, value={})
+            db.add(row)
+        row.value = {**(row.value or {}), name: int(limit)}
+        db.commit()
+    finally:
+        db.close()
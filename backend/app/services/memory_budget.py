@@ -0,0 +1,232 @@
+import io
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from PIL import Image as PILImage
+
+from app.core.config import settings
+from app.services.image_source import open_image_stream
+
+logger = logging.getLogger(__name__)
+
+_MB = 1024 * 1024
+
+# Decoded bytes per pixel by PIL mode; unknown modes are assumed to be 4.
+_BYTES_PER_PIXEL = {
+    "1": 1, "L": 1, "P": 1, "LA": 2, "PA": 2, "La": 2, "I;16": 2, "I;16B": 2, "I;16L": 2,
+    "RGB": 3, "YCbCr": 3, "LAB": 3, "HSV": 3, "RGBA": 4, "RGBa": 4, "RGBX": 4, "CMYK": 4, "I": 4, "F": 4,
+}
+
+# JPEG can decode at 1/2, 1/4 or 1/8 scale (PIL draft); other formats decode in full.
+_DRAFT_SCALES = (1, 2, 4, 8)
+
+
+def _draft_scale(long_side: int, needed_side: int) -> int:
+    """Largest JPEG DCT scale whose decode still covers ``needed_side``."""
+    best = 1
+    for scale in _DRAFT_SCALES:
+        if long_side / scale >= needed_side:
+            best = scale
+    return best
+
+
+def _cost(width: int, height: int, mode: str, scale: int = 1) -> int:
+    pixels = math.ceil(width / scale) * math.ceil(height / scale)
+    # The decoded buffer plus one RGB working copy (convert, transpose, crop or resize).
+    return pixels * (_BYTES_PER_PIXEL.get(mode, 4) + 3)
+
+
+def decode_cost(width: int, height: int, mode: str, fmt: Optional[str], needed_side: Optional[int] = None) -> int:
+    """Estimated peak bytes to decode an image whose caller only needs ``needed_side`` px on the long side."""
+    long_side = max(1, width, height)
+    scale = _draft_scale(long_side, needed_side) if fmt == "JPEG" and needed_side else 1
+    return _cost(width, height, mode, scale)
+
+
+def probe(path: str, data: Optional[bytes] = None) -> Tuple[int, int, str, Optional[str]]:
+    """(width, height, mode, format) from the image header, without decoding pixels."""
+    with (io.BytesIO(data) if data is not None else open_image_stream(path)) as fp, PILImage.open(fp) as img:
+        return img.size[0], img.size[1], img.mode, img.format
+
+
+class Reservation:
+    """Memory held against the budget until ``release()`` (or the end of a ``with`` block)."""
+
+    def __init__(self, budget: "MemoryBudget", nbytes: int, task_id: Optional[int]):
+        self.budget = budget
+        self.nbytes = nbytes
+        self.task_id = task_id
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.budget._release(self)
+
+    def __enter__(self) -> "Reservation":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class MemoryBudget:
+    """Admission control for image decodes against a fixed byte budget.
+
+    Requests are admitted in arrival order, so a large image is not starved by
+    a stream of small ones. A single request larger than the whole budget is
+    capped at the budget, i.e. it waits until it can run alone.
+    """
+
+    def __init__(self, limit_bytes: int):
+        self.limit = max(0, int(limit_bytes))
+        self.cond = threading.Condition()
+        self.used = 0
+        self.peak = 0
+        self.waiting: Deque[object] = deque()
+        self.tasks: Dict[int, Dict[str, Any]] = {}
+        self.stats = {"admitted": 0, "waited": 0, "wait_seconds": 0.0, "reduced_decodes": 0, "oversized": 0}
+
+    def _task(self, task_id: int) -> Dict[str, Any]:
+        usage = self.tasks.get(task_id)
+        if usage is None:
+            usage = self.tasks[task_id] = {
+                "current": 0, "peak": 0, "images": 0, "reduced_decodes": 0, "oversized": 0, "wait_seconds": 0.0,
+            }
+        return usage
+
+    def reserve(self, nbytes: int, task_id: Optional[int] = None, should_stop=None) -> Optional[Reservation]:
+        """Block until ``nbytes`` fit; None when ``should_stop()`` turns True while waiting."""
+        nbytes = max(0, int(nbytes))
+        if self.limit:
+            nbytes = min(nbytes, self.limit)
+        ticket = object()
+        started = time.monotonic()
+        with self.cond:
+            self.waiting.append(ticket)
+            try:
+                while self.limit and (self.waiting[0] is not ticket or (self.used and self.used + nbytes > self.limit)):
+                    if should_stop is not None and should_stop():
+                        return None
+                    self.cond.wait(timeout=0.5 if should_stop is not None else None)
+            finally:
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+            waited = time.monotonic() - started
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+            self.stats["admitted"] += 1
+            if waited > 0.01:
+                self.stats["waited"] += 1
+                self.stats["wait_seconds"] += waited
+            if task_id is not None:
+                usage = self._task(task_id)
+                usage["current"] += nbytes
+                usage["peak"] = max(usage["peak"], usage["current"])
+                usage["images"] += 1
+                usage["wait_seconds"] += waited
+        return Reservation(self, nbytes, task_id)
+
+    def _release(self, reservation: Reservation) -> None:
+        with self.cond:
+            self.used -= reservation.nbytes
+            if reservation.task_id is not None and reservation.task_id in self.tasks:
+                self.tasks[reservation.task_id]["current"] -= reservation.nbytes
+            self.cond.notify_all()
+
+    def note(self, task_id: Optional[int], key: str) -> None:
+        with self.cond:
+            self.stats[key] += 1
+            if task_id is not None:
+                self._task(task_id)[key] += 1
+
+    def take_task_usage(self, task_id: int) -> Optional[Dict[str, Any]]:
+        """Usage since the last call for this task; reservations still held carry over."""
+        with self.cond:
+            usage = self.tasks.pop(task_id, None)
+            if usage is None:
+                return None
+            if usage["current"]:
+                self._task(task_id).update(current=usage["current"], peak=usage["current"])
+        return {
+            "peak_reserved_mb": round(usage["peak"] / _MB, 1),
+            "images": usage["images"],
+            "reduced_decodes": usage["reduced_decodes"],
+            "oversized": usage["oversized"],
+            "wait_seconds": round(usage["wait_seconds"], 3),
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                "limit_mb": round(self.limit / _MB, 1),
+                "used_mb": round(self.used / _MB, 1),
+                "peak_mb": round(self.peak / _MB, 1),
+                "waiting": len(self.waiting),
+                **{k: round(v, 3) if isinstance(v, float) else v for k, v in self.stats.items()},
+            }
+
+
+_LOCK = threading.Lock()
+_BUDGET: Optional[MemoryBudget] = None
+
+
+def get_budget() -> MemoryBudget:
+    """Process-wide budget of MEMORY_BUDGET_MB (0 admits everything but still tracks usage)."""
+    global _BUDGET
+    with _LOCK:
+        if _BUDGET is None:
+            _BUDGET = MemoryBudget(settings.MEMORY_BUDGET_MB * _MB)
+        return _BUDGET
+
+
+def reserve(nbytes: int, task_id: Optional[int] = None, should_stop=None) -> Optional[Reservation]:
+    return get_budget().reserve(nbytes, task_id=task_id, should_stop=should_stop)
+
+
+def admit(
+    img: PILImage.Image,
+    needed_side: Optional[int] = None,
+    task_id: Optional[int] = None,
+    should_stop=None,
+) -> Optional[Reservation]:
+    """Reserve memory for decoding an opened (not yet loaded) image.
+
+    An image whose full decode would exceed MEMORY_MAX_IMAGE_MB is routed to a
+    reduced-resolution decode: JPEGs are drafted down to ``needed_side`` (the
+    long side the caller actually uses), and further if that still does not
+    fit. Other formats cannot decode reduced and are reserved in full.
+    """
+    width, height = img.size
+    max_bytes = settings.MEMORY_MAX_IMAGE_MB * _MB
+    cost = _cost(width, height, img.mode)
+    if max_bytes and cost > max_bytes:
+        budget = get_budget()
+        if img.format == "JPEG":
+            long_side = max(1, width, height)
+            scale = _draft_scale(long_side, needed_side) if needed_side else 1
+            for candidate in _DRAFT_SCALES:
+                if candidate >= scale:
+                    scale = candidate
+                    if _cost(width, height, img.mode, scale) <= max_bytes:
+                        break
+            if scale > 1:
+                img.draft("RGB", (math.ceil(width / scale), math.ceil(height / scale)))
+                logger.info(f"图片 {width}x{height} 解码需约 {cost // _MB}MB，降采样 1/{scale} 解码")
+                cost = _cost(width, height, img.mode, scale)
+                budget.note(task_id, "reduced_decodes")
+        if cost > max_bytes:
+            budget.note(task_id, "oversized")
+    return reserve(cost, task_id=task_id, should_stop=should_stop)
+
+
+def take_task_usage(task_id: int) -> Optional[Dict[str, Any]]:
+    return get_budget().take_task_usage(task_id)
+
+
+def snapshot() -> Dict[str, Any]:
+    return get_budget().snapshot()
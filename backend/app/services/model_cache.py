@@ -0,0 +1,184 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(kind: str, model: str, prompt: str, image_digests: Iterable[str]) -> str:
+    """Build a cache key from the exact request inputs (image bytes hash, model, prompt)."""
+    h = hashlib.sha256()
+    for part in (kind, model, prompt, *image_digests):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class _InFlight:
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.value: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+
+class ModelResponseCache:
+    """SQLite-backed cache for raw model responses with LRU size-based eviction.
+
+    Concurrent lookups of the same key are coalesced: the first caller runs the
+    request, the others wait for its result instead of sending a duplicate call.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max(0, int(max_bytes))
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, _InFlight] = {}
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, kind TEXT, model TEXT, value TEXT, "
+                "size INTEGER, created_at REAL, accessed_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed ON responses (accessed_at)")
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str, kind: str = "", model: str = "") -> None:
+        size = len(value.encode("utf-8"))
+        if self.max_bytes and size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, kind, model, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, kind, model, value, size, now, now),
+            )
+            self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self) -> None:
+        if not self.max_bytes:
+            return
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Evict least recently used entries down to 90% of the budget.
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC").fetchall()
+        evict = []
+        for key, size in rows:
+            if total <= target:
+                break
+            evict.append((key,))
+            total -= size or 0
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evict)
+        logger.info(f"模型缓存淘汰 {len(evict)} 条记录")
+
+    def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], str],
+        kind: str = "",
+        model: str = "",
+        store: Optional[Callable[[], bool]] = None,
+    ) -> str:
+        """Return the cached value or run ``compute`` once for all concurrent callers.
+
+        Exceptions raised by ``compute`` are propagated to every waiter and
+        nothing is stored, so failed calls are retried next time. A computed
+        value is only stored when ``store()`` (checked after ``compute``) is True.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            pending = self._inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = _InFlight()
+                self._inflight[key] = pending
+
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            value = compute()
+            pending.value = value
+            if store is None or store():
+                self.put(key, value, kind=kind, model=model)
+            return value
+        except BaseException as exc:
+            pending.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            pending.event.set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            "entries": count,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+_CACHE_LOCK = threading.Lock()
+_CACHE: Optional[ModelResponseCache] = None
+
+
+def get_model_cache() -> Optional[ModelResponseCache]:
+    """Return the process-wide response cache, or None when disabled."""
+    global _CACHE
+    if not settings.MODEL_CACHE_ENABLED:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            try:
+                _CACHE = ModelResponseCache(
+                    settings.MODEL_CACHE_PATH,
+                    settings.MODEL_CACHE_MAX_MB * 1024 * 1024,
+                )
+            except Exception as exc:  # noqa: BLE001
+                logger.error(f"初始化模型缓存失败，禁用缓存: {exc}")
+                return None
+        return _CACHE
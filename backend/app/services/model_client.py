@@ -1,14 +1,66 @@
-import base64
 import time
 import json
 import logging
-from typing import Dict, Optional, Any
-from openai import OpenAI
-from openai import OpenAIError
+import threading
+from typing import Callable, Dict, List, Optional, Any, Tuple, Union
+from openai import OpenAIError, RateLimitError
+from app.core.config import settings
 from app.core.defaults import DEFAULT_CAPTION_PROMPT
+from app.services import hedging, model_router, rate_limiter
+from app.services.payload_encoder import PayloadEncoder
+from app.services.http_pool import get_openai_client
+from app.services.model_cache import get_model_cache, make_cache_key
 
 logger = logging.getLogger(__name__)
 
+FOCUS_SYSTEM_PROMPT = "You are a professional image analyst. Focus on identifying the main subject and its exact position."
+
+FOCUS_PROMPT = """Analyze this image and identify the main focus point. Return a JSON object with:
+            - focus_point: {x, y, side} normalized (0-1). side is the square crop ratio based on the short edge.
+            - bbox: optional {x1, y1, x2, y2} normalized bounding box
+            - shot_type: optional "closeup", "medium", or "long"
+            - confidence: 0.0-1.0 confidence score
+            - usable: boolean indicating if the image is clear and usable for training
+            - reject_reason: reason if image is not usable (e.g., too_blurry, subject_not_clear)
+            - reason: short reason for the focus point
+
+            Crop rule: choose the LARGEST possible square crop. Prefer side=1.0 (use the full short edge).
+            Only reduce side if needed to fully include the main subject.
+            Only return valid JSON, no additional text."""
+
+FOCUS_BATCH_PROMPT = """You will receive {count} images labelled Image 1..{count}. Analyze EACH image independently
+and identify its main focus point. Return ONLY a JSON array with exactly {count} objects, in image order.
+Each object has:
+- index: the image number (1-based)
+- focus_point: {{x, y, side}} normalized (0-1). side is the square crop ratio based on the short edge.
+- bbox: optional {{x1, y1, x2, y2}} normalized bounding box
+- shot_type: optional "closeup", "medium", or "long"
+- confidence: 0.0-1.0 confidence score
+- usable: boolean indicating if the image is clear and usable for training
+- reject_reason: reason if image is not usable (e.g., too_blurry, subject_not_clear)
+- reason: short reason for the focus point
+
+Crop rule: choose the LARGEST possible square crop. Prefer side=1.0 (use the full short edge).
+Only reduce side if needed to fully include the main subject.
+Only return valid JSON, no additional text."""
+
+
+def _parse_focus_batch(response: str) -> List[Any]:
+    """Parse a batched focus answer into a list ordered by image index."""
+    data = json.loads(response)
+    if isinstance(data, dict):
+        data = data.get("results") or data.get("images") or []
+    if not isinstance(data, list):
+        raise ValueError("focus batch response is not a JSON array")
+    if all(isinstance(item, dict) and isinstance(item.get("index"), int) for item in data):
+        ordered: List[Any] = [None] * len(data)
+        for item in data:
+            pos = item["index"] - 1
+            if 0 <= pos < len(ordered) and ordered[pos] is None:
+                ordered[pos] = item
+        data = ordered
+    return data
+
 
 class ModelClient:
     # 模型优先级列表 - 仅包含VL模型
@@ -19,8 +71,17 @@ class ModelClient:
         "Qwen/Qwen3-VL-8B-Instruct"         # 最后使用8B模型
     ]
     
-    def __init__(self, api_key: str, base_url: str, model: str):
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        model: str,
+        use_cache: bool = True,
+        task_id: Optional[int] = None,
+    ):
         self.api_key = api_key
+        # Fairness key for the shared rate limiter.
+        self.task_id = task_id
         self.base_url = base_url.rstrip('/')
         self.initial_model = model
         self.model = model
@@ -29,46 +90,194 @@ class ModelClient:
         # 初始化模型索引
         if model in self.MODEL_PRIORITY:
             self.model_index = self.MODEL_PRIORITY.index(model)
+        # Start on the healthiest eligible model instead of re-trying a failing primary.
+        self._route()
         
+        # 响应缓存（可按任务关闭）
+        self.cache = get_model_cache() if use_cache else None
+
+        # Budget-encoded images are reused across retries of the same file.
+        self.encoder = PayloadEncoder()
+        self._stats_lock = threading.Lock()
+        self.payload_stats = {
+            "requests": 0,
+            "images": 0,
+            "bytes_sent": 0,
+            "raw_bytes": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+        # Wall time of each successful model call (including hedges) for p50/p95/p99.
+        self.call_latencies: List[float] = []
+        self.hedge_stats = {"hedged": 0, "hedge_wins": 0, "hedges_capped": 0}
+        self.rate_stats = {"rate_limit_wait_s": 0.0, "throttled": 0}
+
         logger.info(f"初始化ModelClient，使用模型: {self.model}")
         
-        # Create OpenAI client
-        self.client = OpenAI(
-            api_key=api_key,
-            base_url=base_url,
-            timeout=30.0
-        )
+        # Shared per (base_url, api_key): tasks and stages reuse keep-alive connections.
+        self.client = get_openai_client(base_url, api_key)
+
+    def _encode_image(self, image_path: str) -> Tuple[str, str]:
+        """Return the Base64 data URL and the sha256 of the exact bytes sent.
+
+        The image is re-encoded to the current model's pixel/byte budget.
+        """
+        encoded = self.encoder.encode(image_path, self.model)
+        with self._stats_lock:
+            self.payload_stats["raw_bytes"] += encoded.raw_bytes
+        return encoded.data_url, encoded.digest
+
+    def _record_payload(self, messages: list) -> int:
+        """Count the image bytes of one request attempt (data URLs as sent on the wire)."""
+        sent = 0
+        images = 0
+        for message in messages:
+            content = message.get("content")
+            if not isinstance(content, list):
+                continue
+            for part in content:
+                if part.get("type") == "image_url":
+                    sent += len(part["image_url"]["url"])
+                    images += 1
+        with self._stats_lock:
+            self.payload_stats["requests"] += 1
+            self.payload_stats["images"] += images
+            self.payload_stats["bytes_sent"] += sent
+        return sent
 
-    def _encode_image(self, image_path: str) -> str:
-        with open(image_path, "rb") as image_file:
-            base64_data = base64.b64encode(image_file.read()).decode("utf-8")
-            # 返回完整的Base64 Data URL格式
-            return f"data:image/jpeg;base64,{base64_data}"
+    def get_payload_stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self.payload_stats)
+
+    def get_latency_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            latencies = list(self.call_latencies)
+            stats: Dict[str, Any] = {"calls": len(latencies), **self.hedge_stats, **self.rate_stats}
+            stats["rate_limit_wait_s"] = round(stats["rate_limit_wait_s"], 2)
+        for q in (50, 95, 99):
+            value = hedging.percentile(latencies, q)
+            stats[f"p{q}"] = round(value, 3) if value is not None else None
+        return stats
+
+    def _hedge_model(self) -> Optional[str]:
+        """Next model in the priority list to hedge against, if hedging applies."""
+        if not settings.MODEL_HEDGE_ENABLED or self.model not in self.MODEL_PRIORITY:
+            return None
+        idx = self.MODEL_PRIORITY.index(self.model)
+        for model in self.MODEL_PRIORITY[idx + 1:]:
+            if model_router.is_available(self.base_url, model):
+                return model
+        return None
+
+    def _create_completion(self, messages: list, validate: Optional[Callable[[str], Any]] = None) -> Tuple[str, str]:
+        """One model call as (answer, model that answered); 429s are retried on the same model after a backoff."""
+        attempt = 0
+        while True:
+            try:
+                return self._complete_once(messages, validate)
+            except RateLimitError as exc:
+                if attempt >= settings.MODEL_429_MAX_RETRIES:
+                    raise
+                delay = rate_limiter.backoff(self.base_url, self.model, exc, attempt)
+                attempt += 1
+                with self._stats_lock:
+                    self.rate_stats["throttled"] += 1
+                logger.warning(f"模型 {self.model} 触发限流(429)，{delay:.1f}s 后重试 ({attempt}/{settings.MODEL_429_MAX_RETRIES})")
+                time.sleep(delay)
+
+    def _complete_once(self, messages: list, validate: Optional[Callable[[str], Any]] = None) -> Tuple[str, str]:
+        request = {"messages": messages, "max_tokens": 1024, "temperature": 0.2, "top_p": 0.8}
+        estimated = rate_limiter.estimate_tokens(messages, request["max_tokens"])
+        waited = rate_limiter.acquire(self.base_url, self.model, self.task_id, estimated)
+        if waited > 0:
+            with self._stats_lock:
+                self.rate_stats["rate_limit_wait_s"] += waited
+        backup = self._hedge_model()
+        started = time.monotonic()
+        if backup is None:
+            sent = self._record_payload(messages)
+            logger.info(f"使用模型 {self.model} 调用API（图片 {sent} 字节）...")
+            try:
+                response = self.client.chat.completions.create(model=self.model, **request)
+            except RateLimitError:
+                raise
+            except Exception as exc:
+                model_router.record_failure(self.base_url, self.model, exc)
+                raise
+            hedging.record_latency(self.model, time.monotonic() - started)
+            model_router.record_success(self.base_url, self.model, time.monotonic() - started)
+            result = hedging.HedgeResult(self.model, response)
+        else:
+            def _on_send(model: str) -> None:
+                sent = self._record_payload(messages)
+                logger.info(f"使用模型 {model} 调用API（图片 {sent} 字节）...")
+
+            result = hedging.call_hedged(
+                self.base_url,
+                self.api_key,
+                self.model,
+                backup,
+                request,
+                validate=validate,
+                on_send=_on_send,
+                admit=lambda model: rate_limiter.try_acquire(self.base_url, model, estimated),
+            )
+        elapsed = time.monotonic() - started
+        usage = getattr(result.response, "usage", None)
+        if usage is not None:
+            rate_limiter.settle(self.base_url, result.model, estimated, getattr(usage, "total_tokens", 0) or 0)
+        with self._stats_lock:
+            self.call_latencies.append(elapsed)
+            if result.hedged:
+                self.hedge_stats["hedged"] += 1
+                if result.model != self.model:
+                    self.hedge_stats["hedge_wins"] += 1
+            if result.capped:
+                self.hedge_stats["hedges_capped"] += 1
+            if usage is not None:
+                self.payload_stats["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+                self.payload_stats["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+        if result.model != self.model:
+            logger.info(f"对冲请求 {result.model} 先于 {self.model} 返回（{elapsed:.1f}s）")
+        return result.response.choices[0].message.content, result.model
+
+    def _set_model(self, model: str) -> None:
+        self.model = model
+        if model in self.MODEL_PRIORITY:
+            self.model_index = self.MODEL_PRIORITY.index(model)
+
+    def _route(self) -> None:
+        """Pick the model for the next call from the requested model down the priority list."""
+        if self.initial_model in self.MODEL_PRIORITY:
+            candidates = self.MODEL_PRIORITY[self.MODEL_PRIORITY.index(self.initial_model):]
+        else:
+            candidates = [self.initial_model]
+        model = model_router.pick(self.base_url, candidates)
+        if model != self.model:
+            logger.info(f"模型路由：{self.model} -> {model}")
+            self._set_model(model)
 
     def _switch_to_next_model(self) -> bool:
         """切换到下一个优先级的模型"""
-        if self.model_index < len(self.MODEL_PRIORITY) - 1:
-            self.model_index += 1
-            self.model = self.MODEL_PRIORITY[self.model_index]
+        if self.model in self.MODEL_PRIORITY and self.model_index < len(self.MODEL_PRIORITY) - 1:
+            self._set_model(model_router.pick(self.base_url, self.MODEL_PRIORITY[self.model_index + 1:]))
             logger.info(f"切换到下一个模型: {self.model}")
             return True
         return False
 
-    def _call_model(self, messages: list) -> str:
+    def _call_model(self, messages: list, validate: Optional[Callable[[str], Any]] = None) -> Tuple[str, str]:
+        """Call the current model, switching down the priority list on errors.
+
+        Returns (answer, model that answered): a fallback after an error or a
+        won hedge means it need not be the model the call started on. With
+        hedging, ``validate`` decides which of two racing answers wins.
+        """
         retry_count = 0
         max_retries = len(self.MODEL_PRIORITY)
         
         while retry_count < max_retries:
             try:
-                logger.info(f"使用模型 {self.model} 调用API...")
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=1024,
-                    temperature=0.2,
-                    top_p=0.8
-                )
-                return response.choices[0].message.content
+                return self._create_completion(messages, validate)
                 
             except OpenAIError as e:
                 logger.error(f"调用模型 {self.model} 时发生错误: {str(e)}")
@@ -96,29 +305,84 @@ class ModelClient:
         logger.error("已尝试所有模型，均失败")
         raise Exception("已尝试所有模型，均失败")
 
+    def _call_model_cached(
+        self,
+        kind: str,
+        messages: list,
+        prompt: str,
+        image_digest: Union[str, List[str]],
+        validate: Optional[Callable[[str], Any]] = None,
+    ) -> str:
+        """Call the model through the response cache.
+
+        Callers ``_route()`` before encoding the payload, so the key names the
+        model whose budget the images were encoded for. ``validate`` runs on
+        fresh responses before they are stored, so unparsable answers are never
+        cached; neither are answers from another model (fallback or hedge).
+        """
+        if self.cache is None:
+            return self._call_model(messages, validate)[0]
+        model = self.model
+        digests = [image_digest] if isinstance(image_digest, str) else list(image_digest)
+        key = make_cache_key(kind, model, prompt, digests)
+        answered_by = []
+
+        def _compute() -> str:
+            response, answered = self._call_model(messages, validate)
+            answered_by.append(answered)
+            if validate is not None:
+                validate(response)
+            return response
+
+        return self.cache.get_or_compute(
+            key, _compute, kind=kind, model=model, store=lambda: answered_by == [model]
+        )
+
+    @staticmethod
+    def _normalize_focus_result(result: Dict[str, Any]) -> Dict[str, Any]:
+        # Validate the result
+        if "focus_point" not in result:
+            result["focus_point"] = {"x": 0.5, "y": 0.5}
+            result["confidence"] = 0.0
+        
+        # Add default values for new fields
+        if "usable" not in result:
+            result["usable"] = True
+        if "reject_reason" not in result:
+            result["reject_reason"] = None
+        
+        # Normalize coordinates if needed
+        for key in ["focus_point", "bbox"]:
+            if key in result and result[key]:
+                for coord in result[key]:
+                    result[key][coord] = max(0.0, min(1.0, result[key][coord]))
+        return result
+
+    @staticmethod
+    def _failed_focus_result() -> Dict[str, Any]:
+        return {
+            "focus_point": {"x": 0.5, "y": 0.5},
+            "bbox": {"x1": 0.0, "y1": 0.0, "x2": 1.0, "y2": 1.0},
+            "shot_type": "medium",
+            "confidence": 0.0,
+            "usable": False,
+            "reject_reason": "failed_to_call_model",
+            "reason": "failed to call model, using default focus point"
+        }
+
     def get_focus_point(self, image_path: str, retry_hint: Optional[str] = None) -> Dict[str, Any]:
         try:
-            base64_image = self._encode_image(image_path)
-
-            prompt = """Analyze this image and identify the main focus point. Return a JSON object with:
-            - focus_point: {x, y, side} normalized (0-1). side is the square crop ratio based on the short edge.
-            - bbox: optional {x1, y1, x2, y2} normalized bounding box
-            - shot_type: optional "closeup", "medium", or "long"
-            - confidence: 0.0-1.0 confidence score
-            - usable: boolean indicating if the image is clear and usable for training
-            - reject_reason: reason if image is not usable (e.g., too_blurry, subject_not_clear)
-            - reason: short reason for the focus point
+            self._route()
+            base64_image, image_digest = self._encode_image(image_path)
 
-            Crop rule: choose the LARGEST possible square crop. Prefer side=1.0 (use the full short edge).
-            Only reduce side if needed to fully include the main subject.
-            Only return valid JSON, no additional text."""
+            prompt = FOCUS_PROMPT
             if retry_hint:
                 prompt = f"{prompt}\nNOTE: {retry_hint}"
 
             messages = [
                 {
                     "role": "system",
-                    "content": "You are a professional image analyst. Focus on identifying the main subject and its exact position."
+                    "content": FOCUS_SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
@@ -137,43 +401,78 @@ class ModelClient:
                 }
             ]
 
-            response = self._call_model(messages)
-            result = json.loads(response)
-            
-            # Validate the result
-            if "focus_point" not in result:
-                result["focus_point"] = {"x": 0.5, "y": 0.5}
-                result["confidence"] = 0.0
-            
-            # Add default values for new fields
-            if "usable" not in result:
-                result["usable"] = True
-            if "reject_reason" not in result:
-                result["reject_reason"] = None
-            
-            # Normalize coordinates if needed
-            for key in ["focus_point", "bbox"]:
-                if key in result and result[key]:
-                    for coord in result[key]:
-                        result[key][coord] = max(0.0, min(1.0, result[key][coord]))
-            
-            return result
+            response = self._call_model_cached("focus", messages, prompt, image_digest, validate=json.loads)
+            return self._normalize_focus_result(json.loads(response))
         except Exception as e:
             logger.error(f"Failed to get focus point: {str(e)}")
             # 返回默认结果作为回退
-            return {
-                "focus_point": {"x": 0.5, "y": 0.5},
-                "bbox": {"x1": 0.0, "y1": 0.0, "x2": 1.0, "y2": 1.0},
-                "shot_type": "medium",
-                "confidence": 0.0,
-                "usable": False,
-                "reject_reason": "failed_to_call_model",
-                "reason": "failed to call model, using default focus point"
-            }
+            return self._failed_focus_result()
+
+    def get_focus_points(
+        self,
+        image_paths: List[str],
+        validate: Optional[Callable[[int, Dict[str, Any]], bool]] = None,
+    ) -> List[Dict[str, Any]]:
+        """Focus detection for several images in one request.
+
+        The model answers with a JSON array in image order. Elements that are
+        missing, unparsable or rejected by ``validate(index, result)`` are
+        re-requested one image at a time with get_focus_point.
+        """
+        if len(image_paths) == 1:
+            return [self.get_focus_point(image_paths[0])]
+        results: List[Optional[Dict[str, Any]]] = [None] * len(image_paths)
+        try:
+            self._route()
+            encoded = [self._encode_image(path) for path in image_paths]
+            prompt = FOCUS_BATCH_PROMPT.format(count=len(image_paths))
+            content: List[Dict[str, Any]] = [{"type": "text", "text": prompt}]
+            for idx, (data_url, _) in enumerate(encoded):
+                content.append({"type": "text", "text": f"Image {idx + 1}:"})
+                content.append({"type": "image_url", "image_url": {"url": data_url}})
+            messages = [
+                {"role": "system", "content": FOCUS_SYSTEM_PROMPT},
+                {"role": "user", "content": content},
+            ]
+
+            def _validate(answer: str) -> None:
+                # Only cache answers covering every image.
+                if len(_parse_focus_batch(answer)) != len(image_paths):
+                    raise ValueError("focus batch size mismatch")
+
+            response = self._call_model_cached(
+                "focus_batch",
+                messages,
+                prompt,
+                [digest for _, digest in encoded],
+                validate=_validate,
+            )
+            for idx, item in enumerate(_parse_focus_batch(response)[: len(image_paths)]):
+                if not isinstance(item, dict):
+                    continue
+                try:
+                    results[idx] = self._normalize_focus_result(item)
+                except Exception:
+                    # Malformed element: left as None and re-requested alone below.
+                    pass
+        except Exception as e:
+            logger.error(f"批量聚焦请求失败，改为逐张请求: {str(e)}")
+
+        fallback = 0
+        for idx, path in enumerate(image_paths):
+            result = results[idx]
+            if result is not None and (validate is None or validate(idx, result)):
+                continue
+            fallback += 1
+            results[idx] = self.get_focus_point(path)
+        if fallback:
+            logger.info(f"批量聚焦 {len(image_paths)} 张中 {fallback} 张改为单张请求")
+        return results
 
     def generate_tags(self, image_path: str) -> Dict[str, Any]:
         try:
-            base64_image = self._encode_image(image_path)
+            self._route()
+            base64_image, image_digest = self._encode_image(image_path)
 
             prompt = """Return ONLY one-line JSON (no markdown/backticks).
 Task: generate training caption + tags for ONE portrait photo.
@@ -213,7 +512,7 @@ Rules:
                 }
             ]
 
-            response = self._call_model(messages)
+            response = self._call_model_cached("tags", messages, prompt, image_digest, validate=json.loads)
             # 解析JSON响应
             result = json.loads(response)
             return result
@@ -233,7 +532,8 @@ Rules:
         Generate long-form caption text for the final dataset packaging.
         """
         try:
-            base64_image = self._encode_image(image_path)
+            self._route()
+            base64_image, image_digest = self._encode_image(image_path)
             caption_prompt = prompt or DEFAULT_CAPTION_PROMPT
 
             messages = [
@@ -250,7 +550,7 @@ Rules:
                 },
             ]
 
-            response = self._call_model(messages)
+            response = self._call_model_cached("caption", messages, caption_prompt, image_digest)
             return response.strip()
         except Exception as exc:
             logger.error(f"Failed to generate caption: {exc}")
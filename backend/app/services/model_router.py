@@ -0,0 +1,200 @@
+import logging
+import math
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Outcomes kept per model for the success rate.
+_OUTCOME_WINDOW = 50
+# Success rate alone does not open the breaker before this many outcomes.
+_MIN_OUTCOMES = 5
+
+
+class ModelHealth:
+    """Health of one model on one endpoint: success rate, error types, latency EWMA and breaker state."""
+
+    def __init__(self) -> None:
+        self.outcomes: Deque[bool] = deque(maxlen=_OUTCOME_WINDOW)
+        self.errors: Counter = Counter()
+        self.latency_ewma: Optional[float] = None
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probe_started: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def success_rate(self) -> Optional[float]:
+        if not self.outcomes:
+            return None
+        return sum(self.outcomes) / len(self.outcomes)
+
+    def healthy(self) -> bool:
+        return self.state == CLOSED
+
+    def failing(self) -> bool:
+        if self.consecutive_failures >= settings.MODEL_BREAKER_FAILURES:
+            return True
+        if len(self.outcomes) < _MIN_OUTCOMES:
+            return False
+        return (self.success_rate or 0.0) < settings.MODEL_ROUTER_MIN_SUCCESS_RATE
+
+    def cooled_down(self, now: float) -> bool:
+        return now - self.opened_at >= settings.MODEL_BREAKER_COOLDOWN
+
+    def probe_available(self, now: float) -> bool:
+        """One probe at a time once the breaker cooled down; a probe never reported expires."""
+        if self.state == CLOSED or not self.cooled_down(now):
+            return False
+        return self.probe_started is None or now - self.probe_started >= settings.MODEL_BREAKER_COOLDOWN
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        rate = self.success_rate
+        return {
+            "state": self.state,
+            "healthy": self.healthy(),
+            "success_rate": round(rate, 3) if rate is not None else None,
+            "samples": len(self.outcomes),
+            "latency_ewma": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "errors": dict(self.errors),
+            "last_error": self.last_error,
+            "retry_in": (
+                max(0.0, round(settings.MODEL_BREAKER_COOLDOWN - (now - self.opened_at), 1))
+                if self.state != CLOSED
+                else None
+            ),
+        }
+
+
+_LOCK = threading.Lock()
+_HEALTH: Dict[Tuple[str, str], ModelHealth] = {}
+
+
+def _key(base_url: str, model: str) -> Tuple[str, str]:
+    return (base_url or "").rstrip("/"), model
+
+
+def _health(base_url: str, model: str) -> ModelHealth:
+    key = _key(base_url, model)
+    health = _HEALTH.get(key)
+    if health is None:
+        health = _HEALTH[key] = ModelHealth()
+    return health
+
+
+def record_success(base_url: str, model: str, latency: float) -> None:
+    with _LOCK:
+        health = _health(base_url, model)
+        health.outcomes.append(True)
+        alpha = settings.MODEL_ROUTER_EWMA_ALPHA
+        health.latency_ewma = latency if health.latency_ewma is None else alpha * latency + (1 - alpha) * health.latency_ewma
+        health.consecutive_failures = 0
+        health.probe_started = None
+        if health.state != CLOSED:
+            logger.info(f"模型 {model} 探测成功，熔断恢复")
+            health.state = CLOSED
+            # Judge the recovered model on fresh outcomes only.
+            health.outcomes.clear()
+            health.outcomes.append(True)
+
+
+def record_failure(base_url: str, model: str, error: BaseException) -> None:
+    with _LOCK:
+        health = _health(base_url, model)
+        health.outcomes.append(False)
+        health.errors[type(error).__name__] += 1
+        health.last_error = str(error)[:200]
+        health.consecutive_failures += 1
+        health.probe_started = None
+        if health.state == HALF_OPEN or (health.state == CLOSED and health.failing()):
+            logger.warning(
+                f"模型 {model} 失败（连续 {health.consecutive_failures} 次，成功率 {health.success_rate:.2f}），"
+                f"熔断 {settings.MODEL_BREAKER_COOLDOWN:.0f}s"
+            )
+            health.state = OPEN
+            health.opened_at = time.monotonic()
+
+
+def is_available(base_url: str, model: str) -> bool:
+    """Breaker closed; does not take a half-open probe."""
+    with _LOCK:
+        health = _HEALTH.get(_key(base_url, model))
+        return health is None or health.healthy()
+
+
+def _ranked(base_url: str, models: List[str]) -> List[str]:
+    """Closed-breaker models, healthiest first.
+
+    Success rate counts in steps of 0.1 (1.0 until enough outcomes are seen);
+    then latency EWMA in factor-of-two bands above the fastest model, so
+    small latency differences do not override the priority order, which
+    breaks the remaining ties. Models without samples rank like the best.
+    """
+    candidates = []
+    for index, model in enumerate(models):
+        health = _HEALTH.get(_key(base_url, model))
+        if health is None or health.healthy():
+            candidates.append((index, model, health))
+    latencies = [h.latency_ewma for _, _, h in candidates if h is not None and h.latency_ewma]
+    fastest = min(latencies) if latencies else None
+
+    def _rank(item):
+        index, _, health = item
+        rate = 1.0
+        band = 0
+        if health is not None:
+            if len(health.outcomes) >= _MIN_OUTCOMES:
+                rate = health.success_rate or 0.0
+            if health.latency_ewma and fastest:
+                band = int(math.log2(health.latency_ewma / fastest))
+        return (-math.floor(rate * 10 + 1e-9), band, index)
+
+    return [model for _, model, _ in sorted(candidates, key=_rank)]
+
+
+def pick(base_url: str, models: List[str]) -> str:
+    """Choose the model to call from ``models`` (in priority order).
+
+    The healthiest model with a closed breaker wins (see ``_ranked``). A model
+    whose breaker has cooled down and that comes before every closed model in
+    priority order is picked as the half-open probe, one caller at a time.
+    When nothing is eligible a model is still returned rather than failing outright.
+    """
+    if not settings.MODEL_ROUTER_ENABLED or len(models) <= 1:
+        return models[0]
+    now = time.monotonic()
+    with _LOCK:
+        for model in models:
+            health = _HEALTH.get(_key(base_url, model))
+            if health is None or health.healthy():
+                break
+            if health.probe_available(now):
+                health.state = HALF_OPEN
+                health.probe_started = now
+                logger.info(f"模型 {model} 熔断冷却结束，发送探测请求")
+                return model
+
+        ranked = _ranked(base_url, models)
+        if ranked:
+            return ranked[0]
+        # Every breaker is open: use the one that opened first (closest to its probe).
+        return min(models, key=lambda model: _health(base_url, model).opened_at)
+
+
+def snapshot() -> List[Dict[str, Any]]:
+    now = time.monotonic()
+    with _LOCK:
+        return [
+            {"base_url": base_url, "model": model, **health.snapshot(now)}
+            for (base_url, model), health in sorted(_HEALTH.items())
+        ]
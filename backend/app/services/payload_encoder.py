@@ -0,0 +1,123 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from PIL import Image as PILImage
+
+from app.core.config import settings
+from app.services.image_source import read_image_bytes, source_signature
+
+# JPEG qualities tried in order before shrinking the image further.
+_QUALITY_STEPS = (85, 75, 65)
+_SHRINK_FACTOR = 0.8
+_MIN_SIDE = 256
+
+
+@dataclass(frozen=True)
+class ImageBudget:
+    max_side: int
+    max_bytes: int
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    data_url: str
+    digest: str
+    nbytes: int
+    raw_bytes: int
+    width: int
+    height: int
+
+
+def budget_for_model(model: str) -> ImageBudget:
+    """Pixel/byte budget for a model; MODEL_IMAGE_BUDGETS overrides the defaults per model name."""
+    override = settings.MODEL_IMAGE_BUDGETS.get(model) or {}
+    return ImageBudget(
+        max_side=int(override.get("max_side", settings.MODEL_IMAGE_MAX_SIDE)),
+        max_bytes=int(override.get("max_bytes", settings.MODEL_IMAGE_MAX_KB * 1024)),
+    )
+
+
+def _jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    try:
+        with PILImage.open(io.BytesIO(data)) as img:
+            if img.format != "JPEG":
+                return None
+            return img.size
+    except Exception:
+        return None
+
+
+def encode_image(data: bytes, budget: ImageBudget) -> Tuple[bytes, int, int]:
+    """Re-encode ``data`` as JPEG within ``budget``; JPEGs already inside it pass through."""
+    size = _jpeg_size(data)
+    if size is not None and max(size) <= budget.max_side and len(data) <= budget.max_bytes:
+        return data, size[0], size[1]
+
+    with PILImage.open(io.BytesIO(data)) as img:
+        width, height = img.size
+        long_side = max(1, width, height)
+        side = min(budget.max_side, long_side)
+        img.draft("RGB", (max(1, width * side // long_side), max(1, height * side // long_side)))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        best = None
+        while True:
+            target = (max(1, round(width * side / long_side)), max(1, round(height * side / long_side)))
+            resized = img if img.size == target else img.resize(target, PILImage.LANCZOS, reducing_gap=3.0)
+            for quality in _QUALITY_STEPS:
+                buf = io.BytesIO()
+                resized.save(buf, "JPEG", quality=quality)
+                best = (buf.getvalue(), target[0], target[1])
+                if len(best[0]) <= budget.max_bytes:
+                    return best
+            if side <= _MIN_SIDE:
+                # Smallest allowed size still over budget: send the last attempt.
+                return best
+            side = max(_MIN_SIDE, int(side * _SHRINK_FACTOR))
+
+
+class PayloadEncoder:
+    """Per-client cache of budget-encoded data URLs.
+
+    Entries are keyed by the source file signature and budget, so retries of
+    the same image reuse the encoded payload while edited files are re-encoded.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[tuple, EncodedImage]" = OrderedDict()
+
+    def encode(self, image_path: str, model: str) -> EncodedImage:
+        budget = budget_for_model(model)
+        key = (os.path.abspath(image_path), tuple(source_signature(image_path) or ()), budget)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+        raw = read_image_bytes(image_path)
+        data, width, height = encode_image(raw, budget)
+        encoded = EncodedImage(
+            data_url=f"data:image/jpeg;base64,{base64.b64encode(data).decode('utf-8')}",
+            digest=hashlib.sha256(data).hexdigest(),
+            nbytes=len(data),
+            raw_bytes=len(raw),
+            width=width,
+            height=height,
+        )
+        with self._lock:
+            self._cache[key] = encoded
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return encoded
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
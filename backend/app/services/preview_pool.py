@@ -0,0 +1,147 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+_POOL_LOCK = threading.Lock()
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_SIZE = 0
+
+
+def preview_workers() -> int:
+    """Worker processes for preview rendering; PREVIEW_WORKERS=0 uses every core."""
+    configured = settings.PREVIEW_WORKERS
+    if configured and configured > 0:
+        return configured
+    return max(1, os.cpu_count() or 1)
+
+
+def _init_worker(max_image_pixels: int) -> None:
+    from PIL import Image as PILImage
+    from PIL import ImageFile
+
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    PILImage.MAX_IMAGE_PIXELS = max_image_pixels
+
+
+def _render(
+    image_path: str,
+    output_dir: str,
+    max_side: int,
+    quality: int,
+    pyramid_dir: Optional[str],
+    pyramid_levels: Tuple[int, ...],
+) -> Tuple[str, int, int, List[int]]:
+    from app.services.image_processing import render_preview
+
+    return render_preview(
+        image_path,
+        output_dir,
+        max_side=max_side,
+        quality=quality,
+        pyramid_dir=pyramid_dir,
+        pyramid_levels=pyramid_levels,
+    )
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _POOL, _POOL_SIZE
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL_SIZE = preview_workers()
+            # spawn: forking a process that holds DB connections and model threads is unsafe.
+            _POOL = ProcessPoolExecutor(
+                max_workers=_POOL_SIZE,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(settings.MAX_IMAGE_PIXELS,),
+            )
+        return _POOL
+
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is pool:
+            _POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_preview_pool() -> None:
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_previews(
+    paths: List[str],
+    output_dir: str,
+    max_side: int,
+    quality: int,
+    pyramid_dir: Optional[str] = None,
+    pyramid_levels: Tuple[int, ...] = (),
+    admit: Optional[Callable[[str], Any]] = None,
+) -> Iterator[Tuple[str, Optional[Tuple[str, int, int, List[int]]], Optional[BaseException]]]:
+    """Render previews in the shared process pool, yielding (path, result, error) as they finish.
+
+    The pool is shared by all tasks, so concurrent tasks split the CPU budget
+    instead of each claiming every core. Only a bounded window is queued per
+    call; closing the iterator (e.g. on cancel) drops the rest. ``admit(path)``
+    reserves decode memory before a path is queued and the reservation is
+    released when its render finishes; None stops queueing further paths.
+    """
+    if not paths:
+        return
+    pool = _get_pool()
+    window = max(2, _POOL_SIZE * 2)
+    render_args = (output_dir, max_side, quality, pyramid_dir, tuple(pyramid_levels))
+    pending: Dict[Future, str] = {}
+    next_idx = 0
+    try:
+        while next_idx < len(paths) or pending:
+            while next_idx < len(paths) and len(pending) < window:
+                path = paths[next_idx]
+                next_idx += 1
+                reservation = admit(path) if admit is not None else None
+                if admit is not None and reservation is None:
+                    next_idx = len(paths)
+                    break
+                try:
+                    try:
+                        future = pool.submit(_render, path, *render_args)
+                    except BrokenProcessPool:
+                        _discard_pool(pool)
+                        pool = _get_pool()
+                        future = pool.submit(_render, path, *render_args)
+                except BaseException:
+                    if reservation is not None:
+                        reservation.release()
+                    raise
+                if reservation is not None:
+                    future.add_done_callback(lambda _, r=reservation: r.release())
+                pending[future] = path
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    yield path, future.result(), None
+                except BrokenProcessPool as exc:
+                    logger.error(f"预览进程池异常，重建进程池: {exc}")
+                    _discard_pool(pool)
+                    yield path, None, exc
+                except Exception as exc:  # noqa: BLE001
+                    yield path, None, exc
+    finally:
+        for future in pending:
+            future.cancel()
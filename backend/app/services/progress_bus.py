@@ -0,0 +1,232 @@
+"""In-process publish/subscribe of task progress for the SSE endpoints.
+
+Committed changes to a task's status, stage, progress, message, stats or
+export readiness are published from the ORM (``after_commit``); pipeline loops
+also publish per-image progress directly, ahead of the throttled database
+checkpoint. Subscribers await the next event instead of polling the table.
+
+Each event carries only the fields that changed and a process-wide sequence
+number; the latest state of every task seen is kept for new subscribers.
+With ``WORKER_MODE=queue`` the pipeline runs in other processes, so one
+watcher thread per API process reads changed task rows while anyone is
+subscribed and publishes them here.
+"""
+import asyncio
+import copy
+import enum
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.models.task import Task
+
+logger = logging.getLogger(__name__)
+
+# Task columns published to subscribers.
+TRACKED = ("status", "stage", "progress", "message", "stats", "export_ready")
+
+_PENDING = "progress_events"
+
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (dict, list)):
+        # Callers keep mutating their dicts in place (e.g. task.stats).
+        return copy.deepcopy(value)
+    return value
+
+
+def task_fields(task: Task, names=TRACKED) -> Dict[str, Any]:
+    fields = {}
+    for name in names:
+        fields[name] = _plain(getattr(task, name))
+    return fields
+
+
+class ProgressBus:
+    def __init__(self, history: int = 1000):
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.states: Dict[int, Dict[str, Any]] = {}
+        self.events: Deque[Tuple[int, int, Dict[str, Any]]] = deque(maxlen=history)
+        self.waiters: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    def publish(self, task_id: int, fields: Dict[str, Any]) -> None:
+        """Record the fields that differ from the task's last state and wake subscribers."""
+        with self.lock:
+            state = self.states.setdefault(task_id, {"id": task_id})
+            delta = {key: _plain(value) for key, value in fields.items() if key not in state or state[key] != value}
+            if not delta:
+                return
+            state.update(delta)
+            self.seq += 1
+            self.events.append((self.seq, task_id, delta))
+            waiters = list(self.waiters)
+        self._wake(waiters)
+
+    def remove(self, task_ids: Optional[Iterable[int]] = None) -> None:
+        """Publish the deletion of tasks (every known task when None) and forget their state."""
+        with self.lock:
+            ids = list(self.states) if task_ids is None else list(task_ids)
+            for task_id in ids:
+                self.states.pop(task_id, None)
+                self.seq += 1
+                self.events.append((self.seq, task_id, {"deleted": True}))
+            waiters = list(self.waiters) if ids else []
+        self._wake(waiters)
+
+    @staticmethod
+    def _wake(waiters) -> None:
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(waiter.set)
+            except RuntimeError:
+                # The subscriber's event loop is already closed.
+                pass
+
+    def seed(self, task_id: int, fields: Dict[str, Any]) -> None:
+        """Fill in fields not yet known for a task (from the database) without publishing."""
+        with self.lock:
+            state = self.states.setdefault(task_id, {"id": task_id})
+            for key, value in fields.items():
+                state.setdefault(key, _plain(value))
+
+    def state(self, task_id: int) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            state = self.states.get(task_id)
+            return copy.deepcopy(state) if state is not None else None
+
+    def current_seq(self) -> int:
+        with self.lock:
+            return self.seq
+
+    def since(self, seq: int) -> Tuple[int, Optional[List[Tuple[int, int, Dict[str, Any]]]]]:
+        """(latest seq, events after ``seq``); None when some of them already left the history."""
+        with self.lock:
+            if seq >= self.seq:
+                return self.seq, []
+            if not self.events or self.events[0][0] > seq + 1:
+                return self.seq, None
+            return self.seq, [copy.deepcopy(item) for item in self.events if item[0] > seq]
+
+    async def wait(self, seq: int, timeout: float) -> int:
+        """Wait until an event after ``seq`` is published (or ``timeout``); returns the latest seq."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            if self.seq > seq:
+                return self.seq
+            self.waiters.add(waiter)
+        _watcher.ensure_running()
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
+        return self.current_seq()
+
+    def subscribed(self) -> bool:
+        with self.lock:
+            return bool(self.waiters)
+
+
+_BUS = ProgressBus()
+
+
+def get_bus() -> ProgressBus:
+    return _BUS
+
+
+def publish(task_id: int, **fields: Any) -> None:
+    _BUS.publish(task_id, fields)
+
+
+def removed(task_ids: Optional[Iterable[int]] = None) -> None:
+    """Announce deleted tasks (all known tasks when None); bulk deletes bypass the ORM hook."""
+    _BUS.remove(task_ids)
+
+
+class _DatabaseWatcher:
+    """Queue mode: publish task rows whose version changed, while anyone is subscribed."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.versions: Dict[int, int] = {}
+
+    def ensure_running(self) -> None:
+        if settings.WORKER_MODE != "queue":
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="progress-watcher", daemon=True)
+                self.thread.start()
+
+    def _run(self) -> None:
+        from app.db.database import SessionLocal
+
+        while True:
+            with self.lock:
+                # Checked under the lock ensure_running() takes, so a new subscriber restarts the thread.
+                if not _BUS.subscribed():
+                    self.thread = None
+                    return
+            db = SessionLocal()
+            try:
+                rows = db.query(Task.id, Task.version).all()
+                changed = [task_id for task_id, version in rows if self.versions.get(task_id) != version]
+                gone = self.versions.keys() - {task_id for task_id, _ in rows}
+                self.versions = dict(rows)
+                if gone:
+                    _BUS.remove(gone)
+                for start in range(0, len(changed), 500):
+                    for task in db.query(Task).filter(Task.id.in_(changed[start:start + 500])):
+                        _BUS.publish(task.id, task_fields(task))
+            except Exception as exc:  # noqa: BLE001
+                logger.warning(f"任务进度读取失败: {exc}")
+            finally:
+                db.close()
+            time.sleep(settings.JOB_POLL_INTERVAL)
+
+
+_watcher = _DatabaseWatcher()
+
+
+@event.listens_for(Session, "after_flush")
+def _collect(session, flush_context) -> None:
+    # Still the pre-flush state here: new/dirty lists and attribute history are intact.
+    pending = session.info.setdefault(_PENDING, {})
+    for obj in session.deleted:
+        if isinstance(obj, Task):
+            pending[obj.id] = None
+    for obj in session.new:
+        if isinstance(obj, Task):
+            pending.setdefault(obj.id, {}).update(task_fields(obj))
+    for obj in session.dirty:
+        if isinstance(obj, Task):
+            attrs = inspect(obj).attrs
+            changed = [name for name in TRACKED if attrs[name].history.has_changes()]
+            if changed and pending.get(obj.id, {}) is not None:
+                pending.setdefault(obj.id, {}).update(task_fields(obj, changed))
+
+
+@event.listens_for(Session, "after_commit")
+def _publish(session) -> None:
+    for task_id, fields in session.info.pop(_PENDING, {}).items():
+        if fields is None:
+            _BUS.remove([task_id])
+        else:
+            _BUS.publish(task_id, fields)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard(session) -> None:
+    session.info.pop(_PENDING, None)
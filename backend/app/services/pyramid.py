@@ -0,0 +1,94 @@
+import hashlib
+import os
+from typing import Iterable, List, Optional, Tuple
+
+from PIL import Image as PILImage
+
+# Long-side sizes kept per image: grid thumbnails, dedup thumbnails, face analysis, recrop proxy.
+PYRAMID_LEVELS = (256, 512, 1024, 2048)
+
+_ORIENTATION_TAG = 0x0112
+
+
+def pyramid_dir(task_id: int) -> str:
+    return os.path.join(f"./data/tasks/{task_id}", "pyramid")
+
+
+def level_path(directory: str, orig_path: str, level: int) -> str:
+    digest = hashlib.sha1(os.path.abspath(orig_path).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(directory, f"{digest}_{level}.jpg")
+
+
+def _orientation_exif(orientation: Optional[int]) -> Optional[PILImage.Exif]:
+    if not orientation or orientation == 1:
+        return None
+    exif = PILImage.Exif()
+    exif[_ORIENTATION_TAG] = orientation
+    return exif
+
+
+def levels_below(long_side: int, levels: Iterable[int] = PYRAMID_LEVELS) -> List[int]:
+    """Levels strictly smaller than the original; larger requests go to the original."""
+    return sorted({int(level) for level in levels if int(level) < long_side})
+
+
+def write_levels(
+    img: PILImage.Image,
+    orig_path: str,
+    directory: str,
+    levels: Iterable[int],
+    orientation: Optional[int] = None,
+    quality: int = 90,
+) -> List[int]:
+    """Write every requested level from an already decoded RGB image, largest first.
+
+    Each level is resized from the previous one, so the original is decoded
+    once. Pixels stay in the original (un-rotated) orientation and the EXIF
+    orientation tag is carried over, matching crop coordinates on the original.
+    """
+    os.makedirs(directory, exist_ok=True)
+    exif = _orientation_exif(orientation)
+    written = []
+    current = img
+    for level in sorted(levels, reverse=True):
+        scale = level / max(current.size)
+        if scale < 1:
+            current = current.resize(
+                (max(1, round(current.width * scale)), max(1, round(current.height * scale))),
+                PILImage.LANCZOS,
+                reducing_gap=3.0,
+            )
+        path = level_path(directory, orig_path, level)
+        tmp_path = f"{path}.tmp"
+        if exif is not None:
+            current.save(tmp_path, "JPEG", quality=quality, exif=exif)
+        else:
+            current.save(tmp_path, "JPEG", quality=quality)
+        os.replace(tmp_path, path)
+        written.append(level)
+    return sorted(written)
+
+
+def smallest_level(
+    image, min_long: Optional[int] = None, min_short: Optional[int] = None, verify: bool = True
+) -> Tuple[str, Optional[int]]:
+    """Return (path, level) of the smallest stored level covering the requested size.
+
+    ``min_long``/``min_short`` are pixel sizes for the long/short edge. Falls
+    back to ``(orig_path, None)`` when no level is large enough. ``verify=False``
+    trusts the levels recorded in meta_json instead of checking the files.
+    """
+    levels = ((image.meta_json or {}).get("pyramid") or {}).get("levels") or []
+    width, height = image.width or 0, image.height or 0
+    if levels and width > 0 and height > 0:
+        long_side, short_side = max(width, height), min(width, height)
+        directory = pyramid_dir(image.task_id)
+        for level in sorted(levels):
+            if min_long is not None and level < min_long:
+                continue
+            if min_short is not None and short_side * level / long_side < min_short - 0.5:
+                continue
+            path = level_path(directory, image.orig_path, level)
+            if not verify or os.path.exists(path):
+                return path, level
+    return image.orig_path, None
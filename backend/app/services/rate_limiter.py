@@ -0,0 +1,269 @@
+import email.utils
+import itertools
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+# Upper bound on a single wait so refills and cancellations are noticed.
+_MAX_WAIT_SLICE = 1.0
+# Rough prompt tokens per image at the default 1024px payload budget.
+IMAGE_TOKEN_ESTIMATE = 1280
+
+
+def _limits_for(model: str) -> Tuple[int, int]:
+    override = settings.MODEL_RATE_LIMITS.get(model) or {}
+    rpm = int(override.get("rpm", settings.MODEL_RATE_LIMIT_RPM) or 0)
+    tpm = int(override.get("tpm", settings.MODEL_RATE_LIMIT_TPM) or 0)
+    return max(0, rpm), max(0, tpm)
+
+
+def estimate_tokens(messages: list, max_tokens: int) -> int:
+    """Prompt + completion token estimate used to reserve tokens-per-minute budget."""
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                images += 1
+            else:
+                chars += len(part.get("text") or "")
+    return chars // 4 + images * IMAGE_TOKEN_ESTIMATE + max_tokens
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Retry-After (or retry-after-ms) from a 429 response, in seconds."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000.0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+class _Ticket:
+    __slots__ = ("seq", "task")
+
+    def __init__(self, seq: int, task: Any):
+        self.seq = seq
+        self.task = task
+
+
+class TokenBucket:
+    """Requests/min and tokens/min buckets for one (base_url, model), served fairly across tasks.
+
+    Waiters queue per task; capacity goes to the waiting task that was served
+    least recently, so a task with many queued calls cannot starve others.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.cond = threading.Condition()
+        self.waiting: Dict[Any, Deque[_Ticket]] = {}
+        self.last_served: Dict[Any, float] = {}
+        self.stats = {
+            "granted": 0,
+            "waited": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "max_queue_depth": 0,
+            "throttled": 0,
+            "hedges_rejected": 0,
+        }
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(0.0, now - self.updated)
+        self.updated = now
+        if self.rpm:
+            self.requests = min(float(self.rpm), self.requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self.tokens = min(float(self.tpm), self.tokens + elapsed * self.tpm / 60.0)
+
+    def _need(self, tokens: int) -> int:
+        # A single call larger than the whole budget waits for a full bucket instead of forever.
+        return min(tokens, self.tpm) if self.tpm else 0
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        wait = self.blocked_until - now
+        if self.rpm and self.requests < 1.0:
+            wait = max(wait, (1.0 - self.requests) * 60.0 / self.rpm)
+        need = self._need(tokens)
+        if self.tpm and self.tokens < need:
+            wait = max(wait, (need - self.tokens) * 60.0 / self.tpm)
+        return wait
+
+    def _consume(self, tokens: int) -> None:
+        if self.rpm:
+            self.requests -= 1.0
+        if self.tpm:
+            self.tokens -= self._need(tokens)
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        if not self.waiting:
+            return None
+        task = min(self.waiting, key=lambda t: (self.last_served.get(t, 0.0), self.waiting[t][0].seq))
+        return self.waiting[task][0]
+
+    def queue_depth(self) -> int:
+        return sum(len(q) for q in self.waiting.values())
+
+    def acquire(self, task: Any, tokens: int, seq: int) -> float:
+        """Block until this call may be sent; returns the seconds waited."""
+        ticket = _Ticket(seq, task)
+        started = time.monotonic()
+        with self.cond:
+            self.waiting.setdefault(task, deque()).append(ticket)
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.queue_depth())
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    timeout = _MAX_WAIT_SLICE
+                    if self._next_ticket() is ticket:
+                        wait = self._wait_time(tokens, now)
+                        if wait <= 0:
+                            self._consume(tokens)
+                            break
+                        timeout = min(timeout, wait)
+                    self.cond.wait(timeout=timeout)
+            finally:
+                queue = self.waiting.get(task)
+                if queue is not None:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self.waiting[task]
+                self.last_served[task] = time.monotonic()
+                self.cond.notify_all()
+            waited = time.monotonic() - started
+            self.stats["granted"] += 1
+            if waited > 0.01:
+                self.stats["waited"] += 1
+            self.stats["wait_seconds"] += waited
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+        return waited
+
+    def try_acquire(self, tokens: int) -> bool:
+        """Take capacity only if nobody is queued and it is available right now."""
+        with self.cond:
+            now = time.monotonic()
+            self._refill(now)
+            if self.waiting or self._wait_time(tokens, now) > 0:
+                self.stats["hedges_rejected"] += 1
+                return False
+            self._consume(tokens)
+            self.stats["granted"] += 1
+            return True
+
+    def settle(self, estimated: int, actual: int) -> None:
+        """Correct the token reservation once the response reports real usage."""
+        if not self.tpm or actual <= 0:
+            return
+        with self.cond:
+            self.tokens = max(-float(self.tpm), self.tokens - (actual - self._need(estimated)))
+
+    def throttle(self, delay: float) -> None:
+        with self.cond:
+            self.stats["throttled"] += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            self.requests = min(self.requests, 0.0)
+            self.cond.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.cond:
+            now = time.monotonic()
+            self._refill(now)
+            granted = self.stats["granted"]
+            return {
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "queue_depth": self.queue_depth(),
+                "waiting_tasks": len(self.waiting),
+                "available_requests": round(self.requests, 2) if self.rpm else None,
+                "available_tokens": int(self.tokens) if self.tpm else None,
+                "blocked_for": round(max(0.0, self.blocked_until - now), 1),
+                **{k: round(v, 3) if isinstance(v, float) else v for k, v in self.stats.items()},
+                "avg_wait_seconds": round(self.stats["wait_seconds"] / granted, 3) if granted else 0.0,
+            }
+
+
+_LOCK = threading.Lock()
+_BUCKETS: Dict[Tuple[str, str], TokenBucket] = {}
+_SEQ = itertools.count()
+
+
+def _bucket(base_url: str, model: str) -> Optional[TokenBucket]:
+    key = ((base_url or "").rstrip("/"), model)
+    with _LOCK:
+        bucket = _BUCKETS.get(key)
+        if bucket is None:
+            rpm, tpm = _limits_for(model)
+            bucket = _BUCKETS[key] = TokenBucket(rpm, tpm)
+        return bucket
+
+
+def acquire(base_url: str, model: str, task: Any, tokens: int) -> float:
+    """Wait for rate-limit capacity for one call; ``task`` is the fairness key (task id)."""
+    if not settings.MODEL_RATE_LIMIT_ENABLED:
+        return 0.0
+    return _bucket(base_url, model).acquire(task, tokens, next(_SEQ))
+
+
+def try_acquire(base_url: str, model: str, tokens: int) -> bool:
+    if not settings.MODEL_RATE_LIMIT_ENABLED:
+        return True
+    return _bucket(base_url, model).try_acquire(tokens)
+
+
+def settle(base_url: str, model: str, estimated: int, actual: int) -> None:
+    if settings.MODEL_RATE_LIMIT_ENABLED:
+        _bucket(base_url, model).settle(estimated, actual)
+
+
+def backoff(base_url: str, model: str, error: BaseException, attempt: int) -> float:
+    """Pause the (base_url, model) bucket after a 429 and return the delay.
+
+    Uses the server's Retry-After when given, otherwise an exponential delay
+    with jitter so throttled callers do not retry in lockstep.
+    """
+    cap = min(settings.MODEL_429_BACKOFF_MAX, settings.MODEL_429_BACKOFF_BASE * (2 ** attempt))
+    delay = cap / 2 + random.uniform(0, cap / 2)
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, settings.MODEL_429_BACKOFF_MAX))
+    if settings.MODEL_RATE_LIMIT_ENABLED:
+        _bucket(base_url, model).throttle(delay)
+    return delay
+
+
+def snapshot() -> List[Dict[str, Any]]:
+    with _LOCK:
+        items = sorted(_BUCKETS.items())
+    return [{"base_url": base_url, "model": model, **bucket.snapshot()} for (base_url, model), bucket in items]
@@ -0,0 +1,221 @@
+import functools
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image as PILImage
+
+from app.core.config import settings
+from app.db.database import SessionLocal
+from app.models.image import Image
+from app.models.task import Task
+from app.services import memory_budget
+from app.services.image_processing import (
+    clamp_output_size,
+    compute_crop_box,
+    crop_1024_from_original,
+    crop_decode_side,
+    crop_output_path,
+    save_working_proxy,
+)
+from app.services.image_source import open_image_file
+from app.services.pyramid import smallest_level
+
+logger = logging.getLogger(__name__)
+
+# Decoded working proxies, most recently used last.
+_PROXY_LOCK = threading.Lock()
+_PROXY_CACHE: "OrderedDict[str, Tuple[int, PILImage.Image]]" = OrderedDict()
+_PROXY_CACHE_BYTES = 0
+
+# _STATE_LOCKS guard crop_path/crop_render updates; _RENDER_LOCKS serialize full-res renders.
+_LOCKS_GUARD = threading.Lock()
+_STATE_LOCKS: Dict[int, threading.Lock] = {}
+_RENDER_LOCKS: Dict[int, threading.Lock] = {}
+
+_FINAL_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, settings.RECROP_RENDER_WORKERS))
+
+
+def _lock_for(locks: Dict[int, threading.Lock], image_id: int) -> threading.Lock:
+    with _LOCKS_GUARD:
+        lock = locks.get(image_id)
+        if lock is None:
+            lock = locks[image_id] = threading.Lock()
+        return lock
+
+
+def proxy_path_for(task_id: int, image_id: int) -> str:
+    return os.path.join(f"./data/tasks/{task_id}", "proxies", f"{image_id}.jpg")
+
+
+def _cache_proxy(path: str, mtime_ns: int, proxy: PILImage.Image) -> None:
+    global _PROXY_CACHE_BYTES
+    limit = settings.RECROP_PROXY_CACHE_MB * 1024 * 1024
+    size = proxy.width * proxy.height * len(proxy.getbands())
+    with _PROXY_LOCK:
+        old = _PROXY_CACHE.pop(path, None)
+        if old is not None:
+            _PROXY_CACHE_BYTES -= old[1].width * old[1].height * len(old[1].getbands())
+        _PROXY_CACHE[path] = (mtime_ns, proxy)
+        _PROXY_CACHE_BYTES += size
+        while _PROXY_CACHE_BYTES > limit and len(_PROXY_CACHE) > 1:
+            _, (_, evicted) = _PROXY_CACHE.popitem(last=False)
+            _PROXY_CACHE_BYTES -= evicted.width * evicted.height * len(evicted.getbands())
+
+
+def pyramid_proxy_path(image: Image, output_size: int) -> Optional[str]:
+    """Pyramid level usable as working proxy (short edge >= 2x output), if stored."""
+    path, level = smallest_level(image, min_short=clamp_output_size(output_size) * 2)
+    return path if level is not None else None
+
+
+def load_working_proxy(task_id: int, image: Image, output_size: int) -> PILImage.Image:
+    """Return the decoded working proxy: a pyramid level, else a proxy built from the original on first use."""
+    path = pyramid_proxy_path(image, output_size) or proxy_path_for(task_id, image.id)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open_image_file(image.orig_path) as fp, PILImage.open(fp) as img, memory_budget.admit(
+            img, crop_decode_side(img.size, 1.0, clamp_output_size(output_size), proxy=True), task_id=task_id
+        ):
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            save_working_proxy(img, path, output_size)
+    mtime_ns = os.stat(path).st_mtime_ns
+    with _PROXY_LOCK:
+        cached = _PROXY_CACHE.get(path)
+        if cached is not None and cached[0] == mtime_ns:
+            _PROXY_CACHE.move_to_end(path)
+            return cached[1]
+    with PILImage.open(path) as img:
+        proxy = img.convert("RGB")
+    _cache_proxy(path, mtime_ns, proxy)
+    return proxy
+
+
+def apply_user_crop(db, task: Task, image: Image, crop_square: dict, output_size: int) -> dict:
+    """Render the user's crop from the working proxy and queue the full-res render.
+
+    Returns the stored ``crop_render`` state; its version increases with every
+    call so a slower render of an older crop is never materialized.
+    """
+    cx = crop_square.get("cx", 0.5)
+    cy = crop_square.get("cy", 0.5)
+    side = crop_square.get("side", 1.0)
+    size = clamp_output_size(output_size)
+    proxy = load_working_proxy(task.id, image, size)
+    cropped = proxy.crop(compute_crop_box(proxy.width, proxy.height, cx, cy, side))
+    cropped = cropped.resize((size, size), PILImage.LANCZOS)
+
+    images_dir = os.path.join(f"./data/tasks/{task.id}", "crops", "images")
+    os.makedirs(images_dir, exist_ok=True)
+    with _lock_for(_STATE_LOCKS, image.id):
+        db.refresh(image)
+        crop_path = image.crop_path or crop_output_path(image.orig_path, images_dir)
+        meta = image.meta_json or {}
+        version = int((meta.get("crop_render") or {}).get("version", 0)) + 1
+        tmp_path = f"{crop_path}.proxy.tmp"
+        cropped.save(tmp_path, "JPEG", quality=90)
+        os.replace(tmp_path, crop_path)
+        meta["crop_square_user"] = {"cx": cx, "cy": cy, "side": side, "source": crop_square.get("source", "user")}
+        meta["crop_render"] = {"version": version, "final": False, "output_size": size}
+        image.meta_json = meta
+        image.crop_path = crop_path
+        db.commit()
+    _FINAL_EXECUTOR.submit(_render_final_safe, image.id, version)
+    return dict(meta["crop_render"])
+
+
+def _render_final_safe(image_id: int, version: int) -> None:
+    try:
+        render_final(image_id, version)
+    except Exception as exc:  # noqa: BLE001
+        logger.error(f"全分辨率裁切渲染失败 image={image_id}: {exc}")
+
+
+def render_final(image_id: int, version: Optional[int] = None) -> bool:
+    """Render the full-resolution crop for the latest user crop of an image.
+
+    With ``version`` the render is skipped once a newer crop has been saved.
+    Returns True when a final crop was written.
+    """
+    with _lock_for(_RENDER_LOCKS, image_id):
+        db = SessionLocal()
+        try:
+            image = db.query(Image).filter(Image.id == image_id).first()
+            if not image or not image.crop_path:
+                return False
+            meta = image.meta_json or {}
+            render = meta.get("crop_render") or {}
+            user = meta.get("crop_square_user") or {}
+            if not render or render.get("final"):
+                return False
+            if version is not None and render.get("version") != version:
+                return False
+            version = render.get("version")
+            tmp_path = f"{image.crop_path}.v{version}.tmp"
+            crop_1024_from_original(
+                image.orig_path,
+                user.get("cx", 0.5),
+                user.get("cy", 0.5),
+                os.path.dirname(image.crop_path),
+                quality=95,
+                side=user.get("side", 1.0),
+                output_size=render.get("output_size"),
+                output_path=tmp_path,
+                admit=functools.partial(memory_budget.admit, task_id=image.task_id),
+            )
+            with _lock_for(_STATE_LOCKS, image_id):
+                db.refresh(image)
+                meta = image.meta_json or {}
+                current = meta.get("crop_render") or {}
+                if current.get("version") != version or current.get("final"):
+                    os.remove(tmp_path)
+                    return False
+                os.replace(tmp_path, image.crop_path)
+                meta["crop_render"] = {**current, "final": True}
+                image.meta_json = meta
+                db.commit()
+            task = db.query(Task).filter(Task.id == image.task_id).first()
+            if task:
+                from app.tasks.processing import refresh_export
+
+                refresh_export(task, [image])
+            return True
+        finally:
+            db.close()
+
+
+def pending_renders(task_id: int) -> List[int]:
+    """Ids of the task's images whose crop is still the proxy render."""
+    db = SessionLocal()
+    try:
+        return [
+            img.id
+            for img in db.query(Image).filter(Image.task_id == task_id, Image.crop_path.isnot(None)).all()
+            if ((img.meta_json or {}).get("crop_render") or {}).get("final") is False
+        ]
+    finally:
+        db.close()
+
+
+def flush_pending(task_id: int) -> int:
+    """Synchronously render every crop still waiting for its full-res version."""
+    pending = pending_renders(task_id)
+    for image_id in pending:
+        try:
+            render_final(image_id)
+        except Exception as exc:  # noqa: BLE001
+            logger.error(f"全分辨率裁切渲染失败 image={image_id}: {exc}")
+    return len(pending)
+
+
+def crop_url_version(image: Image) -> Optional[int]:
+    """Version suffix for crop URLs so browsers drop stale crops after a recrop."""
+    render = (image.meta_json or {}).get("crop_render") or {}
+    version = render.get("version")
+    if version is None:
+        return None
+    return version * 2 + (1 if render.get("final") else 0)
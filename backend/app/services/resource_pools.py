@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Sub-work pools; network-bound stages are bounded by their scheduler slots instead.
+POOL_NAMES = ("cpu", "disk")
+
+# Idle worker threads exit after this long; the pool starts new ones on demand.
+_IDLE_TIMEOUT = 30.0
+
+
+class ResourcePool:
+    """Thread pool for one resource class whose worker limit can change at runtime.
+
+    Work beyond the limit queues; lowering the limit lets surplus workers
+    exit after their current item instead of interrupting it.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, int(limit))
+        self.cond = threading.Condition()
+        self.queue: Deque[Tuple[Future, Callable, tuple, dict, float]] = deque()
+        self.threads = 0
+        self.busy = 0
+        self.seq = 0
+        self.last_tick = time.monotonic()
+        self.busy_seconds = 0.0
+        self.capacity_seconds = 0.0
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "wait_seconds": 0.0, "max_queue_depth": 0}
+
+    def _tick(self, now: float) -> None:
+        elapsed = now - self.last_tick
+        self.last_tick = now
+        if elapsed > 0:
+            self.busy_seconds += self.busy * elapsed
+            self.capacity_seconds += self.limit * elapsed
+
+    def _spawn_locked(self) -> None:
+        while self.threads < self.limit and self.threads < self.busy + len(self.queue):
+            self.threads += 1
+            self.seq += 1
+            threading.Thread(target=self._worker, name=f"{self.name}-pool-{self.seq}", daemon=True).start()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        future: Future = Future()
+        with self.cond:
+            self.queue.append((future, fn, args, kwargs, time.monotonic()))
+            self.stats["submitted"] += 1
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self.queue))
+            self._spawn_locked()
+            self.cond.notify()
+        return future
+
+    def _worker(self) -> None:
+        while True:
+            with self.cond:
+                while not self.queue and self.threads <= self.limit:
+                    if not self.cond.wait(timeout=_IDLE_TIMEOUT) and not self.queue:
+                        self.threads -= 1
+                        return
+                if self.threads > self.limit:
+                    # Shrunk: this worker leaves; queued work stays for the others.
+                    self.threads -= 1
+                    return
+                future, fn, args, kwargs, queued_at = self.queue.popleft()
+                now = time.monotonic()
+                self._tick(now)
+                self.busy += 1
+                self.stats["wait_seconds"] += now - queued_at
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as exc:  # noqa: BLE001
+                        future.set_exception(exc)
+            finally:
+                with self.cond:
+                    self._tick(time.monotonic())
+                    self.busy -= 1
+                    if future.cancelled() or future.exception() is None:
+                        self.stats["completed"] += 1
+                    else:
+                        self.stats["failed"] += 1
+
+    def resize(self, limit: int) -> int:
+        with self.cond:
+            self._tick(time.monotonic())
+            self.limit = max(1, int(limit))
+            self._spawn_locked()
+            self.cond.notify_all()
+            return self.limit
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.cond:
+            self._tick(time.monotonic())
+            done = self.stats["submitted"] - len(self.queue)
+            return {
+                "limit": self.limit,
+                "threads": self.threads,
+                "busy": self.busy,
+                "queued": len(self.queue),
+                "utilisation": round(self.busy / self.limit, 3),
+                "avg_utilisation": round(self.busy_seconds / self.capacity_seconds, 3) if self.capacity_seconds else 0.0,
+                "avg_wait_seconds": round(self.stats["wait_seconds"] / done, 3) if done else 0.0,
+                **{k: round(v, 3) if isinstance(v, float) else v for k, v in self.stats.items()},
+            }
+
+
+_LOCK = threading.Lock()
+_POOLS: Dict[str, ResourcePool] = {}
+
+
+def _default_limit(name: str) -> int:
+    return {"cpu": settings.CPU_POOL_WORKERS, "disk": settings.DISK_POOL_WORKERS}[name]
+
+
+def get_pool(name: str) -> ResourcePool:
+    """Process-wide pool for sub-work of a resource class (cpu or disk)."""
+    if name not in POOL_NAMES:
+        raise ValueError(f"unknown resource pool: {name}")
+    with _LOCK:
+        pool = _POOLS.get(name)
+        if pool is None:
+            pool = _POOLS[name] = ResourcePool(name, _default_limit(name))
+        return pool
+
+
+def submit(name: str, fn: Callable, *args, **kwargs) -> Future:
+    return get_pool(name).submit(fn, *args, **kwargs)
+
+
+def resize(name: str, limit: int) -> int:
+    limit = get_pool(name).resize(limit)
+    logger.info(f"资源池 {name} 并发上限调整为 {limit}")
+    return limit
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    return {name: get_pool(name).snapshot() for name in POOL_NAMES}
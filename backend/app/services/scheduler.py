@@ -0,0 +1,471 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+BATCH = "batch"
+INTERACTIVE = "interactive"
+LANES = (BATCH, INTERACTIVE)
+
+# Resource classes a stage can hold a slot in: decode/feature work, model calls, packaging.
+CPU = "cpu"
+NET = "net"
+DISK = "disk"
+RESOURCES = (CPU, NET, DISK)
+
+# Upper bound on one wait so cancellation of a parked job is noticed.
+_MAX_WAIT_SLICE = 1.0
+_DURATION_ALPHA = 0.3
+
+
+class _Job:
+    __slots__ = (
+        "seq", "task_id", "owner", "priority", "weight", "lane", "resource", "func", "future",
+        "wake", "thread", "started", "acquired_at", "ran_seconds", "segment_seconds", "enqueued_at", "preemptions",
+    )
+
+    def __init__(self, seq: int, task_id: Optional[int], owner: str, priority: int, weight: float, lane: str, resource: str, func, future):
+        self.seq = seq
+        self.task_id = task_id
+        self.owner = owner
+        self.priority = priority
+        self.weight = max(0.01, weight)
+        self.lane = lane
+        self.resource = resource
+        self.func = func
+        self.future = future
+        self.wake = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.started = False
+        self.acquired_at: Optional[float] = None
+        self.ran_seconds = 0.0
+        # Slot time in the current resource class, for that class's duration estimate.
+        self.segment_seconds = 0.0
+        self.enqueued_at = time.monotonic()
+        self.preemptions = 0
+
+
+class TaskScheduler:
+    """Slot scheduler for stage jobs: priority first, then weighted fair share by owner.
+
+    Each resource class (cpu, net, disk) has its own number of batch slots, so
+    stages waiting on the model API do not hold the slots CPU-bound stages
+    need; a stage moves between classes with ``use_resource``. The interactive
+    lane has ``fast_slots`` of its own for short user-facing work. Owners
+    accumulate virtual time (slot-seconds / weight) while running, and among
+    equal priorities the owner with the least virtual time goes next. Running
+    batch jobs call ``checkpoint`` between images and give their slot up once
+    they held it for a quantum and a waiter for the same class deserves it more.
+    """
+
+    def __init__(self, limits: Dict[str, int], fast_slots: int, quantum: float):
+        self.limits = {resource: max(1, int(limits.get(resource, 1))) for resource in RESOURCES}
+        self.fast_slots = max(1, fast_slots)
+        self.quantum = quantum
+        self.cond = threading.Condition()
+        self.waiting: List[_Job] = []
+        self.running: List[_Job] = []
+        self.vtime: Dict[str, float] = {}
+        self.avg_seconds: Dict[str, float] = {}
+        self.seq = itertools.count()
+        self.local = threading.local()
+        # Bumped on every dispatch pass, i.e. whenever queue_info() may have changed.
+        self.generation = 0
+        # Integrated busy and capacity slot-seconds per class, for average utilisation.
+        self.last_tick = time.monotonic()
+        self.busy_seconds = {resource: 0.0 for resource in RESOURCES}
+        self.capacity_seconds = {resource: 0.0 for resource in RESOURCES}
+
+    # -- accounting -------------------------------------------------------
+
+    def _tick(self, now: float) -> None:
+        elapsed = now - self.last_tick
+        self.last_tick = now
+        if elapsed <= 0:
+            return
+        for resource in RESOURCES:
+            self.busy_seconds[resource] += self._busy(resource) * elapsed
+            self.capacity_seconds[resource] += self.limits[resource] * elapsed
+
+    def _busy(self, resource: str) -> int:
+        return sum(1 for j in self.running if j.lane == BATCH and j.resource == resource)
+
+    def _effective_vtime(self, owner: str, now: float) -> float:
+        vtime = self.vtime.get(owner, 0.0)
+        for job in self.running:
+            if job.owner == owner and job.acquired_at is not None:
+                vtime += (now - job.acquired_at) / job.weight
+        return vtime
+
+    def _join_owner(self, owner: str, now: float) -> None:
+        # An owner returning after idling must not bank its idle time against busy owners.
+        active = {job.owner for job in self.running} | {job.owner for job in self.waiting}
+        if owner in active:
+            return
+        floor = min((self._effective_vtime(o, now) for o in active), default=0.0)
+        self.vtime[owner] = max(self.vtime.get(owner, 0.0), floor)
+
+    def _charge(self, job: _Job, now: float) -> None:
+        if job.acquired_at is None:
+            return
+        held = now - job.acquired_at
+        job.ran_seconds += held
+        job.segment_seconds += held
+        self.vtime[job.owner] = self.vtime.get(job.owner, 0.0) + held / job.weight
+        job.acquired_at = None
+
+    def _record_segment(self, job: _Job) -> None:
+        key = INTERACTIVE if job.lane == INTERACTIVE else job.resource
+        previous = self.avg_seconds.get(key)
+        self.avg_seconds[key] = (
+            job.segment_seconds if previous is None else _DURATION_ALPHA * job.segment_seconds + (1 - _DURATION_ALPHA) * previous
+        )
+        job.segment_seconds = 0.0
+
+    def _key(self, job: _Job, now: float):
+        return (-job.priority, self._effective_vtime(job.owner, now), job.seq)
+
+    def _can_start(self, job: _Job) -> bool:
+        if job.lane == INTERACTIVE:
+            return sum(1 for j in self.running if j.lane == INTERACTIVE) < self.fast_slots
+        return self._busy(job.resource) < self.limits[job.resource]
+
+    # -- dispatch ---------------------------------------------------------
+
+    def _dispatch_locked(self) -> None:
+        now = time.monotonic()
+        self._tick(now)
+        self.generation += 1
+        while self.waiting:
+            ordered = sorted(self.waiting, key=lambda j: self._key(j, now))
+            job = next((j for j in ordered if self._can_start(j)), None)
+            if job is None:
+                break
+            self.waiting.remove(job)
+            job.acquired_at = now
+            self.running.append(job)
+            if job.started:
+                job.wake.set()
+            else:
+                job.started = True
+                job.thread = threading.Thread(target=self._run, args=(job,), name=f"task-{job.task_id}", daemon=True)
+                job.thread.start()
+        self.cond.notify_all()
+
+    def _run(self, job: _Job) -> None:
+        self.local.job = job
+        try:
+            if job.future.set_running_or_notify_cancel():
+                try:
+                    job.future.set_result(job.func())
+                except BaseException as exc:  # noqa: BLE001
+                    job.future.set_exception(exc)
+        finally:
+            self.local.job = None
+            with self.cond:
+                now = time.monotonic()
+                self._tick(now)
+                self._charge(job, now)
+                if job in self.running:
+                    self.running.remove(job)
+                if not any(j.owner == job.owner for j in self.running + self.waiting):
+                    # Idle owners rejoin at the current floor anyway (see _join_owner).
+                    self.vtime.pop(job.owner, None)
+                self._record_segment(job)
+                self._dispatch_locked()
+
+    def submit(
+        self,
+        func: Callable[[], Any],
+        task_id: Optional[int] = None,
+        priority: int = 0,
+        owner: Optional[str] = None,
+        weight: float = 1.0,
+        lane: str = BATCH,
+        resource: str = CPU,
+    ) -> Future:
+        if resource not in RESOURCES:
+            raise ValueError(f"unknown resource class: {resource}")
+        future: Future = Future()
+        with self.cond:
+            now = time.monotonic()
+            owner = owner or f"task-{task_id}"
+            self._join_owner(owner, now)
+            job = _Job(next(self.seq), task_id, owner, int(priority), float(weight), lane, resource, func, future)
+            self.waiting.append(job)
+            self._dispatch_locked()
+        return future
+
+    def _park(self, job: _Job, should_stop: Optional[Callable[[], bool]]) -> None:
+        """Wait (without a slot) until dispatch hands the job a slot again; caller released it."""
+        while not job.wake.wait(_MAX_WAIT_SLICE):
+            if should_stop is not None and should_stop():
+                with self.cond:
+                    if job in self.waiting:
+                        self.waiting.remove(job)
+                        # Finish the cancellation on a borrowed slot; it is charged like any other run.
+                        job.acquired_at = time.monotonic()
+                        self.running.append(job)
+                        self.generation += 1
+                        return
+
+    def _release_locked(self, job: _Job, now: float) -> None:
+        self._tick(now)
+        self._charge(job, now)
+        self.running.remove(job)
+        job.wake.clear()
+        self.waiting.append(job)
+
+    # -- preemption and class changes --------------------------------------
+
+    def should_yield(self) -> bool:
+        job = getattr(self.local, "job", None)
+        if job is None or job.lane != BATCH:
+            return False
+        with self.cond:
+            return self._should_yield_locked(job, time.monotonic())
+
+    def _should_yield_locked(self, job: _Job, now: float) -> bool:
+        if job.acquired_at is None or now - job.acquired_at < self.quantum:
+            return False
+        # Anything still waiting could not start, so freeing this slot is the only way in.
+        rivals = [j for j in self.waiting if j.lane == BATCH and j.resource == job.resource]
+        if not rivals:
+            return False
+        best = min(rivals, key=lambda j: self._key(j, now))
+        if best.priority != job.priority:
+            return best.priority > job.priority
+        if best.owner == job.owner:
+            return False
+        return self._effective_vtime(best.owner, now) < self._effective_vtime(job.owner, now)
+
+    def checkpoint(self, should_stop: Optional[Callable[[], bool]] = None) -> bool:
+        """Give the slot up if a waiter deserves it more, and wait to get it back.
+
+        Called by the running job's own thread between images. Returns True if
+        the job was parked; a job whose ``should_stop`` turns true while parked
+        resumes immediately (without a slot) so it can notice its cancellation.
+        """
+        job = getattr(self.local, "job", None)
+        if job is None or job.lane != BATCH:
+            return False
+        with self.cond:
+            now = time.monotonic()
+            if not self._should_yield_locked(job, now):
+                return False
+            self._release_locked(job, now)
+            job.preemptions += 1
+            self._dispatch_locked()
+        logger.info(f"任务 {job.task_id} 让出执行槽，等待重新调度")
+        self._park(job, should_stop)
+        return True
+
+    def use_resource(self, resource: str, should_stop: Optional[Callable[[], bool]] = None) -> bool:
+        """Move the calling stage to a slot of ``resource``; returns True if it had to switch."""
+        if resource not in RESOURCES:
+            raise ValueError(f"unknown resource class: {resource}")
+        job = getattr(self.local, "job", None)
+        if job is None or job.lane != BATCH or job.resource == resource:
+            return False
+        with self.cond:
+            now = time.monotonic()
+            if job in self.running:
+                self._release_locked(job, now)
+            self._record_segment(job)
+            job.resource = resource
+            self._dispatch_locked()
+        self._park(job, should_stop)
+        return True
+
+    # -- control & observation -------------------------------------------
+
+    def resize(self, resource: str, limit: int) -> int:
+        """Change a class's slot count at runtime; extra running stages finish their slot as usual."""
+        if resource not in RESOURCES:
+            raise ValueError(f"unknown resource class: {resource}")
+        with self.cond:
+            self._tick(time.monotonic())
+            self.limits[resource] = max(1, int(limit))
+            self._dispatch_locked()
+            return self.limits[resource]
+
+    def reprioritize(self, task_id: int, priority: Optional[int] = None, weight: Optional[float] = None) -> bool:
+        with self.cond:
+            found = False
+            for job in self.waiting + self.running:
+                if job.task_id == task_id:
+                    if priority is not None:
+                        job.priority = int(priority)
+                    if weight is not None:
+                        job.weight = max(0.01, float(weight))
+                    found = True
+            self._dispatch_locked()
+            return found
+
+    def _estimate_start(self, position: int, job: _Job, now: float) -> float:
+        """Seconds until the waiter at ``position`` of its class gets a slot, from average durations."""
+        if job.lane == INTERACTIVE:
+            key, capacity = INTERACTIVE, self.fast_slots
+            pool = [j for j in self.running if j.lane == INTERACTIVE]
+        else:
+            key, capacity = job.resource, self.limits[job.resource]
+            pool = [j for j in self.running if j.lane == BATCH and j.resource == job.resource]
+        avg = self.avg_seconds.get(key, settings.SCHEDULER_DEFAULT_JOB_SECONDS)
+        free_at = [max(0.0, avg - j.segment_seconds - (now - (j.acquired_at or now))) for j in pool]
+        free_at += [0.0] * max(0, capacity - len(free_at))
+        heapq.heapify(free_at)
+        start = 0.0
+        for _ in range(position + 1):
+            start = heapq.heappop(free_at)
+            heapq.heappush(free_at, start + avg)
+        return start
+
+    def queue_info(self, task_id: int) -> Optional[Dict[str, Any]]:
+        with self.cond:
+            now = time.monotonic()
+            for job in self.running:
+                if job.task_id == task_id:
+                    return {
+                        "state": "running",
+                        "lane": job.lane,
+                        "resource": job.resource,
+                        "priority": job.priority,
+                        "owner": job.owner,
+                        "position": 0,
+                        "preemptions": job.preemptions,
+                        "estimated_start_seconds": 0.0,
+                        "estimated_start_at": None,
+                    }
+            for job in self.waiting:
+                if job.task_id != task_id:
+                    continue
+                peers = sorted(
+                    (j for j in self.waiting if j.lane == job.lane and (j.lane == INTERACTIVE or j.resource == job.resource)),
+                    key=lambda j: self._key(j, now),
+                )
+                position = peers.index(job)
+                seconds = self._estimate_start(position, job, now)
+                return {
+                    "state": "preempted" if job.started else "queued",
+                    "lane": job.lane,
+                    "resource": job.resource,
+                    "priority": job.priority,
+                    "owner": job.owner,
+                    "position": position + 1,
+                    "preemptions": job.preemptions,
+                    "estimated_start_seconds": round(seconds, 1),
+                    "estimated_start_at": (datetime.utcnow() + timedelta(seconds=seconds)).isoformat(),
+                }
+        return None
+
+    def resources(self) -> Dict[str, Dict[str, Any]]:
+        with self.cond:
+            self._tick(time.monotonic())
+            result = {}
+            for resource in RESOURCES:
+                busy = self._busy(resource)
+                capacity = self.capacity_seconds[resource]
+                result[resource] = {
+                    "limit": self.limits[resource],
+                    "running": busy,
+                    "waiting": sum(1 for j in self.waiting if j.lane == BATCH and j.resource == resource),
+                    "utilisation": round(busy / self.limits[resource], 3),
+                    "avg_utilisation": round(self.busy_seconds[resource] / capacity, 3) if capacity else 0.0,
+                    "avg_stage_seconds": round(self.avg_seconds[resource], 1) if resource in self.avg_seconds else None,
+                }
+            return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        resources = self.resources()
+        with self.cond:
+            now = time.monotonic()
+            owners = {job.owner for job in self.running} | {job.owner for job in self.waiting}
+            return {
+                "resources": resources,
+                "fast_slots": self.fast_slots,
+                "quantum": self.quantum,
+                "running": [
+                    {"task_id": j.task_id, "lane": j.lane, "resource": j.resource, "priority": j.priority, "owner": j.owner,
+                     "held_seconds": round(now - (j.acquired_at or now), 1), "preemptions": j.preemptions}
+                    for j in self.running
+                ],
+                "waiting": [
+                    {"task_id": j.task_id, "lane": j.lane, "resource": j.resource, "priority": j.priority, "owner": j.owner,
+                     "preempted": j.started, "waited_seconds": round(now - j.enqueued_at, 1)}
+                    for j in sorted(self.waiting, key=lambda j: self._key(j, now))
+                ],
+                "owner_vtime": {owner: round(self._effective_vtime(owner, now), 1) for owner in sorted(owners)},
+            }
+
+
+_LOCK = threading.Lock()
+_SCHEDULER: Optional[TaskScheduler] = None
+
+
+def get_scheduler() -> TaskScheduler:
+    global _SCHEDULER
+    with _LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = TaskScheduler(
+                limits={CPU: settings.CPU_STAGE_SLOTS, NET: settings.NET_STAGE_SLOTS, DISK: settings.DISK_STAGE_SLOTS},
+                fast_slots=settings.SCHEDULER_FAST_LANE_SLOTS,
+                quantum=settings.SCHEDULER_QUANTUM,
+            )
+        return _SCHEDULER
+
+
+def submit(func: Callable[[], Any], task_id: Optional[int] = None, **kwargs) -> Future:
+    return get_scheduler().submit(func, task_id=task_id, **kwargs)
+
+
+def run_interactive(func: Callable[[], Any], task_id: Optional[int] = None, timeout: Optional[float] = None) -> Any:
+    """Run short user-facing work on the fast lane and wait for its result."""
+    return get_scheduler().submit(func, task_id=task_id, lane=INTERACTIVE).result(timeout=timeout)
+
+
+def checkpoint(should_stop: Optional[Callable[[], bool]] = None) -> bool:
+    return get_scheduler().checkpoint(should_stop)
+
+
+def should_yield() -> bool:
+    return get_scheduler().should_yield()
+
+
+def use_resource(resource: str, should_stop: Optional[Callable[[], bool]] = None) -> bool:
+    return get_scheduler().use_resource(resource, should_stop)
+
+
+def resize(resource: str, limit: int) -> int:
+    limit = get_scheduler().resize(resource, limit)
+    logger.info(f"{resource} 阶段槽位调整为 {limit}")
+    return limit
+
+
+def resources() -> Dict[str, Dict[str, Any]]:
+    return get_scheduler().resources()
+
+
+def queue_info(task_id: int) -> Optional[Dict[str, Any]]:
+    return get_scheduler().queue_info(task_id)
+
+
+def reprioritize(task_id: int, priority: Optional[int] = None, weight: Optional[float] = None) -> bool:
+    return get_scheduler().reprioritize(task_id, priority, weight)
+
+
+def snapshot() -> Dict[str, Any]:
+    return get_scheduler().snapshot()
+
+
+def generation() -> int:
+    scheduler = get_scheduler()
+    with scheduler.cond:
+        return scheduler.generation
@@ -1,13 +1,16 @@
-﻿import json
+﻿import functools
+import io
+import json
 import logging
 import os
+import time
 import zipfile
 import hashlib
 import json
 from datetime import datetime
 from typing import Dict, List, Optional, Set
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future
 
 from PIL import Image as PILImage
 from PIL import ImageFile, ImageOps
@@ -20,20 +23,30 @@ from app.models.image import Image
 from app.models.log import Log, LogLevel
 from app.models.task import Task, TaskStage, TaskStatus
 from app.services.app_settings import get_app_settings
+from app.services import crop_planner, job_queue, memory_budget, progress_bus, resource_pools, scheduler
+from app.services.export_package import IncrementalExportBuilder
+from app.services.image_source import get_zip_source, is_image_path, open_image_file, read_image_bytes, source_signature
 from app.services.image_processing import (
     calculate_sharpness,
     cluster_keep_topk,
     crop_1024_from_original,
-    generate_preview,
+    render_preview,
 )
  
 from app.services.model_client import ModelClient
+from app.services.preview_pool import iter_previews, preview_workers
+from app.services.pyramid import PYRAMID_LEVELS, smallest_level
+from app.services.recrop import flush_pending as flush_pending_recrops, proxy_path_for, pyramid_proxy_path
 from .celery_app import celery_app
 
 logger = logging.getLogger(__name__)
 
+# Preview results are committed in batches of this size or at this interval (seconds).
+_PREVIEW_COMMIT_BATCH = 32
+_PREVIEW_COMMIT_INTERVAL = 2.0
+
 # Model focus retry rules for crop selection.
-_MIN_MODEL_CROP_SIDE = 0.9
+_MIN_MODEL_CROP_SIDE = crop_planner.MIN_CROP_SIDE
 _MAX_FOCUS_RETRIES = 2
 
 # Global task cancel token to force-stop running tasks.
@@ -42,6 +55,13 @@ _CANCEL_VERSION = 0
 _CANCEL_ALL_ACTIVE = False
 _CANCELLED_TASKS: Set[int] = set()
 
+# In-process recrop flushes by task (thread mode), so repeated downloads queue only one.
+_RECROP_FLUSH_LOCK = threading.Lock()
+_RECROP_FLUSHES: Dict[int, Future] = {}
+
+# Serializes read-modify-write of task.stats["recaption"] between fast-lane jobs.
+_RECAPTION_LOCK = threading.Lock()
+
 
 def bump_cancel_version() -> int:
     global _CANCEL_VERSION
@@ -88,9 +108,8 @@ def _should_cancel(task_id: int, version: int) -> bool:
             return True
         return task_id in _CANCELLED_TASKS
 
-# Global task executor to limit concurrent heavy processing.
-_MAX_PARALLEL_TASKS = max(1, int(getattr(settings, "MAX_PARALLEL_TASKS", 5)))
-_TASK_EXECUTOR = ThreadPoolExecutor(max_workers=_MAX_PARALLEL_TASKS)
+# Stage jobs hold slots of a resource class (cpu/net/disk) in app.services.scheduler
+# (priority, fair share by owner, preemption between images).
 
 # Create database engine
 connect_args = {}
@@ -116,16 +135,20 @@ def _ensure_task_dirs(task_id: int) -> Dict[str, str]:
         "images": os.path.join(base, "crops", "images"),
         "txt": os.path.join(base, "crops", "txt"),
         "export": os.path.join(base, "export"),
+        "features": os.path.join(base, "features"),
+        "proxies": os.path.join(base, "proxies"),
+        "pyramid": os.path.join(base, "pyramid"),
     }
     for path in dirs.values():
         os.makedirs(path, exist_ok=True)
     return dirs
 
 
-def _add_log(db, task_id: Optional[int], level: LogLevel, message: str) -> None:
+def _add_log(db, task_id: Optional[int], level: LogLevel, message: str, commit: bool = True) -> None:
     log = Log(task_id=task_id, level=level, message=message)
     db.add(log)
-    db.commit()
+    if commit:
+        db.commit()
 
 
 def _mark_error(db, task: Task, message: str) -> None:
@@ -147,7 +170,22 @@ def _mark_canceled(db, task: Task) -> None:
         db.rollback()
 
 
+def _yield_slot(db, task_id: int, version: int) -> None:
+    """Per-image preemption point: park this stage if a more deserving task is waiting."""
+    if scheduler.should_yield():
+        # Never sit on an open SQLite write transaction while parked.
+        db.commit()
+        scheduler.checkpoint(should_stop=lambda: _should_cancel(task_id, version))
+
+
+def _use_resource(db, resource: str, task_id: int, version: int) -> None:
+    """Move the running stage to a slot of ``resource`` (cpu, net or disk)."""
+    db.commit()
+    scheduler.use_resource(resource, should_stop=lambda: _should_cancel(task_id, version))
+
+
 def _check_cancel(db, task: Task, task_id: int, version: int) -> bool:
+    _yield_slot(db, task_id, version)
     if _should_cancel(task_id, version):
         _mark_canceled(db, task)
         clear_cancelled(task_id)
@@ -155,11 +193,143 @@ def _check_cancel(db, task: Task, task_id: int, version: int) -> bool:
     return False
 
 
+def _export_builder(task_id: int) -> IncrementalExportBuilder:
+    dirs = _ensure_task_dirs(task_id)
+    return IncrementalExportBuilder(dirs["export"], write_package=settings.EXPORT_WRITE_PACKAGE)
+
+
+def refresh_export(task: Task, images: List[Image]) -> None:
+    """Update only the given images in an already packaged export (e.g. after a recrop)."""
+    if not task.export_path:
+        return
+    builder = _export_builder(task.id)
+    keep = [img for img in images if img.selected and img.crop_path]
+    drop = [img.id for img in images if not (img.selected and img.crop_path)]
+    if keep:
+        builder.upsert(task, keep)
+    if drop:
+        builder.remove(task, drop)
+
+
+def _use_model_cache(task: Task) -> bool:
+    return not (task.config or {}).get("bypass_model_cache", False)
+
+
+def _record_payload_stats(task: Task, stage: str, model_client: ModelClient) -> None:
+    """Store image payload bytes and call latency of a stage's model client in task.stats."""
+    stats = dict(task.stats or {})
+    payload = dict(stats.get("model_payload") or {})
+    payload[stage] = model_client.get_payload_stats()
+    stats["model_payload"] = payload
+    latency = dict(stats.get("model_latency") or {})
+    latency[stage] = model_client.get_latency_stats()
+    stats["model_latency"] = latency
+    task.stats = stats
+
+
+def _record_memory(task: Task, stage: str) -> None:
+    """Store the stage's reserved decode memory and the task's overall peak in task.stats."""
+    usage = memory_budget.take_task_usage(task.id)
+    if usage is None:
+        return
+    stats = dict(task.stats or {})
+    memory = dict(stats.get("memory") or {})
+    stages = dict(memory.get("stages") or {})
+    stages[stage] = usage
+    memory["stages"] = stages
+    memory["peak_reserved_mb"] = max(memory.get("peak_reserved_mb") or 0, usage["peak_reserved_mb"])
+    stats["memory"] = memory
+    task.stats = stats
+
+
+def _preview_admission(task_id: int, version: int):
+    """Reserve decode memory for one preview render, estimated from the image header."""
+    needed_side = max((settings.PREVIEW_MAX_SIDE,) + (PYRAMID_LEVELS if settings.PYRAMID_ENABLED else ()))
+
+    def _admit(path: str, data: Optional[bytes] = None):
+        try:
+            width, height, mode, fmt = memory_budget.probe(path, data)
+            cost = memory_budget.decode_cost(width, height, mode, fmt, needed_side)
+        except Exception:  # noqa: BLE001
+            # Unreadable header: the render reports the error itself.
+            cost = 0
+        return memory_budget.reserve(cost, task_id=task_id, should_stop=lambda: _should_cancel(task_id, version))
+
+    return _admit
+
+
 def _load_images(db, task_id: int) -> List[Image]:
     return db.query(Image).filter(Image.task_id == task_id).all()
 
 
-def submit_task(func, *args, task_id: Optional[int] = None, **kwargs):
+# Per-image pipeline checkpoints, stored in meta_json["stages"] in pipeline order.
+_IMAGE_STAGES = ("prepared", "features", "focus", "cropped", "captioned")
+
+
+def _image_stages(image: Image) -> Dict[str, bool]:
+    meta = image.meta_json or {}
+    stages = dict(meta.get("stages") or {})
+    if meta.get("prepared"):
+        stages.setdefault("prepared", True)
+    return stages
+
+
+def _mark_stage(image: Image, stage: str) -> None:
+    """Record a finished stage and invalidate the stages that depend on it."""
+    meta = image.meta_json or {}
+    stages = dict(meta.get("stages") or {})
+    stages[stage] = True
+    for later in _IMAGE_STAGES[_IMAGE_STAGES.index(stage) + 1:]:
+        stages.pop(later, None)
+    meta["stages"] = stages
+    image.meta_json = meta
+
+
+def _features_path(dirs: Dict[str, str], image_path: str) -> str:
+    digest = hashlib.sha1(os.path.abspath(image_path).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(dirs["features"], f"{digest}.npz")
+
+
+def _render_previews_inline(
+    paths: List[str], output_dir: str, zip_source=None, pyramid_dir: Optional[str] = None, admit=None
+):
+    """Single-process fallback for preview rendering; yields like preview_pool.iter_previews."""
+    if zip_source is not None:
+        # Later members decompress in the background while earlier previews render.
+        originals = zip_source.iter_prefetched(
+            paths, lookahead=settings.ZIP_READ_WORKERS * 2, executor=resource_pools.get_pool("disk")
+        )
+    else:
+        originals = ((p, None) for p in paths)
+    try:
+        for img_path, data in originals:
+            reservation = admit(img_path, data) if admit is not None else None
+            if admit is not None and reservation is None:
+                return
+            try:
+                result = render_preview(
+                    img_path,
+                    output_dir,
+                    max_side=settings.PREVIEW_MAX_SIDE,
+                    quality=settings.PREVIEW_JPEG_QUALITY,
+                    data=data,
+                    pyramid_dir=pyramid_dir,
+                    pyramid_levels=PYRAMID_LEVELS,
+                )
+            except Exception as exc:  # noqa: BLE001
+                yield img_path, None, exc
+                continue
+            finally:
+                if reservation is not None:
+                    reservation.release()
+            yield img_path, result, None
+    finally:
+        originals.close()
+
+
+def submit_task(
+    func, *args, task_id: Optional[int] = None, resource: str = scheduler.CPU, lane: str = scheduler.BATCH, **kwargs
+):
     inferred_id = task_id
     if inferred_id is None and args:
         candidate = args[0]
@@ -172,7 +342,24 @@ def submit_task(func, *args, task_id: Optional[int] = None, **kwargs):
             return
         return func(*args, **kwargs)
 
-    return _TASK_EXECUTOR.submit(_runner)
+    return scheduler.submit(_runner, task_id=inferred_id, resource=resource, lane=lane, **_schedule_params(inferred_id))
+
+
+def _schedule_params(task_id: Optional[int]) -> dict:
+    """Priority, fair-share owner and weight from the task config."""
+    if task_id is None:
+        return {}
+    db = SessionLocal()
+    try:
+        task = db.query(Task).filter(Task.id == task_id).first()
+        config = (task.config or {}) if task else {}
+    finally:
+        db.close()
+    return {
+        "priority": int(config.get("priority") or 0),
+        "owner": config.get("owner") or f"task-{task_id}",
+        "weight": float(config.get("weight") or 1.0),
+    }
 
 
 def prepare_task(task_id: int) -> None:
@@ -183,6 +370,7 @@ def prepare_task(task_id: int) -> None:
         if not task:
             return
         cancel_version = get_cancel_version()
+        _use_resource(db, scheduler.CPU, task_id, cancel_version)
         if _check_cancel(db, task, task_id, cancel_version):
             return
 
@@ -194,13 +382,21 @@ def prepare_task(task_id: int) -> None:
         db.commit()
 
         unpacked_files: List[str] = []
-        # Reuse existing unpack dir to avoid repeated extraction on rerun
-        for root, _, files in os.walk(dirs["unpack"]):
-            for fname in files:
-                unpacked_files.append(os.path.join(root, fname))
+        zip_source = None
+        has_upload = bool(task.upload_path and os.path.exists(task.upload_path))
+        if has_upload and settings.LAZY_ZIP_SOURCE:
+            # Read members straight from the archive; nothing is extracted up front.
+            zip_source = get_zip_source(task.upload_path, dirs["unpack"])
+            unpacked_files = zip_source.member_paths()
+            _add_log(db, task_id, LogLevel.INFO, f"已索引压缩包 {len(unpacked_files)} 个文件（按需读取，未解压）")
+        else:
+            # Reuse existing unpack dir to avoid repeated extraction on rerun
+            for root, _, files in os.walk(dirs["unpack"]):
+                for fname in files:
+                    unpacked_files.append(os.path.join(root, fname))
 
-        if not unpacked_files:
-            if not task.upload_path or not os.path.exists(task.upload_path):
+        if zip_source is None and not unpacked_files:
+            if not has_upload:
                 raise ValueError("No uploaded archive or unpacked files found")
             with zipfile.ZipFile(task.upload_path, "r") as zip_ref:
                 for member in zip_ref.infolist():
@@ -213,11 +409,10 @@ def prepare_task(task_id: int) -> None:
                     zip_ref.extract(member, dirs["unpack"])
                     unpacked_files.append(os.path.join(dirs["unpack"], member.filename))
             _add_log(db, task_id, LogLevel.INFO, f"已解压 {len(unpacked_files)} 个文件")
-        else:
+        elif zip_source is None:
             _add_log(db, task_id, LogLevel.INFO, f"复用已解压文件 {len(unpacked_files)} 个（未重新解压）")
 
-        image_exts = [".jpg", ".jpeg", ".png", ".webp"]
-        image_files = [f for f in unpacked_files if os.path.splitext(f.lower())[1] in image_exts]
+        image_files = [f for f in unpacked_files if is_image_path(f)]
 
         task.stats = {
             "total_files": len(unpacked_files),
@@ -231,51 +426,101 @@ def prepare_task(task_id: int) -> None:
         db.commit()
 
         existing = {img.orig_path: img for img in _load_images(db, task_id)}
+        reused = 0
+
+        pending_files: List[str] = []
+        for img_path in image_files:
+            image = existing.get(img_path)
+            if (
+                image
+                and _image_stages(image).get("prepared")
+                and image.preview_path
+                and os.path.exists(image.preview_path)
+            ):
+                # Already prepared before a restart: keep its preview and downstream results.
+                reused += 1
+            else:
+                pending_files.append(img_path)
+
+        # Pyramid levels are cut from the same decode as the preview.
+        levels_dir = dirs["pyramid"] if settings.PYRAMID_ENABLED else None
+        admit = _preview_admission(task_id, cancel_version)
+        if preview_workers() > 1 and len(pending_files) > 1:
+            rendered = iter_previews(
+                pending_files,
+                dirs["previews"],
+                settings.PREVIEW_MAX_SIDE,
+                settings.PREVIEW_JPEG_QUALITY,
+                pyramid_dir=levels_dir,
+                pyramid_levels=PYRAMID_LEVELS,
+                admit=admit,
+            )
+        else:
+            rendered = _render_previews_inline(
+                pending_files, dirs["previews"], zip_source, pyramid_dir=levels_dir, admit=admit
+            )
 
-        for idx, img_path in enumerate(image_files):
-            if _check_cancel(db, task, task_id, cancel_version):
-                return
-            try:
-                preview_path = generate_preview(
-                    img_path,
-                    dirs["previews"],
-                    max_side=settings.PREVIEW_MAX_SIDE,
-                    quality=settings.PREVIEW_JPEG_QUALITY,
-                )
-                image = existing.get(img_path)
-                meta = image.meta_json if image and image.meta_json else {}
-                meta.update({"prepared": True})
-                if image:
-                    image.preview_path = preview_path
-                    image.selected = True
-                    image.crop_path = None
-                    image.prompt_txt_path = None
-                    image.meta_json = meta
+        done_count = reused
+        batch = 0
+        last_commit = time.monotonic()
+        checkpoint = _ProgressCheckpoint(task)
+        try:
+            for img_path, result, error in rendered:
+                if _check_cancel(db, task, task_id, cancel_version):
+                    return
+                done_count += 1
+                if error is not None:
+                    _add_log(db, task_id, LogLevel.ERROR, f"处理图片失败 {img_path}: {error}", commit=False)
                 else:
-                    image = Image(
-                        task_id=task_id,
-                        orig_name=os.path.basename(img_path),
-                        orig_path=img_path,
-                        preview_path=preview_path,
-                        selected=True,
-                        meta_json=meta,
+                    preview_path, w, h, levels = result
+                    image = existing.get(img_path)
+                    meta = image.meta_json if image and image.meta_json else {}
+                    meta.update({"prepared": True})
+                    if image:
+                        image.preview_path = preview_path
+                        image.selected = True
+                        image.crop_path = None
+                        image.prompt_txt_path = None
+                        image.caption = None
+                        image.meta_json = meta
+                    else:
+                        image = Image(
+                            task_id=task_id,
+                            orig_name=os.path.basename(img_path),
+                            orig_path=img_path,
+                            preview_path=preview_path,
+                            selected=True,
+                            meta_json=meta,
+                        )
+                        db.add(image)
+                    image.width, image.height = w, h
+                    if levels_dir:
+                        meta["pyramid"] = {"levels": levels}
+                        image.meta_json = meta
+                    _mark_stage(image, "prepared")
+                    _add_log(
+                        db,
+                        task_id,
+                        LogLevel.INFO,
+                        f"预览生成 {os.path.basename(img_path)} ({done_count}/{len(image_files)}) 尺寸:{w}x{h}",
+                        commit=False,
                     )
-                    db.add(image)
 
-                task.progress = 20 + int(((idx + 1) / max(1, len(image_files))) * 10)
-                db.commit()
-            except Exception as exc:
-                _add_log(db, task_id, LogLevel.ERROR, f"处理图片失败 {img_path}: {exc}")
-            
-            # 获取图片尺寸信息
-            try:
-                with PILImage.open(img_path) as pil_meta:
-                    w, h = pil_meta.size
-                _add_log(db, task_id, LogLevel.INFO, f"预览生成 {os.path.basename(img_path)} ({idx+1}/{len(image_files)}) 尺寸:{w}x{h}")
-            except Exception as exc:
-                w, h = (0, 0)
-                _add_log(db, task_id, LogLevel.ERROR, f"获取图片尺寸失败 {img_path}: {exc}")
+                checkpoint.update(20 + int((done_count / max(1, len(image_files))) * 10))
+                batch += 1
+                # Persist in batches; a per-image commit serializes the pool on SQLite fsyncs.
+                if batch >= _PREVIEW_COMMIT_BATCH or time.monotonic() - last_commit >= _PREVIEW_COMMIT_INTERVAL:
+                    db.commit()
+                    batch = 0
+                    last_commit = time.monotonic()
+        finally:
+            rendered.close()
+        checkpoint.flush()
+        db.commit()
 
+        if reused:
+            _add_log(db, task_id, LogLevel.INFO, f"复用已生成预览 {reused} 张（断点续跑）")
+        _record_memory(task, "prepare")
         if _check_cancel(db, task, task_id, cancel_version):
             return
         task.status = TaskStatus.PENDING
@@ -295,7 +540,8 @@ def _collect_image_features(images: List[Image]) -> List[Dict]:
     image_data: List[Dict] = []
     for img in images:
         try:
-            with PILImage.open(img.orig_path) as pil:
+            data = read_image_bytes(img.orig_path)
+            with PILImage.open(io.BytesIO(data)) as pil:
                 pil = ImageOps.exif_transpose(pil)
                 thumb = pil.copy()
                 thumb.thumbnail((512, 512))
@@ -303,8 +549,7 @@ def _collect_image_features(images: List[Image]) -> List[Dict]:
                 sharpness = calculate_sharpness(thumb)
                 width, height = pil.size
 
-                with open(img.orig_path, "rb") as f:
-                    md5 = hashlib.md5(f.read()).hexdigest()
+                md5 = hashlib.md5(data).hexdigest()
 
                 image_data.append(
                     {
@@ -322,14 +567,67 @@ def _collect_image_features(images: List[Image]) -> List[Dict]:
     return image_data
 
 
-def dedup_task(task_id: int, auto_continue: bool = False, dedup_params: dict = None) -> None:
-    """Run de-duplication and mark selections."""
+class _ProgressCheckpoint:
+    """Per-image task progress: published on the progress bus at once, written to the
+    task row (and so committed) at most every PROGRESS_CHECKPOINT_SECONDS."""
+
+    def __init__(self, task: Task):
+        self.task = task
+        self.pending: Dict[str, object] = {}
+        self.last = time.monotonic()
+
+    def update(self, progress: int, message: Optional[str] = None) -> None:
+        fields = {"progress": progress} if message is None else {"progress": progress, "message": message}
+        progress_bus.publish(self.task.id, **fields)
+        self.pending.update(fields)
+        if time.monotonic() - self.last >= settings.PROGRESS_CHECKPOINT_SECONDS:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the latest published progress to the task (committed with the caller's next commit)."""
+        for name, value in self.pending.items():
+            setattr(self.task, name, value)
+        self.pending = {}
+        self.last = time.monotonic()
+
+
+class _FeatureProgress:
+    """Per-chunk feature extraction progress, throughput and ETA published on the task."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.started = time.monotonic()
+
+    def publish(self, task: Task, done: int) -> None:
+        elapsed = max(1e-6, time.monotonic() - self.started)
+        rate = done / elapsed
+        eta = (self.total - done) / rate if rate > 0 else None
+        task.progress = max(task.progress, 35 + int(5 * done / max(1, self.total)))
+        task.message = f"提取特征 {done}/{self.total}，{rate:.2f} 张/秒" + (f"，预计剩余 {eta:.0f}s" if eta is not None else "")
+        stats = dict(task.stats or {})
+        stats["feature_extraction"] = {
+            "done": done,
+            "total": self.total,
+            "elapsed_seconds": round(elapsed, 1),
+            "images_per_sec": round(rate, 3),
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+        }
+        task.stats = stats
+
+
+def dedup_task(task_id: int, auto_continue: bool = False, dedup_params: dict = None, resume: bool = False) -> None:
+    """Run de-duplication and mark selections.
+
+    Features already extracted for an unchanged image (e.g. before a restart)
+    are loaded from the task's features dir instead of being recomputed.
+    """
     db = SessionLocal()
     try:
         task = db.query(Task).filter(Task.id == task_id).first()
         if not task:
             return
         cancel_version = get_cancel_version()
+        _use_resource(db, scheduler.CPU, task_id, cancel_version)
         if _check_cancel(db, task, task_id, cancel_version):
             return
 
@@ -351,19 +649,73 @@ def dedup_task(task_id: int, auto_continue: bool = False, dedup_params: dict = N
             return
         
         # Import dedup_people here to avoid circular imports
-        from app.services.dedup_people import extract_features, cluster, pick_kept, _cosine_sim, _face_ssim
-        
+        from app.services.dedup_people import (
+            extract_features,
+            cluster,
+            pick_kept,
+            load_image_meta,
+            save_image_meta,
+            _cosine_sim,
+            _face_ssim,
+        )
+
+        dirs = _ensure_task_dirs(task_id)
+        cached_metas = {}
+        for path in image_paths:
+            cached = load_image_meta(_features_path(dirs, path), path, source=source_signature(path))
+            if cached is not None:
+                cached_metas[path] = cached
+        missing_paths = [path for path in image_paths if path not in cached_metas]
+        if cached_metas:
+            _add_log(db, task_id, LogLevel.INFO, f"复用已提取特征 {len(cached_metas)} 张，需提取 {len(missing_paths)} 张")
+
+        # Face/pose analysis runs at 1024 px: read the pyramid level instead of decoding originals.
+        analysis_sources = {
+            img.orig_path: smallest_level(img, min_long=1024)[0] for img in images if img.orig_path
+        }
+
+        images_by_path = {img.orig_path: img for img in images if img.orig_path}
+        progress = _FeatureProgress(len(missing_paths))
+
+        def _on_chunk(chunk_metas, done: int, total: int) -> None:
+            # Persist each chunk so a cancel or restart keeps the finished work.
+            for meta in chunk_metas:
+                try:
+                    save_image_meta(meta, _features_path(dirs, meta.path), source=source_signature(meta.path))
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("Saving features failed for %s: %s", meta.path, exc)
+                cached_metas[meta.path] = meta
+                img = images_by_path.get(meta.path)
+                if img is not None and not _image_stages(img).get("features"):
+                    _mark_stage(img, "features")
+            progress.publish(task, done)
+            db.commit()
+            _yield_slot(db, task_id, cancel_version)
+
         # Extract features using dedup_people
-        metas = extract_features(
-            image_paths,
+        extract_features(
+            missing_paths,
             max_side_analysis=1024,
             max_side_small=512,
             min_pose_conf=0.35,
             max_workers=4,
+            executor=resource_pools.get_pool("cpu"),
+            opener=lambda path: open_image_file(analysis_sources.get(path, path)),
+            chunk_size=settings.FEATURE_CHUNK_SIZE,
+            should_stop=lambda: _should_cancel(task_id, cancel_version),
+            on_chunk=_on_chunk,
+            admit=functools.partial(
+                memory_budget.admit, task_id=task_id, should_stop=lambda: _should_cancel(task_id, cancel_version)
+            ),
         )
-
+        _record_memory(task, "dedup")
         if _check_cancel(db, task, task_id, cancel_version):
             return
+        metas = [cached_metas[path] for path in image_paths]
+        for img in images:
+            if img.orig_path in cached_metas and not _image_stages(img).get("features"):
+                _mark_stage(img, "features")
+        db.commit()
         
         # Set default params if not provided
         if dedup_params is None:
@@ -395,8 +747,8 @@ def dedup_task(task_id: int, auto_continue: bool = False, dedup_params: dict = N
         # Create mapping from path to keep status
         kept_paths = {image_paths[i] for i in kept_indices}
 
-        task.stats = task.stats or {}
-        task.stats["kept_files"] = len(kept_paths)
+        # Reassign: stats is a plain JSON column and may already hold feature_extraction.
+        task.stats = {**(task.stats or {}), "kept_files": len(kept_paths)}
         
         # Debug: Log feature extraction statistics
         face_ok = sum(1 for m in metas if m.face_emb is not None)
@@ -423,6 +775,7 @@ def dedup_task(task_id: int, auto_continue: bool = False, dedup_params: dict = N
         # Debug: Log cluster statistics
         logger.info(f"Dedup Task {task_id}: Clusters: {len(clusters)}, Kept images: {len(kept_indices)}, Total images: {len(metas)}")
 
+        checkpoint = _ProgressCheckpoint(task)
         for idx, img in enumerate(images):
             if _check_cancel(db, task, task_id, cancel_version):
                 return
@@ -436,7 +789,7 @@ def dedup_task(task_id: int, auto_continue: bool = False, dedup_params: dict = N
             if not img.width or not img.height:
                 try:
                     from PIL import Image as PILImage
-                    with PILImage.open(img.orig_path) as pil_img:
+                    with open_image_file(img.orig_path) as fp, PILImage.open(fp) as pil_img:
                         img.width, img.height = pil_img.size
                 except Exception:
                     # If we can't get the size, set a default
@@ -464,6 +817,10 @@ def dedup_task(task_id: int, auto_continue: bool = False, dedup_params: dict = N
                     meta["subject_area_ratio"] = sar
                     meta["shot_type"] = metas[i].shot_type
                     meta["is_full_body"] = metas[i].is_full_body
+                    # Subject boxes (cx, cy, w, h) in the EXIF-transposed frame, used by the local crop planner.
+                    meta["face_bbox_norm"] = list(metas[i].face_bbox_norm) if metas[i].face_bbox_norm else None
+                    meta["body_bbox_norm"] = list(metas[i].body_bbox_norm) if metas[i].body_bbox_norm else None
+                    meta["orientation"] = metas[i].orientation
                     
                     # Add cluster ID to metadata
                     cluster_id = None
@@ -475,7 +832,7 @@ def dedup_task(task_id: int, auto_continue: bool = False, dedup_params: dict = N
                     break
             
             img.meta_json = meta
-            task.progress = 40 + int(((idx + 1) / max(1, len(images))) * 5)
+            checkpoint.update(40 + int(((idx + 1) / max(1, len(images))) * 5))
             _add_log(
                 db,
                 task_id,
@@ -488,13 +845,14 @@ def dedup_task(task_id: int, auto_continue: bool = False, dedup_params: dict = N
             )
             db.commit()
 
+        checkpoint.flush()
         task.progress = max(task.progress, 50)
         if _check_cancel(db, task, task_id, cancel_version):
             return
         if auto_continue:
             db.commit()
             db.close()
-            crop_task(task_id, auto_continue=True)
+            crop_task(task_id, auto_continue=True, resume=resume)
             return
 
         task.status = TaskStatus.PENDING
@@ -517,7 +875,7 @@ def _ensure_image_size(image: Image) -> None:
     if not image.orig_path:
         return
     try:
-        with PILImage.open(image.orig_path) as pil_img:
+        with open_image_file(image.orig_path) as fp, PILImage.open(fp) as pil_img:
             image.width, image.height = pil_img.size
     except Exception:
         image.width = image.width or 0
@@ -596,14 +954,106 @@ def _sanitize_focus_result(focus_result: dict, min_side: float) -> dict:
     return result
 
 
-def crop_task(task_id: int, auto_continue: bool = False) -> None:
-    """Run focus detection + cropping for selected images."""
+def _needs_model_focus(image: Image, resume: bool) -> bool:
+    stages = _image_stages(image)
+    if resume and stages.get("cropped") and image.crop_path and os.path.exists(image.crop_path):
+        return False
+    return not (resume and stages.get("focus") and (image.meta_json or {}).get("focus"))
+
+
+def _focus_batch_size(model: str) -> int:
+    return max(1, int(settings.FOCUS_BATCH_SIZES.get(model, settings.FOCUS_BATCH_SIZE)))
+
+
+def _plan_local_crops(images: List[Image], mode: str, resume: bool) -> Dict[int, dict]:
+    """Local crop plans for the images the model does not need to see in this mode."""
+    if mode == "model":
+        return {}
+    # Saliency-only plans can never pass the auto threshold, so skip computing them.
+    use_saliency = mode == "local" or settings.LOCAL_CROP_MIN_CONFIDENCE <= crop_planner.SALIENCY_CONFIDENCE
+    plans: Dict[int, dict] = {}
+    for image in images:
+        if not _needs_model_focus(image, resume):
+            continue
+        _ensure_image_size(image)
+        plan = crop_planner.plan_crop(image, use_saliency=use_saliency)
+        if crop_planner.accept_local(plan, mode):
+            plans[image.id] = plan
+    return plans
+
+
+def _fetch_focus_batch(
+    model_client: ModelClient,
+    images: List[Image],
+    start: int,
+    resume: bool,
+    planned: Optional[Dict[int, dict]] = None,
+) -> Dict[int, dict]:
+    """Request focus for the next images (from ``start``) that need the model, in one batch.
+
+    Images with an accepted local plan in ``planned`` are left out.
+    """
+    chunk: List[Image] = []
+    for image in images[start:]:
+        if _needs_model_focus(image, resume) and image.id not in (planned or {}):
+            _ensure_image_size(image)
+            chunk.append(image)
+            if len(chunk) >= _focus_batch_size(model_client.model):
+                break
+
+    def _valid(idx: int, result: dict) -> bool:
+        return not result.get("usable", True) or _is_focus_result_reasonable(result, chunk[idx], _MIN_MODEL_CROP_SIDE)
+
+    results = model_client.get_focus_points([img.preview_path or img.orig_path for img in chunk], validate=_valid)
+    return {img.id: result for img, result in zip(chunk, results)}
+
+
+def _record_focus_metrics(task: Task, model_client: ModelClient, images: int, seconds: float) -> None:
+    """Focus throughput for comparing batched vs single requests."""
+    usage = model_client.get_payload_stats()
+    tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+    stats = dict(task.stats or {})
+    stats["focus_metrics"] = {
+        "batch_size": _focus_batch_size(model_client.model),
+        "images": images,
+        "requests": usage["requests"],
+        "seconds": round(seconds, 2),
+        "requests_per_sec": round(usage["requests"] / seconds, 3) if seconds > 0 else None,
+        "images_per_request": round(images / usage["requests"], 2) if usage["requests"] else None,
+        "tokens_per_image": round(tokens / images, 1) if images else None,
+    }
+    task.stats = stats
+
+
+def _record_planner_stats(task: Task, mode: str, planned: Dict[int, dict], model_images: int, batch_size: int) -> None:
+    sources: Dict[str, int] = {}
+    for plan in planned.values():
+        sources[plan.get("source", "local")] = sources.get(plan.get("source", "local"), 0) + 1
+    stats = dict(task.stats or {})
+    stats["crop_planner"] = {
+        "mode": mode,
+        "local_images": len(planned),
+        "model_images": model_images,
+        "sources": sources,
+        # Requests the model would have needed for the locally planned images.
+        "avoided_calls": -(-len(planned) // max(1, batch_size)),
+    }
+    task.stats = stats
+
+
+def crop_task(task_id: int, auto_continue: bool = False, resume: bool = False) -> None:
+    """Run focus detection + cropping for selected images.
+
+    With ``resume`` images whose crop is already on disk are skipped and stored
+    focus results are reused instead of calling the model again.
+    """
     db = SessionLocal()
     try:
         task = db.query(Task).filter(Task.id == task_id).first()
         if not task:
             return
         cancel_version = get_cancel_version()
+        _use_resource(db, scheduler.NET, task_id, cancel_version)
         if _check_cancel(db, task, task_id, cancel_version):
             return
 
@@ -620,6 +1070,8 @@ def crop_task(task_id: int, auto_continue: bool = False) -> None:
             api_key=task.api_key or settings.MODELSCOPE_TOKEN,
             base_url=task.base_url or settings.BASE_URL,
             model=task.focus_model,
+            use_cache=_use_model_cache(task),
+            task_id=task_id,
         )
 
         app_settings = get_app_settings(db)
@@ -627,14 +1079,37 @@ def crop_task(task_id: int, auto_continue: bool = False) -> None:
 
         images = db.query(Image).filter(Image.task_id == task_id, Image.selected == True).all()  # noqa: E712
         total = max(1, len(images))
+        planner_mode = crop_planner.planner_mode(task)
+        local_plans = _plan_local_crops(images, planner_mode, resume)
+        if local_plans:
+            _add_log(db, task_id, LogLevel.INFO, f"本地裁切规划 {len(local_plans)} 张，跳过模型调用（模式 {planner_mode}）")
+        # Focus results fetched ahead in batches of FOCUS_BATCH_SIZE(S) images per request.
+        prefetched_focus: Dict[int, dict] = {}
+        focus_images = 0
+        focus_seconds = 0.0
+        checkpoint = _ProgressCheckpoint(task)
 
         for idx, image in enumerate(images):
             if _check_cancel(db, task, task_id, cancel_version):
                 return
+            stages = _image_stages(image)
+            if resume and stages.get("cropped") and image.crop_path and os.path.exists(image.crop_path):
+                continue
             try:
                 _ensure_image_size(image)
-                focus_result = model_client.get_focus_point(image.preview_path or image.orig_path)
-                if focus_result.get("usable", True):
+                stored_focus = (image.meta_json or {}).get("focus")
+                if resume and stages.get("focus") and stored_focus:
+                    focus_result = stored_focus
+                elif image.id in local_plans:
+                    focus_result = local_plans[image.id]
+                else:
+                    if image.id not in prefetched_focus:
+                        started = time.monotonic()
+                        prefetched_focus.update(_fetch_focus_batch(model_client, images, idx, resume, local_plans))
+                        focus_seconds += time.monotonic() - started
+                    focus_result = prefetched_focus.pop(image.id)
+                    focus_images += 1
+                if focus_result.get("usable", True) and focus_result.get("planner") != "local":
                     retry_hint = (
                         "Previous result produced an invalid crop. "
                         "Return the LARGEST possible square crop (side near 1.0 = full short edge). "
@@ -650,10 +1125,12 @@ def crop_task(task_id: int, auto_continue: bool = False) -> None:
                             LogLevel.WARNING,
                             f"检测到裁切框异常，重新请求模型 ({attempt}/{_MAX_FOCUS_RETRIES}) {image.orig_name}",
                         )
+                        started = time.monotonic()
                         focus_result = model_client.get_focus_point(
                             image.preview_path or image.orig_path,
                             retry_hint=retry_hint,
                         )
+                        focus_seconds += time.monotonic() - started
                         valid = _is_focus_result_reasonable(focus_result, image, _MIN_MODEL_CROP_SIDE)
                     if not valid:
                         _add_log(
@@ -692,6 +1169,7 @@ def crop_task(task_id: int, auto_continue: bool = False) -> None:
                         meta["focus"]["confidence"] = 0.0
 
                 image.meta_json = meta
+                _mark_stage(image, "focus")
 
                 if not usable:
                     image.selected = False
@@ -722,10 +1200,21 @@ def crop_task(task_id: int, auto_continue: bool = False) -> None:
                     quality=95,
                     side=side,
                     output_size=crop_output_size,
+                    # No separate proxy when a pyramid level already serves recrops.
+                    proxy_path=None if pyramid_proxy_path(image, crop_output_size) else proxy_path_for(task_id, image.id),
+                    admit=functools.partial(memory_budget.admit, task_id=task_id),
                 )
                 image.crop_path = crop_path
-                meta["crop_square_model"] = {"cx": cx, "cy": cy, "side": side, "source": "model"}
+                meta["crop_square_model"] = {
+                    "cx": cx,
+                    "cy": cy,
+                    "side": side,
+                    "source": "local" if focus_result.get("planner") == "local" else "model",
+                }
+                # A model crop supersedes any queued user recrop render.
+                meta.pop("crop_render", None)
                 image.meta_json = meta
+                _mark_stage(image, "cropped")
                 _add_log(
                     db,
                     task_id,
@@ -736,19 +1225,23 @@ def crop_task(task_id: int, auto_continue: bool = False) -> None:
             except Exception as exc:  # noqa: BLE001
                 _add_log(db, task_id, LogLevel.ERROR, f"裁切失败 {image.orig_name}: {exc}")
 
-            task.progress = 60 + int(((idx + 1) / total) * 10)
-            task.message = f"裁切进度 {idx+1}/{total}"
+            checkpoint.update(60 + int(((idx + 1) / total) * 10), f"裁切进度 {idx+1}/{total}")
             db.commit()
 
+        checkpoint.flush()
         task.stats = task.stats or {}
         task.stats["processed_files"] = len([img for img in images if img.crop_path and img.selected])
+        _record_payload_stats(task, "crop", model_client)
+        _record_focus_metrics(task, model_client, focus_images, focus_seconds)
+        _record_planner_stats(task, planner_mode, local_plans, focus_images, _focus_batch_size(model_client.model))
+        _record_memory(task, "crop")
 
         if _check_cancel(db, task, task_id, cancel_version):
             return
         if auto_continue:
             db.commit()
             db.close()
-            caption_task(task_id)
+            caption_task(task_id, resume=resume)
             return
 
         task.status = TaskStatus.PENDING
@@ -766,14 +1259,95 @@ def crop_task(task_id: int, auto_continue: bool = False) -> None:
             pass
 
 
-def caption_task(task_id: int) -> None:
-    """Generate training captions and package dataset."""
+def _save_caption(dirs: Dict[str, str], image: Image, caption: str) -> str:
+    txt_filename = os.path.splitext(os.path.basename(image.crop_path))[0] + ".txt"
+    txt_path = os.path.join(dirs["txt"], txt_filename)
+    with open(txt_path, "w", encoding="utf-8") as f:
+        f.write(caption)
+    image.prompt_txt_path = txt_path
+    image.caption = caption
+    meta = image.meta_json or {}
+    meta["caption"] = caption
+    image.meta_json = meta
+    _mark_stage(image, "captioned")
+    return txt_path
+
+
+def _set_recaption_state(task_id: int, image_id: int, state: dict) -> None:
+    """Record a recaption's state in task.stats["recaption"], which the progress bus publishes."""
+    with _RECAPTION_LOCK:
+        db = SessionLocal()
+        try:
+            task = db.query(Task).filter(Task.id == task_id).first()
+            if not task:
+                return
+            stats = dict(task.stats or {})
+            recaption = dict(stats.get("recaption") or {})
+            recaption[str(image_id)] = state
+            stats["recaption"] = recaption
+            task.stats = stats
+            db.commit()
+        finally:
+            db.close()
+
+
+def submit_recaption(task_id: int, image_id: int):
+    """Queue one image's caption regeneration on the fast lane."""
+    _set_recaption_state(task_id, image_id, {"status": "queued"})
+    return submit_job("recaption", task_id, image_id=image_id)
+
+
+def recaption_image(task_id: int, image_id: int) -> None:
+    """Fast-lane job: regenerate one caption and publish the outcome through task stats."""
+    try:
+        result = caption_image(task_id, image_id)
+    except Exception as exc:
+        logger.error(f"单张提示词重新生成失败 task={task_id} image={image_id}: {exc}")
+        _set_recaption_state(task_id, image_id, {"status": "failed", "error": str(exc)[:500]})
+        raise
+    if result is None:
+        _set_recaption_state(task_id, image_id, {"status": "failed", "error": "Image has no crop"})
+        return
+    _set_recaption_state(task_id, image_id, {"status": "done", "prompt_text": result["prompt_text"]})
+
+
+def caption_image(task_id: int, image_id: int) -> Optional[dict]:
+    """Regenerate one image's caption; returns None if the image has no crop."""
+    db = SessionLocal()
+    try:
+        task = db.query(Task).filter(Task.id == task_id).first()
+        image = db.query(Image).filter(Image.id == image_id, Image.task_id == task_id).first()
+        if not task or not image or not image.crop_path:
+            return None
+        model_client = ModelClient(
+            api_key=task.api_key or settings.MODELSCOPE_TOKEN,
+            base_url=task.base_url or settings.BASE_URL,
+            model=task.tag_model,
+            use_cache=_use_model_cache(task),
+            task_id=task_id,
+        )
+        caption = model_client.generate_caption(image.crop_path, prompt=get_app_settings(db)["caption_prompt"])
+        txt_path = _save_caption(_ensure_task_dirs(task_id), image, caption)
+        _add_log(db, task_id, LogLevel.INFO, f"单张提示词重新生成 {image.orig_name} -> {os.path.basename(txt_path)}")
+        db.commit()
+        refresh_export(task, [image])
+        return {"id": image.id, "prompt_text": caption}
+    finally:
+        db.close()
+
+
+def caption_task(task_id: int, resume: bool = False) -> None:
+    """Generate training captions and package dataset.
+
+    With ``resume`` images that already have a caption file are skipped.
+    """
     db = SessionLocal()
     try:
         task = db.query(Task).filter(Task.id == task_id).first()
         if not task:
             return
         cancel_version = get_cancel_version()
+        _use_resource(db, scheduler.NET, task_id, cancel_version)
         if _check_cancel(db, task, task_id, cancel_version):
             return
 
@@ -791,80 +1365,62 @@ def caption_task(task_id: int) -> None:
             api_key=task.api_key or settings.MODELSCOPE_TOKEN,
             base_url=task.base_url or settings.BASE_URL,
             model=task.tag_model,
+            use_cache=_use_model_cache(task),
+            task_id=task_id,
         )
 
         images = db.query(Image).filter(Image.task_id == task_id, Image.selected == True).all()  # noqa: E712
         total = max(1, len(images))
+        export_builder = _export_builder(task_id)
+        checkpoint = _ProgressCheckpoint(task)
 
         for idx, image in enumerate(images):
             if _check_cancel(db, task, task_id, cancel_version):
                 return
             if not image.crop_path:
                 continue
+            if (
+                resume
+                and _image_stages(image).get("captioned")
+                and image.prompt_txt_path
+                and os.path.exists(image.prompt_txt_path)
+            ):
+                continue
             try:
                 caption = model_client.generate_caption(image.crop_path, prompt=caption_prompt)
-                txt_filename = os.path.splitext(os.path.basename(image.crop_path))[0] + ".txt"
-                txt_path = os.path.join(dirs["txt"], txt_filename)
-                with open(txt_path, "w", encoding="utf-8") as f:
-                    f.write(caption)
-                image.prompt_txt_path = txt_path
-                meta = image.meta_json or {}
-                meta["caption"] = caption
-                image.meta_json = meta
+                txt_path = _save_caption(dirs, image, caption)
                 _add_log(db, task_id, LogLevel.INFO, f"提示词生成 {image.orig_name} -> {os.path.basename(txt_path)}")
                 db.commit()
+                export_builder.upsert(task, [image], flush=False)
             except Exception as exc:  # noqa: BLE001
                 _add_log(db, task_id, LogLevel.ERROR, f"提示词生成失败 {image.orig_name}: {exc}")
-            task.progress = 80 + int(((idx + 1) / total) * 10)
-            task.message = f"提示词进度 {idx+1}/{total}"
+            checkpoint.update(80 + int(((idx + 1) / total) * 10), f"提示词进度 {idx+1}/{total}")
             db.commit()
+        checkpoint.flush()
         if _check_cancel(db, task, task_id, cancel_version):
             return
         task.stage = TaskStage.PACKAGING
         task.message = "打包训练集..."
         db.commit()
+        _use_resource(db, scheduler.DISK, task_id, cancel_version)
 
-        manifest = {
-            "version": "1.1",
-            "task_id": task_id,
-            "task_name": task.name,
-            "created_at": datetime.utcnow().isoformat(),
-            "focus_model": task.focus_model,
-            "tag_model": task.tag_model,
-            "images": [],
-        }
+        # Recrops saved from working proxies get their full-res render before packaging.
+        if flush_pending_recrops(task_id):
+            db.expire_all()
 
         kept_images = db.query(Image).filter(
             Image.task_id == task_id, Image.selected == True, Image.crop_path.isnot(None)
         ).all()  # noqa: E712
 
-        for img in kept_images:
-            manifest["images"].append(
-                {
-                    "orig_name": img.orig_name,
-                    "md5": img.md5,
-                    "focus_point": (img.meta_json or {}).get("focus", {}).get("focus_point"),
-                    "crop_path": os.path.basename(img.crop_path) if img.crop_path else None,
-                    "prompt": (img.meta_json or {}).get("caption", ""),
-                }
-            )
-
-        manifest_path = os.path.join(dirs["export"], "manifest.json")
-        with open(manifest_path, "w", encoding="utf-8") as f:
-            json.dump(manifest, f, indent=2, ensure_ascii=False)
-
-        train_package_path = os.path.join(dirs["export"], "train_package.zip")
-        with zipfile.ZipFile(train_package_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for img in kept_images:
-                if img.crop_path:
-                    zipf.write(img.crop_path, f"images/{os.path.basename(img.crop_path)}")
-                if img.prompt_txt_path:
-                    zipf.write(img.prompt_txt_path, f"txt/{os.path.basename(img.prompt_txt_path)}")
-            zipf.write(manifest_path, "manifest.json")
+        # Writes the captions queued above plus anything that changed since.
+        export_builder.sync(task, kept_images)
+        export_path = export_builder.package_path if settings.EXPORT_WRITE_PACKAGE else export_builder.manifest_path
 
         task.stats = task.stats or {}
         task.stats["processed_files"] = len(kept_images)
-        task.export_path = train_package_path
+        _record_payload_stats(task, "caption", model_client)
+        task.export_path = export_path
+        task.export_ready = True
         task.status = TaskStatus.COMPLETED
         task.stage = TaskStage.FINISHED
         task.progress = 100
@@ -881,25 +1437,159 @@ def caption_task(task_id: int) -> None:
             pass
 
 
-def run_full_pipeline(task_id: int) -> None:
+def _set_pipeline_mode(task_id: int, mode: str) -> Optional[dict]:
+    """Remember whether the task runs the one-click flow so a resume can continue it."""
+    db = SessionLocal()
+    try:
+        task = db.query(Task).filter(Task.id == task_id).first()
+        if not task:
+            return None
+        config = dict(task.config or {})
+        config["pipeline"] = mode
+        task.config = config
+        db.commit()
+        return config
+    except Exception:
+        db.rollback()
+        return None
+    finally:
+        db.close()
+
+
+def run_full_pipeline(task_id: int, resume: bool = False) -> None:
     """One-click flow from unpack -> dedup -> crop -> caption."""
     cancel_version = get_cancel_version()
     if _should_cancel(task_id, cancel_version):
         return
+    config = _set_pipeline_mode(task_id, "full") or {}
     prepare_task(task_id)
     if _should_cancel(task_id, cancel_version):
         return
-    dedup_params = None
+    dedup_task(task_id, auto_continue=True, dedup_params=config.get("dedup_params"), resume=resume)
+
+
+def resume_task(task_id: int) -> None:
+    """Continue an interrupted task from its recorded stage, reusing finished per-image work."""
     db = SessionLocal()
     try:
         task = db.query(Task).filter(Task.id == task_id).first()
-        if task and task.config:
-            dedup_params = task.config.get("dedup_params")
-    except Exception:
-        dedup_params = None
+        if not task:
+            return
+        stage = task.stage
+        config = task.config or {}
+        _add_log(db, task_id, LogLevel.INFO, f"恢复中断任务，阶段: {getattr(stage, 'value', stage)}")
+    finally:
+        db.close()
+
+    full = config.get("pipeline") == "full"
+    dedup_params = config.get("dedup_params")
+    if stage in (TaskStage.INITIAL, TaskStage.UNPACKING, TaskStage.PREVIEW_GENERATION):
+        if full:
+            run_full_pipeline(task_id, resume=True)
+        else:
+            prepare_task(task_id)
+    elif stage == TaskStage.DE_DUPLICATION:
+        dedup_task(task_id, auto_continue=full, dedup_params=dedup_params, resume=True)
+    elif stage in (TaskStage.FOCUS_DETECTION, TaskStage.CROPPING):
+        crop_task(task_id, auto_continue=full, resume=True)
+    elif stage in (TaskStage.TAGGING, TaskStage.PACKAGING):
+        caption_task(task_id, resume=True)
+
+
+def resume_interrupted_tasks() -> List[int]:
+    """Schedule resume for tasks left PROCESSING by a previous backend process.
+
+    In queue mode, workers own their jobs: only jobs whose worker stopped
+    heartbeating are requeued, and tasks with a live job are left alone.
+    """
+    if job_queue.queue_mode():
+        job_queue.requeue_stale()
+    db = SessionLocal()
+    try:
+        tasks = db.query(Task).filter(Task.status == TaskStatus.PROCESSING).all()
+        task_ids = []
+        for task in tasks:
+            if job_queue.queue_mode() and job_queue.active_job(task.id):
+                continue
+            task.status = TaskStatus.PENDING
+            task.message = "检测到中断，等待恢复..."
+            task_ids.append(task.id)
+        db.commit()
     finally:
         db.close()
-    dedup_task(task_id, auto_continue=True, dedup_params=dedup_params)
+    for task_id in task_ids:
+        submit_job("resume", task_id)
+    if task_ids:
+        logger.info(f"Scheduled resume for interrupted tasks: {task_ids}")
+    return task_ids
+
+
+def _prepare_and_dedup(task_id: int, dedup_params: dict = None) -> None:
+    prepare_task(task_id)
+    dedup_task(task_id, dedup_params=dedup_params)
+
+
+def flush_recrops(task_id: int) -> None:
+    """Render the full-res crops still pending after user recrops; runs in the disk class."""
+    rendered = flush_pending_recrops(task_id)
+    if rendered:
+        logger.info(f"任务 {task_id} 补齐 {rendered} 张全分辨率裁切")
+
+
+def schedule_recrop_flush(task_id: int) -> None:
+    """Queue a background flush of pending recrops unless one is already queued or running."""
+    if job_queue.queue_mode():
+        if job_queue.active_job(task_id, kind="flush_recrops") is None:
+            submit_job("flush_recrops", task_id)
+        return
+    with _RECROP_FLUSH_LOCK:
+        future = _RECROP_FLUSHES.get(task_id)
+        if future is not None and not future.done():
+            return
+        _RECROP_FLUSHES[task_id] = submit_job("flush_recrops", task_id)
+
+
+# Stage entry points by job kind; queued jobs store the kind and JSON args only.
+JOB_KINDS = {
+    "prepare": prepare_task,
+    "prepare_dedup": _prepare_and_dedup,
+    "crop": crop_task,
+    "caption": caption_task,
+    "run_all": run_full_pipeline,
+    "resume": resume_task,
+    "flush_recrops": flush_recrops,
+    "recaption": recaption_image,
+}
+
+
+# Resource class a job starts in; stages switch class as they go (see _use_resource).
+JOB_RESOURCES = {
+    "prepare": scheduler.CPU,
+    "prepare_dedup": scheduler.CPU,
+    "crop": scheduler.NET,
+    "caption": scheduler.NET,
+    "run_all": scheduler.CPU,
+    "resume": scheduler.CPU,
+    "flush_recrops": scheduler.DISK,
+    "recaption": scheduler.NET,
+}
+
+# Kinds run on the scheduler's fast lane instead of a batch slot (thread mode).
+INTERACTIVE_JOBS = ("recaption",)
+
+
+def run_job(kind: str, task_id: int, args: Optional[dict] = None) -> None:
+    JOB_KINDS[kind](task_id, **(args or {}))
+
+
+def submit_job(kind: str, task_id: int, **args):
+    """Run a stage in this process's pool, or queue it for a worker process when WORKER_MODE=queue."""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"unknown job kind: {kind}")
+    if job_queue.queue_mode():
+        return job_queue.enqueue(task_id, kind, args, priority=_schedule_params(task_id)["priority"])
+    lane = scheduler.INTERACTIVE if kind in INTERACTIVE_JOBS else scheduler.BATCH
+    return submit_task(JOB_KINDS[kind], task_id, resource=JOB_RESOURCES[kind], lane=lane, **args)
 
 
 @celery_app.task(name="process_task")
@@ -0,0 +1,235 @@
+"""Stage worker processes for WORKER_MODE=queue.
+
+Run next to the API (from the backend directory):
+
+    python -m app.worker --processes 2
+
+Each process claims one job at a time from the jobs table, runs it, and
+heartbeats while it works. A job whose worker dies is requeued as a resume
+by the remaining workers (or the API on its next start).
+
+Rate limits, the hedge cap, the memory budget and the cpu/disk pools live in
+each process, so every worker gets an equal share of the configured totals.
+Workers report their model health, limits and pools to the ``workers`` table
+and pick up pool sizes changed through ``PUT /api/resources/{name}``.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from app.core.config import settings
+
+logger = logging.getLogger("app.worker")
+
+# How often each worker looks for jobs abandoned by a dead worker.
+_STALE_CHECK_INTERVAL = 30.0
+
+
+def _share(total: int, processes: int) -> int:
+    # 0 means unlimited and stays that way; a positive total never drops below 1.
+    return max(1, total // processes) if total > 0 else total
+
+
+def apply_process_share(processes: int) -> None:
+    """Scale this process's copies of the per-process budgets to 1/processes of the totals."""
+    processes = max(1, processes)
+    settings.MODEL_RATE_LIMIT_RPM = _share(settings.MODEL_RATE_LIMIT_RPM, processes)
+    settings.MODEL_RATE_LIMIT_TPM = _share(settings.MODEL_RATE_LIMIT_TPM, processes)
+    settings.MODEL_RATE_LIMITS = {
+        model: {key: _share(int(value), processes) for key, value in limits.items()}
+        for model, limits in settings.MODEL_RATE_LIMITS.items()
+    }
+    settings.MODEL_HEDGE_MAX_OUTSTANDING = _share(settings.MODEL_HEDGE_MAX_OUTSTANDING, processes)
+    settings.MEMORY_BUDGET_MB = _share(settings.MEMORY_BUDGET_MB, processes)
+    settings.CPU_POOL_WORKERS = _share(settings.CPU_POOL_WORKERS, processes)
+    settings.DISK_POOL_WORKERS = _share(settings.DISK_POOL_WORKERS, processes)
+    settings.PREVIEW_WORKERS = _share(settings.PREVIEW_WORKERS or os.cpu_count() or 1, processes)
+
+
+class _StatusReporter(threading.Thread):
+    """Publishes this worker's state and applies pool sizes set through the API."""
+
+    def __init__(self, worker_id: str, processes: int):
+        super().__init__(name="worker-status", daemon=True)
+        self.worker_id = worker_id
+        self.processes = max(1, processes)
+        self._stop_event = threading.Event()
+
+    def _report(self) -> None:
+        from app.services import job_queue, memory_budget, model_router, rate_limiter, resource_pools
+
+        for name, total in job_queue.pool_limits().items():
+            limit = _share(int(total), self.processes)
+            if name in resource_pools.POOL_NAMES and resource_pools.get_pool(name).limit != limit:
+                resource_pools.resize(name, limit)
+        job_queue.report_worker(
+            self.worker_id,
+            {
+                "models": model_router.snapshot(),
+                "limits": rate_limiter.snapshot(),
+                "pools": resource_pools.snapshot(),
+                "memory": memory_budget.snapshot(),
+            },
+        )
+
+    def run(self) -> None:
+        while True:
+            try:
+                self._report()
+            except Exception as exc:
+                logger.warning(f"工作进程状态上报失败: {exc}")
+            if self._stop_event.wait(settings.JOB_HEARTBEAT_INTERVAL):
+                return
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join(timeout=settings.JOB_HEARTBEAT_INTERVAL + 1)
+
+
+class _Heartbeat(threading.Thread):
+    """Keeps the claimed job alive and forwards cancel requests to the running stage."""
+
+    def __init__(self, job_id: int, task_id: int, worker_id: str):
+        super().__init__(name=f"job-heartbeat-{job_id}", daemon=True)
+        self.job_id = job_id
+        self.task_id = task_id
+        self.worker_id = worker_id
+        self.cancelled = False
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        from app.services import job_queue
+        from app.tasks import processing
+
+        while not self._stop_event.wait(settings.JOB_HEARTBEAT_INTERVAL):
+            try:
+                if job_queue.heartbeat(self.job_id, self.worker_id) and not self.cancelled:
+                    self.cancelled = True
+                    logger.info(f"作业 {self.job_id} 收到取消请求，停止任务 {self.task_id}")
+                    processing.cancel_task(self.task_id)
+            except Exception as exc:
+                logger.warning(f"作业 {self.job_id} 心跳失败: {exc}")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join(timeout=settings.JOB_HEARTBEAT_INTERVAL + 1)
+
+
+def _run_one(job: dict, worker_id: str) -> None:
+    from app.models.job import JobStatus
+    from app.services import job_queue
+    from app.tasks import processing
+
+    job_id, task_id = job["id"], job["task_id"]
+    processing.clear_cancelled(task_id)
+    heartbeat = _Heartbeat(job_id, task_id, worker_id)
+    heartbeat.start()
+    status, error = JobStatus.DONE, None
+    logger.info(f"开始作业 {job_id}: 任务 {task_id} {job['kind']}")
+    try:
+        processing.run_job(job["kind"], task_id, job.get("args"))
+    except Exception as exc:
+        logger.exception(f"作业 {job_id} 执行失败")
+        status, error = JobStatus.FAILED, str(exc)
+    finally:
+        heartbeat.stop()
+        if heartbeat.cancelled:
+            status = JobStatus.CANCELLED
+        processing.clear_cancelled(task_id)
+    job_queue.finish(job_id, worker_id, status, error)
+    logger.info(f"作业 {job_id} 结束: {status.value}")
+
+
+def work_loop(stop_event=None, processes: int = 1) -> None:
+    """Claim and run jobs until ``stop_event`` is set."""
+    from app.services import job_queue
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    reporter = _StatusReporter(worker_id, processes)
+    reporter.start()
+    try:
+        _claim_loop(worker_id, stop_event)
+    finally:
+        reporter.stop()
+        try:
+            job_queue.remove_worker(worker_id)
+        except Exception as exc:
+            logger.warning(f"移除工作进程状态失败: {exc}")
+
+
+def _claim_loop(worker_id: str, stop_event) -> None:
+    from app.services import job_queue
+
+    last_stale_check = 0.0
+    while stop_event is None or not stop_event.is_set():
+        now = time.monotonic()
+        if now - last_stale_check >= _STALE_CHECK_INTERVAL:
+            last_stale_check = now
+            try:
+                job_queue.requeue_stale()
+            except Exception as exc:
+                logger.warning(f"检查超时作业失败: {exc}")
+        try:
+            job = job_queue.claim(worker_id)
+        except Exception as exc:
+            # The database may be briefly locked by the API or another worker.
+            logger.warning(f"领取作业失败: {exc}")
+            job = None
+        if job is None:
+            if stop_event is not None:
+                stop_event.wait(settings.JOB_POLL_INTERVAL)
+            else:
+                time.sleep(settings.JOB_POLL_INTERVAL)
+            continue
+        _run_one(job, worker_id)
+
+
+def _process_main(stop_event, processes: int) -> None:
+    # The parent handles Ctrl+C; children finish their current job after stop_event.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=settings.LOG_LEVEL, format="%(asctime)s [%(processName)s] %(levelname)s %(message)s")
+    apply_process_share(processes)
+    work_loop(stop_event, processes)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run stage worker processes for WORKER_MODE=queue")
+    parser.add_argument("--processes", type=int, default=settings.WORKER_PROCESSES)
+    args = parser.parse_args()
+    logging.basicConfig(level=settings.LOG_LEVEL, format="%(asctime)s [%(processName)s] %(levelname)s %(message)s")
+    if settings.WORKER_MODE != "queue":
+        logger.warning("WORKER_MODE 不是 queue，API 不会向队列提交作业")
+
+    ctx = multiprocessing.get_context("spawn")
+    stop_event = ctx.Event()
+    count = max(1, args.processes)
+    # Not daemonic: stages start their own preview render processes.
+    processes = [
+        ctx.Process(target=_process_main, args=(stop_event, count), name=f"worker-{i + 1}")
+        for i in range(count)
+    ]
+    for proc in processes:
+        proc.start()
+    logger.info(f"已启动 {len(processes)} 个工作进程")
+
+    def _stop(*_):
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        for proc in processes:
+            proc.join()
+    except KeyboardInterrupt:
+        logger.info("正在停止工作进程，等待当前作业完成...")
+        stop_event.set()
+        for proc in processes:
+            proc.join()
+
+
+if __name__ == "__main__":
+    main()
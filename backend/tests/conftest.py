@@ -0,0 +1,42 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# Settings are read at import time: point them at a throwaway database and data directory.
+_ROOT = tempfile.mkdtemp(prefix="backend-tests-")
+os.environ.setdefault("MODELSCOPE_TOKEN", "test-token")
+os.environ.setdefault("CELERY_BROKER_URL", "memory://")
+os.environ.setdefault("CELERY_RESULT_BACKEND", "cache+memory://")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_ROOT, 'test.db')}"
+os.environ["WORKER_MODE"] = "inline"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Task files live under ./data relative to the working directory.
+os.chdir(_ROOT)
+
+import app.models.image  # noqa: E402,F401  (mapper configuration needs every model)
+import app.models.log  # noqa: E402,F401
+from app.db.database import SessionLocal, engine  # noqa: E402
+from app.models.task import Base  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def _clean_state():
+    yield
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    # Ids are reused once the rows are gone, so drop their files as well.
+    shutil.rmtree(os.path.join("data", "tasks"), ignore_errors=True)
+    os.makedirs(os.path.join("data", "tasks"))
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
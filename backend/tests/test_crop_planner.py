@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.core.config import settings
+from app.services import crop_planner
+
+
+def _image(width=4000, height=3000, **meta):
+    return SimpleNamespace(width=width, height=height, meta_json=meta, preview_path=None, orig_path=None)
+
+
+def test_default_mode_is_model():
+    assert settings.CROP_PLANNER_MODE == "model"
+    assert crop_planner.planner_mode(SimpleNamespace(config={})) == "model"
+    assert not crop_planner.accept_local({"confidence": 1.0}, "model")
+
+
+def test_small_subject_gets_the_smallest_allowed_side():
+    plan = crop_planner.plan_crop(
+        _image(has_pose=True, pose_conf=0.8, body_bbox_norm=[0.5, 0.5, 0.2, 0.5]), use_saliency=False
+    )
+    assert plan["source"] == "pose"
+    assert plan["focus_point"]["side"] == crop_planner.MIN_CROP_SIDE
+
+
+def test_side_follows_the_body_extent():
+    # A body 0.85 of the 3000 px short edge tall, padded by 10%.
+    plan = crop_planner.plan_crop(
+        _image(has_pose=True, pose_conf=0.8, body_bbox_norm=[0.5, 0.5, 0.2, 0.85]), use_saliency=False
+    )
+    assert plan["focus_point"]["side"] == pytest.approx(0.935)
+
+
+def test_tall_subject_uses_the_whole_short_edge():
+    plan = crop_planner.plan_crop(
+        _image(has_pose=True, pose_conf=0.8, body_bbox_norm=[0.5, 0.5, 0.3, 0.95]), use_saliency=False
+    )
+    assert plan["focus_point"]["side"] == 1.0
+
+
+def test_face_only_plan_is_clamped_like_model_output():
+    plan = crop_planner.plan_crop(
+        _image(has_face=True, face_conf=0.9, face_bbox_norm=[0.5, 0.3, 0.05, 0.07]), use_saliency=False
+    )
+    assert plan["source"] == "face"
+    assert crop_planner.MIN_CROP_SIDE <= plan["focus_point"]["side"] <= 1.0
@@ -0,0 +1,112 @@
+import io
+import os
+import zipfile
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.main import app  # noqa: E402
+from app.models.image import Image  # noqa: E402
+from app.models.task import Task, TaskStage, TaskStatus  # noqa: E402
+from app.tasks import processing  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture
+def exported_task(db):
+    task = Task(name="range", status=TaskStatus.COMPLETED, stage=TaskStage.FINISHED, export_ready=True)
+    db.add(task)
+    db.commit()
+    base = os.path.abspath(f"./data/tasks/{task.id}")
+    os.makedirs(os.path.join(base, "crops", "images"))
+    os.makedirs(os.path.join(base, "crops", "txt"))
+    os.makedirs(os.path.join(base, "export"))
+    for i in range(3):
+        crop = os.path.join(base, "crops", "images", f"{i}.jpg")
+        with open(crop, "wb") as f:
+            f.write(os.urandom(4096))
+        txt = os.path.join(base, "crops", "txt", f"{i}.txt")
+        with open(txt, "w", encoding="utf-8") as f:
+            f.write(f"caption {i}")
+        db.add(Image(task_id=task.id, orig_name=f"{i}.jpg", crop_path=crop, prompt_txt_path=txt, selected=True))
+    task.export_path = os.path.join(base, "export", "train_package.zip")
+    with open(task.export_path, "wb"):
+        pass
+    db.commit()
+    return task
+
+
+def test_full_download_is_a_valid_zip(client, exported_task):
+    response = client.get(f"/api/tasks/{exported_task.id}/download")
+    assert response.status_code == 200
+    assert response.headers["accept-ranges"] == "bytes"
+    assert int(response.headers["content-length"]) == len(response.content)
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == [
+            "images/0.jpg", "images/1.jpg", "images/2.jpg", "manifest.json", "txt/0.txt", "txt/1.txt", "txt/2.txt",
+        ]
+
+
+def test_range_request_returns_partial_content(client, exported_task):
+    full = client.get(f"/api/tasks/{exported_task.id}/download")
+    total = len(full.content)
+    response = client.get(f"/api/tasks/{exported_task.id}/download", headers={"Range": "bytes=100-4199"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-4199/{total}"
+    assert response.headers["content-length"] == "4100"
+    assert response.content == full.content[100:4200]
+
+    tail = client.get(f"/api/tasks/{exported_task.id}/download", headers={"Range": "bytes=-10"})
+    assert tail.status_code == 206
+    assert tail.content == full.content[-10:]
+
+
+def test_if_range_with_stale_etag_sends_full_body(client, exported_task):
+    full = client.get(f"/api/tasks/{exported_task.id}/download")
+    resumed = client.get(
+        f"/api/tasks/{exported_task.id}/download",
+        headers={"Range": "bytes=100-", "If-Range": full.headers["etag"]},
+    )
+    assert resumed.status_code == 206
+    assert resumed.content == full.content[100:]
+
+    stale = client.get(
+        f"/api/tasks/{exported_task.id}/download",
+        headers={"Range": "bytes=100-", "If-Range": '"stale"'},
+    )
+    assert stale.status_code == 200
+    assert stale.content == full.content
+
+
+def test_unsatisfiable_range(client, exported_task):
+    total = len(client.get(f"/api/tasks/{exported_task.id}/download").content)
+    response = client.get(f"/api/tasks/{exported_task.id}/download", headers={"Range": f"bytes={total}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{total}"
+
+
+def test_pending_recrop_defers_download_to_background_flush(client, exported_task, db, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(processing, "_RECROP_FLUSHES", {})
+    monkeypatch.setattr(processing, "submit_job", lambda kind, task_id, **args: submitted.append((kind, task_id)) or Future())
+    image = db.query(Image).filter(Image.task_id == exported_task.id).first()
+    image.meta_json = {"crop_render": {"version": 1, "final": False}}
+    db.commit()
+
+    for _ in range(2):
+        response = client.get(f"/api/tasks/{exported_task.id}/download")
+        assert response.status_code == 409
+        assert response.headers["retry-after"] == "1"
+    assert submitted == [("flush_recrops", exported_task.id)]
+
+    image.meta_json = {"crop_render": {"version": 1, "final": True}}
+    db.commit()
+    assert client.get(f"/api/tasks/{exported_task.id}/download").status_code == 200
@@ -0,0 +1,95 @@
+import io
+import zipfile
+
+import pytest
+
+from app.services.export_package import ZipStreamPlan, parse_range_header
+
+
+def _plan(tmp_path):
+    image = tmp_path / "a.jpg"
+    image.write_bytes(bytes(range(256)) * 40)
+    caption = tmp_path / "a.txt"
+    caption.write_text("a person standing, " * 20, encoding="utf-8")
+    plan = ZipStreamPlan()
+    plan.add_file(str(image), "images/a.jpg", compress=False)
+    plan.add_file(str(caption), "txt/a.txt", compress=True)
+    plan.add_bytes(b'{"images": 1}', "manifest.json")
+    return plan
+
+
+def _body(plan, start=0, end=None):
+    return b"".join(plan.iter_range(start, end))
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        (None, None),
+        ("", None),
+        ("items=0-1", None),
+        ("bytes=0-0,5-9", None),
+        ("bytes=0-99", (0, 99)),
+        ("bytes=10-", (10, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes=990-5000", (990, 999)),
+    ],
+)
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5-4", "bytes=-0", "bytes=a-b"])
+def test_parse_range_header_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        parse_range_header(header, 1000)
+
+
+def test_stream_matches_declared_size_and_unzips(tmp_path):
+    plan = _plan(tmp_path)
+    body = _body(plan)
+    assert len(body) == plan.total_size()
+    with zipfile.ZipFile(io.BytesIO(body)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ["images/a.jpg", "txt/a.txt", "manifest.json"]
+        assert zf.getinfo("images/a.jpg").compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo("txt/a.txt").compress_type == zipfile.ZIP_DEFLATED
+        assert zf.read("images/a.jpg") == (tmp_path / "a.jpg").read_bytes()
+
+
+def test_ranges_are_slices_of_the_full_body(tmp_path):
+    plan = _plan(tmp_path)
+    body = _body(plan)
+    size = len(body)
+    for start, end in [(0, 0), (0, 29), (30, 31), (25, 5000), (size - 22, size - 1), (7, size + 100)]:
+        assert _body(plan, start, end) == body[start:end + 1]
+
+
+def test_resumed_download_reassembles_archive(tmp_path):
+    plan = _plan(tmp_path)
+    size = plan.total_size()
+    cut = size // 3
+    first = _body(plan, 0, cut - 1)
+    start, end = parse_range_header(f"bytes={cut}-", size)
+    assert first + _body(plan, start, end) == _body(plan)
+
+
+def test_etag_follows_member_content(tmp_path):
+    plan = _plan(tmp_path)
+    assert _plan(tmp_path).etag() == plan.etag()
+    changed = ZipStreamPlan()
+    changed.add_file(str(tmp_path / "a.jpg"), "images/a.jpg", compress=False)
+    changed.add_bytes(b"changed", "txt/a.txt")
+    changed.add_bytes(b'{"images": 1}', "manifest.json")
+    assert changed.etag() != plan.etag()
+
+
+def test_zip64_member_count():
+    plan = ZipStreamPlan()
+    for i in range(0x10000 + 1):
+        plan.add_bytes(b"", f"txt/{i}.txt", mtime=0)
+    with zipfile.ZipFile(io.BytesIO(_body(plan))) as zf:
+        names = zf.namelist()
+    assert len(names) == 0x10000 + 1
+    assert names[-1] == "txt/65536.txt"
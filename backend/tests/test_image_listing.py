@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.main import app  # noqa: E402
+from app.models.image import Image  # noqa: E402
+from app.models.task import Task  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture
+def task_id(db):
+    task = Task(name="images", focus_model="focus-model", tag_model="tag-model")
+    db.add(task)
+    db.commit()
+    for i in range(9):
+        db.add(
+            Image(
+                task_id=task.id,
+                orig_name=f"{i}.jpg",
+                selected=i % 3 != 0,
+                caption=f"caption {i}",
+                meta_json={"has_face": i % 2 == 0, "focus": {"shot_type": "closeup" if i < 4 else "long"}},
+            )
+        )
+    db.commit()
+    return task.id
+
+
+def _pages(client, task_id, params):
+    pages, cursor = [], None
+    while True:
+        query = dict(params, **({"cursor": cursor} if cursor is not None else {}))
+        response = client.get(f"/api/tasks/{task_id}/images", params=query)
+        assert response.status_code == 200
+        pages.append(response.json())
+        cursor = response.headers.get("x-next-cursor")
+        if cursor is None:
+            return pages
+
+
+def test_cursor_pages_cover_every_image_once_in_id_order(client, task_id):
+    pages = _pages(client, task_id, {"limit": 4, "fields": "id"})
+    assert [len(page) for page in pages] == [4, 4, 1]
+    ids = [item["id"] for page in pages for item in page]
+    assert ids == sorted(ids) and len(set(ids)) == 9
+
+
+def test_paging_applies_filters(client, task_id):
+    kept = [item["orig_name"] for page in _pages(client, task_id, {"limit": 2, "selected": True}) for item in page]
+    assert kept == ["1.jpg", "2.jpg", "4.jpg", "5.jpg", "7.jpg", "8.jpg"]
+    faces = _pages(client, task_id, {"limit": 10, "has_face": True, "shot_type": "closeup"})
+    assert [item["orig_name"] for item in faces[0]] == ["0.jpg", "2.jpg"]
+
+
+def test_fields_limit_the_returned_keys(client, task_id):
+    items = client.get(f"/api/tasks/{task_id}/images", params={"limit": 2, "fields": "id,keep,prompt_text"}).json()
+    assert all(set(item) == {"id", "keep", "prompt_text"} for item in items)
+    assert items[0]["prompt_text"] == "caption 0"
+    plain = client.get(f"/api/tasks/{task_id}/images", params={"limit": 2}).json()
+    assert "prompt_text" not in plain[0]
+
+
+def test_filters_follow_meta_json_updates(client, task_id, db):
+    image = db.query(Image).filter(Image.task_id == task_id, Image.orig_name == "8.jpg").one()
+    image.meta_json["focus"] = {"shot_type": "closeup"}
+    db.commit()
+    closeups = client.get(f"/api/tasks/{task_id}/images", params={"shot_type": "closeup", "fields": "orig_name"}).json()
+    assert [item["orig_name"] for item in closeups] == ["0.jpg", "1.jpg", "2.jpg", "3.jpg", "8.jpg"]
@@ -0,0 +1,117 @@
+from app.models.job import Job, JobStatus
+from app.services import job_queue
+
+
+def _status(db, job_id):
+    db.expire_all()
+    return db.query(Job).filter(Job.id == job_id).one()
+
+
+def test_claim_takes_highest_priority_then_oldest():
+    low = job_queue.enqueue(1, "crop", priority=0)
+    high = job_queue.enqueue(2, "crop", priority=5)
+    later = job_queue.enqueue(3, "crop", priority=0)
+    assert job_queue.claim("w1")["id"] == high
+    assert job_queue.claim("w2")["id"] == low
+    assert job_queue.claim("w3")["id"] == later
+    assert job_queue.claim("w4") is None
+
+
+def test_claim_marks_the_job_running_for_the_worker(db):
+    job_id = job_queue.enqueue(1, "caption", args={"resume": True})
+    claimed = job_queue.claim("w1")
+    assert claimed["kind"] == "caption"
+    assert claimed["args"] == {"resume": True}
+    job = _status(db, job_id)
+    assert job.status == JobStatus.RUNNING
+    assert job.worker_id == "w1"
+    assert job.attempts == 1
+
+
+def test_a_task_never_runs_two_jobs_at_once():
+    first = job_queue.enqueue(1, "prepare_dedup")
+    second = job_queue.enqueue(1, "crop")
+    other = job_queue.enqueue(2, "crop")
+    assert job_queue.claim("w1")["id"] == first
+    assert job_queue.claim("w2")["id"] == other
+    assert job_queue.claim("w3") is None
+    job_queue.finish(first, "w1", JobStatus.DONE)
+    assert job_queue.claim("w3")["id"] == second
+
+
+def test_requeue_stale_turns_stage_jobs_into_resume(db):
+    job_id = job_queue.enqueue(1, "crop", args={"auto_continue": True})
+    job_queue.claim("w1")
+    assert job_queue.requeue_stale(timeout=-1) == [job_id]
+    job = _status(db, job_id)
+    assert job.status == JobStatus.QUEUED
+    assert job.kind == "resume"
+    assert job.args == {}
+    assert job.worker_id is None
+    reclaimed = job_queue.claim("w2")
+    assert reclaimed["id"] == job_id
+    assert reclaimed["attempts"] == 2
+
+
+def test_requeue_stale_leaves_live_jobs_alone():
+    job_queue.enqueue(1, "crop")
+    job_queue.claim("w1")
+    assert job_queue.requeue_stale(timeout=3600) == []
+
+
+def test_requeue_stale_cancels_jobs_marked_for_cancel(db):
+    job_id = job_queue.enqueue(1, "crop")
+    job_queue.claim("w1")
+    job_queue.request_cancel(1)
+    assert job_queue.requeue_stale(timeout=-1) == []
+    assert _status(db, job_id).status == JobStatus.CANCELLED
+
+
+def test_finish_from_a_superseded_worker_is_ignored(db):
+    job_id = job_queue.enqueue(1, "crop")
+    job_queue.claim("w1")
+    job_queue.requeue_stale(timeout=-1)
+    job_queue.claim("w2")
+    job_queue.finish(job_id, "w1", JobStatus.FAILED, "lost heartbeat")
+    job = _status(db, job_id)
+    assert job.status == JobStatus.RUNNING
+    assert job.worker_id == "w2"
+    job_queue.finish(job_id, "w2", JobStatus.DONE)
+    assert _status(db, job_id).status == JobStatus.DONE
+
+
+def test_heartbeat_reports_cancel_requests():
+    job_id = job_queue.enqueue(1, "crop")
+    job_queue.claim("w1")
+    assert job_queue.heartbeat(job_id, "w1") is False
+    job_queue.request_cancel(1)
+    assert job_queue.heartbeat(job_id, "w1") is True
+
+
+def test_cancel_drops_queued_jobs(db):
+    running = job_queue.enqueue(1, "prepare")
+    queued = job_queue.enqueue(1, "crop")
+    job_queue.claim("w1")
+    assert job_queue.request_cancel(1) == 2
+    assert _status(db, queued).status == JobStatus.CANCELLED
+    assert _status(db, running).status == JobStatus.RUNNING
+    assert _status(db, running).cancel_requested
+
+
+def test_live_workers_only_lists_recent_reports(monkeypatch):
+    job_queue.report_worker("w1", {"processes": 2, "pools": {"cpu": 4}})
+    job_queue.report_worker("w2", {"processes": 2})
+    job_queue.remove_worker("w2")
+    workers = job_queue.live_workers()
+    assert [w["worker_id"] for w in workers] == ["w1"]
+    assert workers[0]["pools"] == {"cpu": 4}
+    monkeypatch.setattr(job_queue.settings, "JOB_HEARTBEAT_TIMEOUT", -1)
+    assert job_queue.live_workers() == []
+
+
+def test_pool_limits_accumulate():
+    assert job_queue.pool_limits() == {}
+    job_queue.set_pool_limit("cpu", 8)
+    job_queue.set_pool_limit("disk", 2)
+    job_queue.set_pool_limit("cpu", 6)
+    assert job_queue.pool_limits() == {"cpu": 6, "disk": 2}
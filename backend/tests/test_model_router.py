@@ -0,0 +1,107 @@
+import pytest
+
+from app.core.config import settings
+from app.services import model_router
+
+BASE = "https://api.example.com/v1"
+
+
+@pytest.fixture(autouse=True)
+def router(monkeypatch):
+    monkeypatch.setattr(model_router, "_HEALTH", {})
+    monkeypatch.setattr(settings, "MODEL_ROUTER_ENABLED", True)
+    monkeypatch.setattr(settings, "MODEL_ROUTER_MIN_SUCCESS_RATE", 0.5)
+    monkeypatch.setattr(settings, "MODEL_BREAKER_FAILURES", 3)
+    monkeypatch.setattr(settings, "MODEL_BREAKER_COOLDOWN", 60.0)
+
+
+def _fail(model, times=1):
+    for _ in range(times):
+        model_router.record_failure(BASE, model, TimeoutError("timed out"))
+
+
+def _succeed(model, times=1, latency=1.0):
+    for _ in range(times):
+        model_router.record_success(BASE, model, latency)
+
+
+def _cool_down(model):
+    model_router._HEALTH[model_router._key(BASE, model)].opened_at -= settings.MODEL_BREAKER_COOLDOWN
+
+
+def _state(model):
+    return model_router._HEALTH[model_router._key(BASE, model)].state
+
+
+def test_consecutive_failures_open_the_breaker():
+    _fail("a", 2)
+    assert model_router.is_available(BASE, "a")
+    assert model_router.pick(BASE, ["a", "b"]) == "a"
+    _fail("a")
+    assert _state("a") == model_router.OPEN
+    assert not model_router.is_available(BASE, "a")
+    assert model_router.pick(BASE, ["a", "b"]) == "b"
+
+
+def test_low_success_rate_opens_the_breaker():
+    # Never three failures in a row, but 2 of 6 succeed.
+    for _ in range(2):
+        _succeed("a")
+        _fail("a", 2)
+    assert _state("a") == model_router.OPEN
+
+
+def test_cooled_down_model_gets_a_single_probe():
+    _fail("a", 3)
+    assert model_router.pick(BASE, ["a", "b"]) == "b"
+    _cool_down("a")
+    assert model_router.pick(BASE, ["a", "b"]) == "a"
+    assert _state("a") == model_router.HALF_OPEN
+    # The probe is outstanding: everyone else keeps using the fallback.
+    assert model_router.pick(BASE, ["a", "b"]) == "b"
+
+
+def test_successful_probe_closes_the_breaker():
+    _fail("a", 3)
+    _cool_down("a")
+    assert model_router.pick(BASE, ["a", "b"]) == "a"
+    _succeed("a")
+    assert _state("a") == model_router.CLOSED
+    assert model_router.pick(BASE, ["a", "b"]) == "a"
+
+
+def test_failed_probe_reopens_the_breaker():
+    _fail("a", 3)
+    _cool_down("a")
+    assert model_router.pick(BASE, ["a", "b"]) == "a"
+    _fail("a")
+    assert _state("a") == model_router.OPEN
+    # A fresh cooldown starts from the failed probe.
+    assert model_router.pick(BASE, ["a", "b"]) == "b"
+
+
+def test_all_open_picks_the_earliest_opened():
+    _fail("b", 3)
+    _fail("a", 3)
+    assert model_router.pick(BASE, ["a", "b"]) == "b"
+
+
+def test_closed_models_rank_by_success_rate():
+    _succeed("a", 4)
+    _fail("a")
+    _succeed("b", 5)
+    assert model_router.pick(BASE, ["a", "b"]) == "b"
+
+
+def test_latency_bands_keep_priority_for_small_differences():
+    _succeed("a", 5, latency=1.5)
+    _succeed("b", 5, latency=1.0)
+    assert model_router.pick(BASE, ["a", "b"]) == "a"
+    _succeed("a", 20, latency=5.0)
+    assert model_router.pick(BASE, ["a", "b"]) == "b"
+
+
+def test_disabled_router_keeps_the_requested_model(monkeypatch):
+    monkeypatch.setattr(settings, "MODEL_ROUTER_ENABLED", False)
+    _fail("a", 3)
+    assert model_router.pick(BASE, ["a", "b"]) == "a"
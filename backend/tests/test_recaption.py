@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.core.config import settings  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models.image import Image  # noqa: E402
+from app.models.job import Job  # noqa: E402
+from app.models.task import Task  # noqa: E402
+from app.services import job_queue  # noqa: E402
+from app.tasks import processing  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture
+def image(db):
+    task = Task(name="recaption", focus_model="focus-model", tag_model="tag-model")
+    db.add(task)
+    db.commit()
+    image = Image(task_id=task.id, orig_name="a.jpg", crop_path="./data/a.jpg", selected=True)
+    db.add(image)
+    db.commit()
+    return image
+
+
+def _recaption_state(db, image):
+    db.expire_all()
+    return (db.get(Task, image.task_id).stats or {}).get("recaption", {}).get(str(image.id))
+
+
+def test_recaption_runs_on_the_fast_lane_and_publishes_the_result(db, image, monkeypatch):
+    monkeypatch.setattr(processing, "caption_image", lambda task_id, image_id: {"id": image_id, "prompt_text": "new"})
+    processing.submit_recaption(image.task_id, image.id).result(timeout=10)
+    assert _recaption_state(db, image) == {"status": "done", "prompt_text": "new"}
+
+
+def test_recaption_failure_is_published(db, image, monkeypatch):
+    def _fail(task_id, image_id):
+        raise RuntimeError("model unavailable")
+
+    monkeypatch.setattr(processing, "caption_image", _fail)
+    with pytest.raises(RuntimeError):
+        processing.submit_recaption(image.task_id, image.id).result(timeout=10)
+    assert _recaption_state(db, image) == {"status": "failed", "error": "model unavailable"}
+
+
+def test_queue_mode_enqueues_ahead_of_stage_jobs(client, db, image, monkeypatch):
+    monkeypatch.setattr(settings, "WORKER_MODE", "queue")
+    stage = job_queue.enqueue(image.task_id + 1, "crop", priority=100)
+    for _ in range(2):
+        response = client.post(f"/api/tasks/{image.task_id}/items/{image.id}/caption")
+        assert response.status_code == 202
+        assert response.json() == {"id": image.id, "status": "queued"}
+    assert _recaption_state(db, image) == {"status": "queued"}
+    # Side jobs do not make the task look busy.
+    assert job_queue.active_job(image.task_id) is None
+
+    claimed = job_queue.claim("w1")
+    assert (claimed["kind"], claimed["args"]) == ("recaption", {"image_id": image.id})
+    assert claimed["priority"] == job_queue.FAST_LANE_PRIORITY
+    assert job_queue.claim("w2")["id"] == stage
+
+
+def test_lost_side_job_is_requeued_as_is(db, image):
+    job_id = job_queue.enqueue(image.task_id, "recaption", {"image_id": image.id})
+    job_queue.claim("w1")
+    assert job_queue.requeue_stale(timeout=-1) == [job_id]
+    job = db.get(Job, job_id)
+    assert (job.kind, job.args) == ("recaption", {"image_id": image.id})
@@ -0,0 +1,99 @@
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.main import app  # noqa: E402
+from app.models.image import Image  # noqa: E402
+from app.models.task import Task, TaskStatus  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture
+def task_ids(db):
+    tasks = [
+        Task(
+            name=f"t{i}",
+            status=TaskStatus.COMPLETED if i % 2 else TaskStatus.PENDING,
+            focus_model="focus-model",
+            tag_model="tag-model",
+        )
+        for i in range(7)
+    ]
+    db.add_all(tasks)
+    db.commit()
+    return [task.id for task in tasks]
+
+
+def _pages(client, params):
+    pages, cursor = [], None
+    while True:
+        query = dict(params, **({"cursor": cursor} if cursor is not None else {}))
+        response = client.get("/api/tasks", params=query)
+        assert response.status_code == 200
+        pages.append([task["id"] for task in response.json()])
+        cursor = response.headers.get("x-next-cursor")
+        if cursor is None:
+            return pages
+
+
+def test_cursor_pages_cover_every_task_once_newest_first(client, task_ids):
+    pages = _pages(client, {"limit": 3})
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [task_id for page in pages for task_id in page] == sorted(task_ids, reverse=True)
+
+
+def test_exact_last_page_has_no_next_cursor(client, task_ids):
+    pages = _pages(client, {"limit": 7})
+    assert pages == [sorted(task_ids, reverse=True)]
+
+
+def test_cursor_paging_applies_filters(client, task_ids):
+    pages = _pages(client, {"limit": 2, "status": "completed"})
+    assert [task_id for page in pages for task_id in page] == sorted(task_ids[1::2], reverse=True)
+
+
+def test_unchanged_listing_answers_304(client, task_ids, db):
+    first = client.get("/api/tasks", params={"limit": 3})
+    etag = first.headers["etag"]
+    again = client.get("/api/tasks", params={"limit": 3}, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["etag"] == etag
+
+    # Another page or query string is a different resource.
+    other = client.get("/api/tasks", params={"limit": 2}, headers={"If-None-Match": etag})
+    assert other.status_code == 200
+
+    task = db.get(Task, task_ids[0])
+    task.message = "changed"
+    db.commit()
+    changed = client.get("/api/tasks", params={"limit": 3}, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+
+
+def test_image_changes_invalidate_the_task_etag(client, task_ids, db):
+    image = Image(task_id=task_ids[0], orig_name="a.jpg", selected=True)
+    db.add(image)
+    db.commit()
+    etag = client.get(f"/api/tasks/{task_ids[0]}").headers["etag"]
+    image.selected = False
+    db.commit()
+    response = client.get(f"/api/tasks/{task_ids[0]}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["items"][0]["keep"] is False
+
+
+def test_export_ready_is_read_from_the_task_row(client, task_ids, db):
+    task = db.get(Task, task_ids[0])
+    # The listing must not stat export files: a missing path does not change the flag.
+    task.export_path = "./data/tasks/missing/export/train_package.zip"
+    task.export_ready = True
+    db.commit()
+    listed = {item["id"]: item for item in client.get("/api/tasks").json()}
+    assert listed[task_ids[0]]["export_ready"] is True
+    assert listed[task_ids[1]]["export_ready"] is False
@@ -222,10 +222,23 @@ export const getTask = async (taskId: number): Promise<Task> => {
   return response.data
 }
 
+// Attempts while the server is still rendering full-resolution recrops (409 + Retry-After).
+const DOWNLOAD_MAX_ATTEMPTS = 20
+
 export const downloadTask = async (taskId: number): Promise<void> => {
-  const response = await api.get(`/tasks/${taskId}/download`, {
-    responseType: 'blob'
-  })
+  let response
+  for (let attempt = 1; ; attempt++) {
+    try {
+      response = await api.get(`/tasks/${taskId}/download`, {
+        responseType: 'blob'
+      })
+      break
+    } catch (error: any) {
+      if (error?.response?.status !== 409 || attempt >= DOWNLOAD_MAX_ATTEMPTS) throw error
+      const retryAfter = Number(error.response.headers?.['retry-after']) || 1
+      await new Promise(resolve => setTimeout(resolve, retryAfter * 1000))
+    }
+  }
 
   const url = window.URL.createObjectURL(new Blob([response.data]))
   const link = document.createElement('a')
@@ -278,6 +291,38 @@ export const createEventSource = (taskId: number, onMessage: (data: any) => void
   return eventSource
 }
 
+export type TaskDelta = Partial<Task> & { id: number; deleted?: boolean }
+
+export interface TaskStreamHandlers {
+  // Full state of every subscribed task (on connect, or when a resume point is gone).
+  onSnapshot: (tasks: TaskDelta[]) => void
+  // Only the fields that changed, per task; deleted tasks come as { id, deleted: true }.
+  onUpdate: (tasks: TaskDelta[]) => void
+}
+
+// One multiplexed SSE connection for the progress of all tasks (or the given ones).
+// EventSource reconnects by itself and the server resumes from Last-Event-ID.
+export const createTaskStream = (handlers: TaskStreamHandlers, taskIds?: number[]): EventSource => {
+  const query = taskIds?.length ? `?tasks=${taskIds.join(',')}` : ''
+  const eventSource = new EventSource(buildSseUrl(`/events${query}`))
+  const parse = (event: Event): TaskDelta[] => {
+    try {
+      return JSON.parse((event as MessageEvent).data).tasks || []
+    } catch (error) {
+      console.error('Error parsing SSE message:', error)
+      return []
+    }
+  }
+
+  eventSource.addEventListener('snapshot', (event) => handlers.onSnapshot(parse(event)))
+  eventSource.addEventListener('update', (event) => handlers.onUpdate(parse(event)))
+  eventSource.onerror = () => {
+    console.warn('SSE 连接中断，等待自动重连')
+  }
+
+  return eventSource
+}
+
 export const triggerDedup = async (taskId: number, dedupParams?: any) => {
   return api.post(`/tasks/${taskId}/dedup`, dedupParams || {})
 }
@@ -47,6 +47,7 @@ export interface TaskImage {
   meta_json: any
   preview_url?: string | null
   crop_url?: string | null
+  thumb_url?: string | null
   has_prompt: boolean
   prompt_text?: string
   subject_area_ratio?: number